@@ -5,9 +5,12 @@ upgma takes an dictionary of pair tuples mapped to distances as input.
 
 UPGMA_cluster takes an array and a list of PhyloNode objects corresponding 
 to the array as input. Can also generate this type of input from a Dict2D using
-inputs_from_dict2D function.
+inputs_from_dict2D function.  The array can be either square or a condensed
+vector of the distances above the diagonal (see condensed_from_matrix), which
+in single precision needs an eighth of the memory of a square float64 array.
 
-Both return a PhyloNode object of the UPGMA cluster
+Both return a PhyloNode object of the UPGMA cluster, built with the nearest
+neighbour chain algorithm in O(n^2) time.
 """
 
 from numpy import array, ravel, argmin, take, sum, average, ma, diag
@@ -106,11 +109,13 @@ def condense_node_order(matrix, smallest_index, node_order):
     Also sets the branch length of the nodes to 1/2 of the distance between
     the nodes in the matrix"""
     index1, index2 = smallest_index
+    _join_nodes(node_order, index1, index2, matrix[index1, index2])
+    return node_order
+
+def _join_nodes(node_order, index1, index2, distance):
     node1 = node_order[index1]
     node2 = node_order[index2]
-    #get the distance between the nodes and assign 1/2 the distance to the
-    #Length property of each node
-    distance = matrix[index1, index2]
+    #assign 1/2 the distance to the Length property of each node
     nodes = [node1,node2]
     d = distance/2.0
     for n in nodes:
@@ -129,34 +134,88 @@ def condense_node_order(matrix, smallest_index, node_order):
     node_order[index1] = new_node
     #replace the object at index2 with None
     node_order[index2] = None
-    return node_order
 
-def UPGMA_cluster(matrix, node_order, large_number):
+def condensed_from_matrix(matrix, dtype=numpy.float32):
+    """the distances above the diagonal of a square matrix as a vector,
+    row by row, in single precision by default.
+    
+    Distance i,j (i < j) of n items is at i*(2*n-i-1)//2 + j-i-1."""
+    n = len(matrix)
+    condensed = numpy.empty([n * (n-1) // 2], dtype)
+    start = 0
+    for i in range(n-1):
+        end = start + n - i - 1
+        condensed[start:end] = matrix[i, i+1:]
+        start = end
+    return condensed
+
+def _condensed_row_index(offsets, i):
+    """positions in a condensed vector of the distances from i, with i's own
+    (non-existent) position given as 0.  offsets[k] is where row k would
+    start if it included its first k+1 entries."""
+    index = offsets[i] + numpy.arange(len(offsets))
+    index[:i] = offsets[:i] + i
+    index[i] = 0
+    return index
+
+def UPGMA_cluster(matrix, node_order, large_number=None):
     """cluster with UPGMA
     
-    matrix is a numpy array.
+    matrix is a numpy array, either square or condensed (see
+    condensed_from_matrix).
     node_order is a list of PhyloNode objects corresponding to the matrix.
-    large_number will be assigned to the matrix during the process and
-    should be much larger than any value already in the matrix.
+    large_number is no longer needed as the diagonal and already clustered
+    rows are ignored.
+    
+    Clusters are found with the nearest neighbour chain algorithm, so each
+    merge only scans single rows of the matrix rather than all of it. This
+    gives the same tree as repeatedly merging the closest pair, except
+    perhaps for the order in which tied distances are joined.
     
-    WARNING: Changes matrix in-place.
-    WARNING: Expects matrix to already have diagonals assigned to large_number
-             before this function is called.
+    WARNING: Changes matrix and node_order in-place.
     """
     num_entries = len(node_order)
-    tree = None
-    for i in range(num_entries - 1):
-        smallest_index = find_smallest_index(matrix)
-        index1, index2 = smallest_index
-        #if smallest_index is on the diagonal set the diagonal to large_number
-        if index1 == index2:
-            matrix[diag([True]*len(matrix))] = large_number
-            smallest_index = find_smallest_index(matrix)
-        row_order = condense_node_order(matrix, smallest_index, \
-                node_order)
-        matrix = condense_matrix(matrix, smallest_index, large_number)
-        tree = node_order[smallest_index[0]]
-    return tree
+    if matrix.ndim == 1:
+        assert len(matrix) == num_entries * (num_entries-1) // 2
+        k = numpy.arange(num_entries, dtype=numpy.int64)
+        offsets = k * (2*num_entries - k - 1) // 2 - k - 1
+        def get_row(i):
+            return matrix[_condensed_row_index(offsets, i)].astype(Float)
+        def set_row(i, values):
+            index = _condensed_row_index(offsets, i)
+            others = numpy.arange(num_entries) != i
+            matrix[index[others]] = values[others]
+    else:
+        assert matrix.shape == (num_entries, num_entries)
+        def get_row(i):
+            return matrix[i].astype(Float)
+        def set_row(i, values):
+            matrix[i] = values
+            matrix[:, i] = values
+    
+    active = numpy.ones([num_entries], bool)
+    chain = []
+    for remaining in range(num_entries, 1, -1):
+        while True:
+            if not chain:
+                chain.append(numpy.flatnonzero(active)[0])
+            a = chain[-1]
+            row = get_row(a)
+            row[a] = numpy.inf
+            row[~active] = numpy.inf
+            b = argmin(row)
+            # prefer the previous link when tied, so the chain can't cycle
+            if len(chain) > 1 and row[chain[-2]] <= row[b]:
+                break
+            chain.append(b)
+        b = chain[-2]
+        del chain[-2:]
+        (index1, index2) = (min(a, b), max(a, b))
+        distance = row[b]
+        _join_nodes(node_order, index1, index2, distance)
+        set_row(index1, (get_row(index1) + get_row(index2)) / 2.0)
+        active[index2] = False
+    return node_order[0]
 
 def inputs_from_dict2D(dict2d_matrix):
     """makes inputs for UPGMA_cluster from a Dict2D object
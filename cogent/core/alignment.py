@@ -36,13 +36,15 @@ from cogent.format.phylip import phylip_from_alignment
 from cogent.format.nexus import nexus_from_alignment
 from cogent.parse.gff import GffParser, parse_attributes
 from numpy import nonzero, array, logical_or, logical_and, logical_not, \
-    transpose, arange, zeros, ones, take, put, uint8, ndarray
+    transpose, arange, zeros, ones, take, put, uint8, ndarray, empty, \
+    bincount, concatenate, bitwise_or
 from numpy.random import randint, permutation
 
 from cogent.util.dict2d import Dict2D
 
 from copy import copy, deepcopy
 from cogent.core.profile import Profile
+from cogent.util.array import row_uncertainty
 
 __author__ = "Peter Maxwell and Rob Knight"
 __copyright__ = "Copyright 2007-2016, The Cogent Project"
@@ -1291,6 +1293,12 @@ class SequenceCollection(object):
         
         return gaps_ok
     
+    def _gapOkPositions(self, allowed_gap_frac, negate=False):
+        """Returns indices of the positions passing _make_gaps_ok, or failing
+        it if negate is True."""
+        return self.getPositionIndices(self._make_gaps_ok(allowed_gap_frac),
+            negate)
+    
     def omitGapPositions(self, allowed_gap_frac=1-eps, del_seqs=False, \
         allowed_frac_bad_cols=0, seq_constructor=None):
         """Returns new alignment where all cols have <= allowed_gap_frac gaps.
@@ -1315,15 +1323,14 @@ class SequenceCollection(object):
         """
         if seq_constructor is None:
             seq_constructor = self.MolType.Sequence
-        gaps_ok = self._make_gaps_ok(allowed_gap_frac)
         #if we're not deleting the 'naughty' seqs that contribute to the
         #gaps, it's easy...
         if not del_seqs:
-            return self.takePositionsIf(f=gaps_ok, \
+            return self.takePositions(self._gapOkPositions(allowed_gap_frac),
                 seq_constructor=seq_constructor)
         #otherwise, we have to figure out which seqs to delete.
         #if we get here, we're doing del_seqs.
-        cols_to_delete = dict.fromkeys(self.getPositionIndices(gaps_ok, \
+        cols_to_delete = dict.fromkeys(self._gapOkPositions(allowed_gap_frac,
             negate=True))
         default_gap_f = self.MolType.Gaps.__contains__
         
@@ -2076,6 +2083,7 @@ class DenseAlignment(AlignmentI, SequenceCollection):
     """
     MolType = None             #will be set to BYTES on moltype import
     Alphabet = None            #will be set to BYTES.Alphabet on moltype import
+    block_size = 2**22         #maximum number of values to handle at once
     
     InputHandlers = {   'array':aln_from_array,
                         'model_seqs':aln_from_model_seqs,
@@ -2094,8 +2102,11 @@ class DenseAlignment(AlignmentI, SequenceCollection):
         """
         kwargs['suppress_named_seqs'] = True
         super(DenseAlignment, self).__init__(*args, **kwargs)
-        self.ArrayPositions = transpose(\
-            self.SeqData.astype(self.Alphabet.ArrayType))
+        data = self.SeqData
+        if not (kwargs.get('force_same_data') and \
+                data.dtype == self.Alphabet.ArrayType):
+            data = data.astype(self.Alphabet.ArrayType)
+        self.ArrayPositions = transpose(data)
         self.ArraySeqs = transpose(self.ArrayPositions)
         self.SeqData = self.ArraySeqs
         self.SeqLen = len(self.ArrayPositions)
@@ -2159,7 +2170,17 @@ class DenseAlignment(AlignmentI, SequenceCollection):
         Result shares data with the original array, so if you change the
         result you change the Alignment.
         """
-        return self.Positions[item]
+        if isinstance(item, slice):
+            return map(self.Alphabet.fromIndices, self.ArrayPositions[item])
+        return self.Alphabet.fromIndices(self.ArrayPositions[item])
+    
+    def _iterBlocks(self):
+        """Yields (start, end, array of positions start to end of each
+        sequence), with at most block_size values in each block."""
+        width = max(1, self.block_size // max(1, len(self.Names)))
+        for start in range(0, self.SeqLen, width):
+            end = min(start + width, self.SeqLen)
+            yield start, end, self.ArraySeqs[:, start:end]
     
     def _coerce_seqs(self, seqs, is_array):
         """Controls how seqs are coerced in _names_seqs_order.
@@ -2235,13 +2256,27 @@ class DenseAlignment(AlignmentI, SequenceCollection):
         index, and the symbol index as the second index. For example, for the
         TCAG DNA Alphabet, result[3][0] would store the count of T in the
         sequence at index 3 (i.e. the 4th sequence).
+        
+        The counts are made by bincount, a block of positions at a time.
         """
+        num_symbols = len(self.Alphabet)
+        num_seqs = len(self.Names)
         if index:
-            a = self.ArrayPositions
+            result = zeros([self.SeqLen, num_symbols], int)
         else:
-            a = self.ArraySeqs
-        count_f = self.Alphabet.counts
-        return array(map(count_f, a))
+            result = zeros([num_seqs, num_symbols], int)
+        for (start, end, block) in self._iterBlocks():
+            if index:
+                offsets = arange(end - start) * num_symbols
+                counts = bincount((block + offsets).ravel(),
+                    minlength=len(offsets) * num_symbols)
+                result[start:end] = counts.reshape([-1, num_symbols])
+            else:
+                offsets = arange(num_seqs)[:, None] * num_symbols
+                counts = bincount((block + offsets).ravel(),
+                    minlength=num_seqs * num_symbols)
+                result += counts.reshape([num_seqs, num_symbols])
+        return result
     
     def getPosFreqs(self):
         """Returns Profile of counts: position by character.
@@ -2276,6 +2311,47 @@ class DenseAlignment(AlignmentI, SequenceCollection):
         p.normalizePositions()
         return p.rowUncertainty()
     
+    def _gapIndices(self):
+        """Returns the alphabet indices of the MolType gaps and the alphabet
+        gap, i.e. the symbols ModelSequence.gapArray counts as gaps."""
+        alphabet = self.Alphabet
+        gaps = set(getattr(self.MolType, 'Gaps', None) or [])
+        gaps.add(getattr(alphabet, 'Gap', None))
+        return sorted([alphabet.index(gap) for gap in gaps
+            if gap is not None and gap in alphabet])
+    
+    def columnSummary(self):
+        """Returns (counts, entropies, gap_fractions) for each position.
+        
+        counts is the position by symbol array from _get_freqs(1), entropies
+        the Shannon entropy of each position in bits (as from getPosEntropy),
+        and gap_fractions the fraction of the sequences with a gap at each
+        position.  All three come from one count of the array of indices,
+        without making an object for each position.
+        """
+        counts = self._get_freqs(1)
+        num_seqs = len(self.Names)
+        if num_seqs:
+            probs = counts / float(num_seqs)
+        else:
+            probs = zeros(counts.shape, float)
+        entropies = row_uncertainty(probs)
+        gap_fractions = probs[:, self._gapIndices()].sum(1)
+        return counts, entropies, gap_fractions
+    
+    def uncertainties(self, good_items=None):
+        """Returns Shannon uncertainty at each position.
+        
+        As AlignmentI.uncertainties, but calculated from the symbol counts.
+        """
+        counts = self._get_freqs(1)
+        if good_items:
+            counts = counts[:, [i for (i, symbol) in enumerate(self.Alphabet)
+                if symbol in good_items]]
+        totals = counts.sum(1)
+        totals[totals == 0] = 1
+        return list(row_uncertainty(counts / totals[:, None].astype(float)))
+    
     def IUPACConsensus(self, alphabet=None):
         """Returns string containing IUPAC consensus sequence of the alignment.
         """
@@ -2313,10 +2389,53 @@ class DenseAlignment(AlignmentI, SequenceCollection):
         
         return gaps_ok
     
+    def takePositions(self, cols, negate=False, seq_constructor=None):
+        """Returns new Alignment containing only specified positions.
+        
+        As AlignmentI.takePositions, but the positions are taken from the
+        array of indices rather than one symbol at a time.
+        """
+        if seq_constructor is None:
+            seq_constructor = self.MolType.Sequence
+        cols = array(list(cols), int)
+        if negate:
+            keep = ones(self.SeqLen, bool)
+            keep[cols] = False
+            cols = nonzero(keep)[0]
+        from_indices = self.Alphabet.fromIndices
+        result = {}
+        for (name, row) in zip(self.Names, self.ArraySeqs):
+            result[name] = seq_constructor(from_indices(row[cols]))
+        return self.__class__(result, Names=self.Names)
+    
+    def _gapOkPositions(self, allowed_gap_frac, negate=False):
+        """Returns indices of the positions passing _make_gaps_ok, or failing
+        it if negate is True, counting the alphabet gap a block at a time."""
+        gap_index = getattr(self.Alphabet, 'GapIndex', None)
+        if gap_index is None or not self.Names:
+            return super(DenseAlignment, self)._gapOkPositions(
+                allowed_gap_frac, negate)
+        num_gaps = zeros(self.SeqLen, int)
+        for (start, end, block) in self._iterBlocks():
+            num_gaps[start:end] = (block == gap_index).sum(0)
+        ok = num_gaps / len(self.Names) <= allowed_gap_frac
+        if negate:
+            ok = logical_not(ok)
+        return nonzero(ok)[0].tolist()
+    
     def columnFreqs(self, constructor=Freqs):
         """Returns list of Freqs with item counts for each column.
         """
-        return map(constructor, self.Positions)
+        if constructor is Freqs:
+            symbols = list(self.Alphabet)
+            return [Freqs(dict([(symbols[i], position[i])
+                for i in nonzero(position)[0]]))
+                for position in self._get_freqs(1)]
+        result = []
+        for (start, end, block) in self._iterBlocks():
+            result.extend([constructor(self.Alphabet.fromIndices(position))
+                for position in block.T])
+        return result
 
     def sample(self, n=None, with_replacement=False, motif_length=1, \
         randint=randint, permutation=permutation):
@@ -2356,6 +2475,12 @@ class DenseAlignment(AlignmentI, SequenceCollection):
         result = self.__class__(positions.T,force_same_data=True, \
             Info=self.Info, Names=self.Names)
         return result
+    
+    def pack(self):
+        """Returns a PackedDenseAlignment of the same data, using 2 or 4 bits
+        per position."""
+        return PackedDenseAlignment(self.ArrayPositions, map(str, self.Names),
+            self.Alphabet, conversion_f=aln_from_array, Info=self.Info)
  
 class CodonDenseAlignment(DenseAlignment):
     """Stores alignment of gapped codons, no degenerate symbols."""
@@ -2369,6 +2494,201 @@ class CodonDenseAlignment(DenseAlignment):
                         'empty':aln_from_empty,
                     }
 
+def _pack_indices(a, bits):
+    """Packs each row of a 2D array of integers below 2**bits into a row of
+    bytes, 8/bits values per byte with the first in the lowest bits."""
+    per_byte = 8 // bits
+    (num_rows, length) = a.shape
+    width = -(-length // per_byte)
+    padded = zeros([num_rows, width * per_byte], uint8)
+    padded[:, :length] = a
+    shifts = (arange(per_byte) * bits).astype(uint8)
+    shifted = padded.reshape([num_rows, width, per_byte]) << shifts
+    return bitwise_or.reduce(shifted, axis=2).astype(uint8)
+
+def _unpack_indices(packed, bits, start, end, dtype=uint8):
+    """Values start to end of each row packed by _pack_indices"""
+    per_byte = 8 // bits
+    first = start // per_byte
+    block = packed[:, first:-(-end // per_byte)]
+    mask = (1 << bits) - 1
+    result = empty(block.shape + (per_byte,), dtype)
+    for k in range(per_byte):
+        result[:, :, k] = (block >> (bits * k)) & mask
+    offset = first * per_byte
+    return result.reshape([len(packed), -1])[:, start-offset:end-offset]
+
+class PackedDenseAlignment(DenseAlignment):
+    """A DenseAlignment stored with 2 bits per position, when only the first
+    4 symbols of the alphabet are used (eg: DNA without gaps or ambiguity
+    codes), or else 4 bits when only the first 16 are (eg: gapped and
+    degenerate DNA without '?').
+    
+    Single positions, slices of positions, getSubAlignment, takeSeqs,
+    getGappedSeq, NamedSeqs, iterPositions, columnFreqs and the symbol counts
+    unpack just the sequences or positions they need, a block at a time.
+    Everything else works as for a DenseAlignment, but through ArraySeqs,
+    ArrayPositions and SeqData, which are unpacked in full each time they
+    are used.  Changing them doesn't change the alignment.
+    """
+    def __init__(self, *args, **kwargs):
+        super(PackedDenseAlignment, self).__init__(*args, **kwargs)
+        seqs = self.__dict__.pop('ArraySeqs')
+        for name in ['ArrayPositions', 'SeqData', '_seqs']:
+            self.__dict__.pop(name, None)
+        max_index = seqs.max() if seqs.size else 0
+        if max_index < 4:
+            bits = 2
+        elif max_index < 16:
+            bits = 4
+        else:
+            raise ValueError("Can't pack symbol '%s', only the first 16 "
+                "symbols of an alphabet" % self.Alphabet[max_index])
+        self._packed = _pack_indices(seqs, bits)
+        self._bits = bits
+        self._array_type = seqs.dtype
+    
+    def __getattr__(self, name):
+        # the unpacked arrays, which DenseAlignment keeps as attributes
+        if name in ['ArraySeqs', 'SeqData']:
+            return self._unpack()
+        elif name == 'ArrayPositions':
+            return self._unpack().T
+        raise AttributeError(name)
+    
+    def _unpack(self, start=0, end=None):
+        """Array of positions start to end of each sequence"""
+        if end is None:
+            end = self.SeqLen
+        return _unpack_indices(self._packed, self._bits, start, end,
+            self._array_type)
+    
+    def _iterBlocks(self):
+        width = max(1, self.block_size // max(1, len(self._packed)))
+        for start in range(0, self.SeqLen, width):
+            end = min(start + width, self.SeqLen)
+            yield start, end, self._unpack(start, end)
+    
+    def _iterRowBlocks(self):
+        num_rows = max(1, self.block_size // max(1, self.SeqLen))
+        for first in range(0, len(self._packed), num_rows):
+            rows = self._packed[first:first+num_rows]
+            yield _unpack_indices(rows, self._bits, 0, self.SeqLen,
+                self._array_type)
+    
+    def _makeSeq(self, row):
+        seq = self.Alphabet.toString(row)
+        if self.MolType:
+            seq = self.MolType.Sequence(seq)
+        return seq
+    
+    def _get_named_seqs(self):
+        if '_named_seqs' not in self.__dict__:
+            seqs = [self._makeSeq(row) for block in self._iterRowBlocks()
+                for row in block]
+            self._named_seqs = self._make_named_seqs(self.Names, seqs)
+        return self._named_seqs
+    
+    NamedSeqs = property(_get_named_seqs)
+    
+    def getGappedSeq(self, seq_name, recode_gaps=False):
+        """Return a gapped Sequence object for the specified seqname,
+        unpacking just that sequence unless NamedSeqs already has."""
+        if '_named_seqs' in self.__dict__:
+            return self._named_seqs[seq_name]
+        row = self._packed[self.Names.index(seq_name)][None]
+        seq = self._makeSeq(_unpack_indices(row, self._bits, 0, self.SeqLen,
+            self._array_type)[0])
+        seq.Name = seq_name
+        return seq
+    
+    def iterPositions(self, pos_order=None):
+        """Iterates over positions in the alignment, as
+        DenseAlignment.iterPositions but unpacking a block at a time."""
+        if pos_order is not None:
+            for pos in pos_order:
+                if not -self.SeqLen <= pos < self.SeqLen:
+                    raise IndexError("position %s out of range" % pos)
+                pos %= self.SeqLen
+                column = self._unpack(pos, pos+1)
+                yield [self._makeSeq(symbol) for symbol in column]
+            return
+        for (start, end, block) in self._iterBlocks():
+            seqs = [self._makeSeq(row) for row in block]
+            for pos in range(end - start):
+                yield [seq[pos] for seq in seqs]
+    
+    def _fromPacked(self, packed, names):
+        result = self.__class__.__new__(self.__class__)
+        result.__dict__.update(self.__dict__)
+        result.__dict__.pop('_named_seqs', None)
+        result.Names = names
+        result._packed = packed
+        return result
+    
+    def __getitem__(self, item):
+        """Position (column) item as a list of symbols, or a list of
+        them if item is a slice"""
+        if isinstance(item, slice):
+            positions = arange(self.SeqLen)[item]
+            if not len(positions):
+                return []
+            (start, end) = (positions.min(), positions.max() + 1)
+            block = self._unpack(start, end)[:, positions - start]
+            return map(self.Alphabet.fromIndices, block.T)
+        if item < 0:
+            item += self.SeqLen
+        if not 0 <= item < self.SeqLen:
+            raise IndexError("position %s out of range" % item)
+        return self.Alphabet.fromIndices(self._unpack(item, item+1)[:, 0])
+    
+    def getSubAlignment(self, seqs=None, pos=None, invert_seqs=False, \
+        invert_pos=False):
+        """Returns subalignment of specified sequences and positions, as
+        DenseAlignment.getSubAlignment but packed."""
+        packed = self._packed
+        names = self.Names
+        if seqs is not None:
+            if invert_seqs:
+                seq_mask = ones(len(packed))
+                put(seq_mask, seqs, 0)
+                seqs = nonzero(seq_mask)[0]
+            packed = take(packed, seqs, 0)
+            names = [self.Names[i] for i in seqs]
+        result = self._fromPacked(packed, map(str, names))
+        if pos is not None:
+            if invert_pos:
+                pos_mask = ones(self.SeqLen)
+                put(pos_mask, pos, 0)
+                pos = nonzero(pos_mask)[0]
+            pos = array(pos, int)
+            new_packed = [_pack_indices(block[:, pos], self._bits)
+                for block in result._iterRowBlocks()]
+            if new_packed:
+                packed = concatenate(new_packed)
+            else:
+                packed = zeros([0, 0], uint8)
+            result._packed = packed
+            result.SeqLen = len(pos)
+        return result
+    
+    def takeSeqs(self, seqs, negate=False, **kwargs):
+        """Returns new PackedDenseAlignment containing only specified
+        seqs."""
+        if kwargs:
+            return super(PackedDenseAlignment, self).takeSeqs(seqs, negate,
+                **kwargs)
+        index = dict((name, i) for (i, name) in enumerate(self.Names))
+        rows = [index[name] for name in seqs]
+        if not rows and not negate:
+            return {}   #safe value; can't construct empty alignment
+        return self.getSubAlignment(seqs=rows, invert_seqs=negate)
+    
+    def unpack(self):
+        """Returns a DenseAlignment of the same data."""
+        return DenseAlignment(self.ArrayPositions, map(str, self.Names),
+            self.Alphabet, conversion_f=aln_from_array, Info=self.Info)
+
 def make_gap_filter(template, gap_fraction, gap_run):
     """Returns f(seq) -> True if no gap runs and acceptable gap fraction.
     
@@ -2378,10 +2698,15 @@ def make_gap_filter(template, gap_fraction, gap_run):
         but not in the seq or in the seq but not in the template
     NOTE: template and seq must both be ModelSequence objects.
     """
-    template_gaps = array(template.gapVector())
+    def gap_array(seq):
+        if hasattr(seq, 'gapArray'):
+            return seq.gapArray()
+        return array(seq.gapVector())
+    
+    template_gaps = gap_array(template)
     def result(seq):
         """Returns True if seq adhers to the gap threshold and gap fraction."""
-        seq_gaps = array(seq.gapVector())
+        seq_gaps = gap_array(seq)
         #check if gap amount bad
         if sum(seq_gaps!=template_gaps)/float(len(seq)) > gap_fraction:
             return False
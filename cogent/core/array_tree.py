@@ -0,0 +1,428 @@
+#!/usr/bin/env python
+"""An immutable, array based view of a tree for fast bulk operations.
+
+Nodes are numbered in preorder so that the subtree of node u is the range of
+nodes u:end[u].  Most operations can then be done with numpy on whole arrays
+rather than by walking a linked tree of TreeNode objects in Python, which
+matters for trees of 100,000 tips or more.
+"""
+
+import numpy
+from cogent.core.tree import PhyloNode, TreeError, UniqueNames
+from cogent.parse.newick import parse_string, _BulkTokeniser, \
+        _quotes_or_comments
+
+__author__ = "Peter Maxwell"
+__copyright__ = "Copyright 2007-2016, The Cogent Project"
+__credits__ = ["Peter Maxwell"]
+__license__ = "GPL"
+__version__ = "1.9"
+__maintainer__ = "Peter Maxwell"
+__email__ = "pm67nz@gmail.com"
+__status__ = "Production"
+
+
+def _frozen(a):
+    a.flags.writeable = False
+    return a
+
+# Classes of Newick tokens.  _FOLLOWS[a, b] says if b can come after a.
+(_NAME, _OPEN, _CLOSE, _COMMA, _COLON, _LENGTH, _END) = range(7)
+_FOLLOWS = numpy.zeros([7, 7], bool)
+for (_before, _afters) in [
+        (_OPEN, [_OPEN, _CLOSE, _COMMA, _COLON, _NAME]),
+        (_COMMA, [_OPEN, _CLOSE, _COMMA, _COLON, _NAME]),
+        (_CLOSE, [_CLOSE, _COMMA, _COLON, _NAME, _END]),
+        (_NAME, [_CLOSE, _COMMA, _COLON, _END]),
+        (_COLON, [_LENGTH]),
+        (_LENGTH, [_CLOSE, _COMMA, _END])]:
+    _FOLLOWS[_before, _afters] = True
+
+def _arraysFromTokens(tokens):
+    """Names, parent indices and lengths in preorder from the Newick
+    tokens of one tree, found with numpy rather than a token at a time.
+    None if the tokens aren't a simple well formed tree, which is left for
+    the parser to report on."""
+    if tokens and tokens[-1] == ';':
+        tokens = tokens[:-1]
+    if not tokens or ';' in tokens:
+        return None
+    tokens = numpy.array(tokens + [None, None], object)
+    kind = numpy.empty([len(tokens)], int)
+    kind[:] = _NAME
+    for (token, token_kind) in [('(', _OPEN), (')', _CLOSE),
+            (',', _COMMA), (':', _COLON)]:
+        kind[tokens == token] = token_kind
+    kind[-2:] = _END
+    kind[1:][(kind[:-1] == _COLON) & (kind[1:] == _NAME)] = _LENGTH
+    if not _FOLLOWS[kind[:-2], kind[1:-1]].all() or kind[0] != _OPEN:
+        return None
+    # and the parentheses must enclose everything else, just once
+    is_open = kind == _OPEN
+    closes = numpy.flatnonzero(kind == _CLOSE)
+    if not len(closes):
+        return None
+    steps = is_open.astype(int) - (kind == _CLOSE)
+    depth_after = numpy.cumsum(steps)
+    root_close = closes[-1]
+    if (depth_after[:root_close] <= 0).any() or depth_after[root_close] or \
+            (kind[root_close:] == _COMMA).any():
+        return None
+    depth = depth_after - steps
+
+    # Nodes start at an open parenthesis or a tip which follows one or a
+    # comma, so their starting tokens are in preorder.
+    after_open = numpy.zeros([len(tokens)], bool)
+    after_open[1:] = (kind[:-1] == _OPEN) | (kind[:-1] == _COMMA)
+    starts = numpy.flatnonzero(is_open | (after_open & (kind != _OPEN)))
+    n = len(starts)
+    node_depth = depth[starts]
+    # a node's parent is the last node before it which is one level up
+    keys = node_depth * n + numpy.arange(n)
+    order = numpy.argsort(keys, kind='mergesort')
+    before = numpy.searchsorted(keys[order], keys - n) - 1
+    parent = order[before]
+    parent[0] = -1
+
+    # At each level the parentheses alternate open, close, open ...
+    opens = numpy.flatnonzero(is_open)
+    close_of = numpy.empty([len(tokens)], int)
+    close_of[opens[numpy.argsort(depth[opens], kind='mergesort')]] = \
+            closes[numpy.argsort(depth_after[closes], kind='mergesort')]
+    # a node's name and length follow its closing parenthesis, if any
+    label = numpy.where(is_open[starts], close_of[starts] + 1, starts)
+    named = kind[label] == _NAME
+    names = numpy.where(named, tokens[label], None)
+    colon = label + named
+    has_length = kind[colon] == _COLON
+    lengths = numpy.empty([n], float)
+    lengths[:] = numpy.nan
+    try:
+        lengths[has_length] = numpy.array(
+                tokens[colon[has_length] + 1].tolist(), float)
+    except ValueError:
+        return None
+
+    # names are made unique in postorder, as the parser makes the nodes
+    unique_name = UniqueNames()
+    postorder = numpy.argsort(label * 2 - is_open[starts], kind='mergesort')
+    unique_names = [None] * n
+    for u in postorder.tolist():
+        unique_names[u] = unique_name(names[u])
+    if names[0] is None:
+        unique_names[0] = 'root'
+    return (unique_names, parent, lengths)
+
+def _arraysFromParser(treestring, underscore_unmunge):
+    """Names, parent indices and lengths in preorder via the Newick parser
+    """
+    # Nodes are made in postorder, where each subtree is the range of
+    # nodes from first[u] to u.
+    unique_name = UniqueNames()
+    names = []
+    lengths = []
+    parent = []
+    first = []
+    last_name = [None]
+    def constructor(children, name, attributes):
+        u = len(names)
+        last_name[0] = name
+        names.append(unique_name(name))
+        lengths.append(attributes.get('length', None))
+        parent.append(-1)
+        if children:
+            for child in children:
+                parent[child] = u
+            first.append(first[children[0]])
+        else:
+            first.append(u)
+        return u
+    parse_string(treestring, constructor,
+            underscore_unmunge=underscore_unmunge)
+    n = len(names)
+    first = numpy.array(first, int)
+    # a node's depth counts the subtree ranges it is in
+    changes = numpy.zeros([n+1], int)
+    numpy.add.at(changes, first, 1)
+    changes[1:] -= 1
+    depth = numpy.cumsum(changes[:-1]) - 1
+    # and before it in preorder are its ancestors and earlier subtrees
+    preorder = numpy.empty([n], int)
+    preorder[depth + first] = numpy.arange(n)
+    new_index = numpy.empty([n+1], int)
+    new_index[preorder] = numpy.arange(n)
+    new_index[-1] = -1
+    parent = new_index[numpy.array(parent, int)[preorder]]
+    lengths = numpy.array(lengths, float)[preorder]
+    names = [names[u] for u in preorder]
+    if last_name[0] is None:
+        names[0] = 'root'
+    return (names, parent, lengths)
+
+
+class ArrayTree(object):
+    """A tree as arrays, with nodes numbered in preorder (root = 0):
+        Names: the node names.
+        parent: index of each node's parent, -1 for the root.
+        lengths: branch length of each node, nan where there was none.
+        child_offsets: the children of node u are
+            children[child_offsets[u]:child_offsets[u+1]].
+        end: the subtree of node u is nodes u:end[u].
+        postorder: node indices in postorder.
+        tips: indices of the tips, in (preorder or postorder) order.
+
+    Only names and lengths are kept from the original tree.  Use getTree()
+    to get a PhyloNode tree back."""
+
+    def __init__(self, tree):
+        names = []
+        parent = []
+        lengths = []
+        index_of = {}
+        for node in tree.preorder():
+            index_of[id(node)] = len(names)
+            names.append(node.Name)
+            if node is tree:
+                parent.append(-1)
+            else:
+                parent.append(index_of[id(node.Parent)])
+            length = getattr(node, 'Length', None)
+            lengths.append(numpy.nan if length is None else length)
+        self._setArrays(names, parent, lengths)
+
+    @classmethod
+    def fromArrays(cls, names, parent, lengths):
+        """An ArrayTree from parent indices which are already in preorder"""
+        new = cls.__new__(cls)
+        new._setArrays(names, parent, lengths)
+        return new
+
+    @classmethod
+    def fromNewick(cls, treestring, underscore_unmunge=False):
+        """An ArrayTree from a Newick string, with the same node names as
+        LoadTree(treestring=treestring) but without making a TreeNode for
+        every node on the way."""
+        arrays = None
+        if not _quotes_or_comments(treestring):
+            tokens = list(_BulkTokeniser(treestring,
+                    underscore_unmunge=underscore_unmunge).tokens())
+            arrays = _arraysFromTokens(tokens[:-1])
+        if arrays is None:
+            # quoted labels, comments or errors
+            arrays = _arraysFromParser(treestring, underscore_unmunge)
+        return cls.fromArrays(*arrays)
+
+    def _setArrays(self, names, parent, lengths):
+        self.Names = tuple(names)
+        n = len(self.Names)
+        parent = numpy.asarray(parent, int)
+        assert parent.shape == (n,) and parent[0] == -1
+        assert (parent[1:] >= 0).all() and \
+                (parent[1:] < numpy.arange(1, n)).all(), 'not in preorder'
+        self.parent = _frozen(parent)
+        self.lengths = _frozen(numpy.array(lengths, float))
+
+        # Each node's subtree ends at the first later node which hangs off
+        # an earlier node.
+        end = [n] * n
+        stack = []
+        for (u, p) in enumerate(parent.tolist()):
+            while stack and stack[-1] > p:
+                end[stack.pop()] = u
+            stack.append(u)
+        self.end = _frozen(numpy.array(end, int))
+
+        # preorder is already grouped by parent, just needs stable sorting
+        self.children = _frozen(
+                numpy.argsort(parent[1:], kind='mergesort') + 1)
+        counts = numpy.bincount(parent[1:], minlength=n)
+        offsets = numpy.zeros([n+1], int)
+        numpy.cumsum(counts, out=offsets[1:])
+        self.child_offsets = _frozen(offsets)
+        self.tips = _frozen(numpy.flatnonzero(counts == 0))
+
+        # each node after its subtree, and after any ancestors ending there
+        self.postorder = _frozen(numpy.lexsort((-numpy.arange(n), self.end)))
+
+        self._index = None
+
+    def __len__(self):
+        return len(self.Names)
+
+    def getNodeIndex(self, name):
+        """Index of the (first) node with this name"""
+        if self._index is None:
+            self._index = {}
+            for (i, node_name) in enumerate(self.Names):
+                self._index.setdefault(node_name, i)
+        return self._index[name]
+
+    def _getIndices(self, names, ignore_missing=False):
+        indices = []
+        for name in names:
+            try:
+                indices.append(self.getNodeIndex(name))
+            except KeyError:
+                if not ignore_missing:
+                    raise ValueError("edge %s not found in tree" % name)
+        return numpy.array(indices, int)
+
+    def getTipNames(self):
+        return [self.Names[i] for i in self.tips]
+
+    def getChildren(self, u):
+        """Indices of the children of node u"""
+        return self.children[self.child_offsets[u]:self.child_offsets[u+1]]
+
+    def getRootDistances(self, default_length=1):
+        """Distance from the root to each node, counting missing lengths as
+        default_length."""
+        lengths = numpy.where(numpy.isnan(self.lengths), default_length,
+                self.lengths)
+        lengths[0] = 0.0
+        # every node's length applies to all of its subtree
+        changes = numpy.zeros([len(self)+1], float)
+        changes[:-1] = lengths
+        numpy.add.at(changes, self.end, -lengths)
+        return numpy.cumsum(changes[:-1])
+
+    def _sharedAncestors(self, tips):
+        """For tips in preorder, the lowest common ancestor of each
+        consecutive pair"""
+        # In preorder the node after tip t is a child of the LCA of t and
+        # the next tip, and of the whole range of tips in between, the LCA
+        # of the ends is the ancestor of the others so has the lowest index.
+        all_tips = self.tips
+        consecutive = self.parent[all_tips[:-1] + 1]
+        positions = numpy.searchsorted(all_tips, tips)
+        if len(positions) < 2:
+            return numpy.zeros([0], int)
+        return numpy.minimum.reduceat(consecutive[:positions[-1]],
+                positions[:-1])
+
+    def lowestCommonAncestor(self, names):
+        """Index of the lowest common ancestor of the named nodes"""
+        nodes = self._getIndices(names, ignore_missing=True)
+        if len(nodes) == 0:
+            return None
+        first = nodes.min()
+        last = self.end[nodes].max()
+        # the deepest, so highest numbered, node containing that whole range
+        candidates = numpy.flatnonzero(self.end[:first+1] >= last)
+        return int(candidates[-1])
+
+    lca = lowestCommonAncestor
+
+    def tipToTipDistances(self, endpoints=None, default_length=1):
+        """Returns distance matrix between all pairs of tips (or those named
+        in endpoints) and the list of their names, in the same order."""
+        if endpoints is None:
+            tips = self.tips
+        else:
+            tips = self._getIndices(endpoints)
+            if len(set(tips.tolist())) < len(tips):
+                raise ValueError("duplicate endpoints")
+            if (self.end[tips] != tips + 1).any():
+                raise ValueError("endpoints must be tips")
+        order = numpy.argsort(tips)
+        sorted_tips = tips[order]
+        depth = self.getRootDistances(default_length)
+        tip_depth = depth[sorted_tips]
+        shared = self._sharedAncestors(sorted_tips)
+        num_tips = len(tips)
+        sorted_result = numpy.zeros([num_tips, num_tips], float)
+        for i in range(num_tips-1):
+            ancestors = numpy.minimum.accumulate(shared[i:])
+            sorted_result[i, i+1:] = tip_depth[i] + tip_depth[i+1:] - \
+                    2 * depth[ancestors]
+        sorted_result += sorted_result.T
+        unsort = numpy.empty_like(order)
+        unsort[order] = numpy.arange(num_tips)
+        result = sorted_result[unsort][:, unsort]
+        return result, [self.Names[i] for i in tips]
+
+    def descendantArray(self, tip_list=None):
+        """Returns numpy array with internal nodes in rows and tips in
+        columns, 1 where the tip is a descendant of the node, and the
+        indices of the internal nodes in the same order as the rows.
+
+        tip_list is a list of the names of the tips that will be considered,
+        in the order they will appear as columns in the final array.  By
+        default all tips in name order."""
+        if not tip_list:
+            tip_list = sorted(self.getTipNames())
+        tips = self._getIndices(tip_list)
+        internal = numpy.flatnonzero(self.end - numpy.arange(len(self)) > 1)
+        result = (internal[:, None] <= tips[None, :]) & \
+                (tips[None, :] < self.end[internal][:, None])
+        return result.astype(int), internal
+
+    def getSubTree(self, name_list, ignore_missing=False, keep_root=False):
+        """A new ArrayTree of the named nodes, as TreeNode.getSubTree, with
+        whole subtrees of named internal nodes kept, and other nodes left
+        with only one child merged into it.  Lengths add, or are nan if
+        either is nan. The tree is never unrooted.
+
+        keep_root: if True, the root stays even with only one child."""
+        n = len(self)
+        named = self._getIndices(name_list, ignore_missing)
+        if len(named) == 0:
+            raise TreeError, "no tree created in make sub tree"
+
+        # nodes inside a named subtree, and ancestors of those
+        changes = numpy.zeros([n+1], int)
+        numpy.add.at(changes, named, 1)
+        numpy.add.at(changes, self.end[named], -1)
+        inside = numpy.cumsum(changes[:-1]) > 0
+        is_named = numpy.zeros([n+1], int)
+        is_named[named+1] = 1
+        named_before = numpy.cumsum(is_named)
+        kept = inside | (named_before[self.end] > named_before[:n])
+
+        kept_children = numpy.bincount(self.parent[1:][kept[1:]],
+                minlength=n)
+        merged = kept & ~inside & (kept_children == 1)
+        if keep_root:
+            merged[0] = False
+
+        # For each chain of merged nodes, find where it ends and its total
+        # length, by pointer jumping.
+        up = self.parent.copy()
+        extra = self.lengths.copy()
+        jumping = merged.copy()
+        while True:
+            jumping[jumping] = (up[jumping] >= 0) & merged[up[jumping]]
+            if not jumping.any():
+                break
+            steps = numpy.flatnonzero(jumping)
+            (next_up, next_extra) = (up[up[steps]], extra[up[steps]])
+            extra[steps] += next_extra
+            up[steps] = next_up
+
+        survivors = numpy.flatnonzero(kept & ~merged)
+        new_index = numpy.cumsum(kept & ~merged) - 1
+        parent = self.parent[survivors]
+        lengths = self.lengths[survivors].copy()
+        via_merged = (parent >= 0) & merged[numpy.maximum(parent, 0)]
+        lengths[via_merged] += extra[parent[via_merged]]
+        parent[via_merged] = up[parent[via_merged]]
+        has_parent = parent >= 0
+        parent[has_parent] = new_index[parent[has_parent]]
+        if len(survivors) == 1:
+            raise TreeError, "only a tip was returned from selecting sub tree"
+        names = [self.Names[i] for i in survivors]
+        return type(self).fromArrays(names, parent, lengths)
+
+    def getTree(self, constructor=PhyloNode):
+        """The equivalent tree of TreeNode objects"""
+        nodes = []
+        for (name, p, length) in zip(self.Names, self.parent.tolist(),
+                self.lengths.tolist()):
+            if length != length:
+                length = None
+            node = constructor(Name=name, Length=length)
+            if p >= 0:
+                node._parent = nodes[p]
+                nodes[p].Children.append(node)
+            nodes.append(node)
+        return nodes[0]
@@ -54,6 +54,19 @@ def distance_from_r(m1, m2):
     """Estimates distance as (1-r)/2: neg correl = max distance"""
     return (1-correlation(m1.flat, m2.flat)[0])/2
 
+_newick_special = re.compile("""[]['"(),:;_]""").search
+
+def _write_pieces(outfile, pieces, chunk_size=2**12):
+    """Writes strings from the iterable pieces to outfile, chunk_size at a
+    time so that neither many small writes nor one huge string are needed"""
+    chunk = []
+    for piece in pieces:
+        chunk.append(piece)
+        if len(chunk) >= chunk_size:
+            outfile.write(''.join(chunk))
+            chunk = []
+    outfile.write(''.join(chunk))
+
 class TreeError(Exception):
     pass
 
@@ -822,6 +835,41 @@ class TreeNode(object):
         
         return ''.join(newick)
 
+    def _newickPieces(self, with_distances, escape_name):
+        """Yields the newick string for this tree, without a semicolon, as
+        strings of at most one node each.  Iterative so tree depth is not
+        limited by the recursion limit."""
+        with_distances = with_distances and isinstance(self, PhyloNode)
+        nodes_stack = [[self, 0]]
+        while nodes_stack:
+            top = nodes_stack[-1]
+            (node, visited) = top
+            children = node.Children
+            if visited < len(children):
+                #pre-visit the next child
+                top[1] += 1
+                nodes_stack.append([children[visited], 0])
+                yield ',' if visited else '('
+                continue
+            nodes_stack.pop()
+            #post-visit
+            if node.NameLoaded and node.Name is not None:
+                name = str(node.Name)
+                if escape_name and not (name.startswith("'") and \
+                                        name.endswith("'")):
+                    if _newick_special(name):
+                        name = "'%s'" % name.replace("'", "''")
+                    else:
+                        name = name.replace(' ','_')
+            else:
+                name = ''
+            if with_distances and node.Length is not None:
+                name = "%s:%s" % (name, node.Length)
+            if children:
+                name = ')' + name
+            if name:
+                yield name
+
     def getNewick(self, with_distances=False, semicolon=True, escape_name=True):
         """Return the newick string for this tree.
 
@@ -835,65 +883,20 @@ class TreeNode(object):
         and its descendents. This method is a modification of an implementation
         by Zongzhi Liu
         """
-        result = ['(']
-        nodes_stack = [[self, len(self.Children)]]
-        node_count = 1
-
-        while nodes_stack:
-            node_count += 1
-            #check the top node, any children left unvisited?
-            top = nodes_stack[-1]
-            top_node, num_unvisited_children = top
-            if num_unvisited_children: #has any child unvisited
-                top[1] -= 1  #decrease the #of children unvisited
-                next_child = top_node.Children[-num_unvisited_children] # - for order
-                #pre-visit
-                if next_child.Children:
-                    result.append('(')
-                nodes_stack.append([next_child, len(next_child.Children)])
-            else:  #no unvisited children
-                nodes_stack.pop()
-                #post-visit
-                if top_node.Children:
-                    result[-1] = ')'
-
-                if top_node.NameLoaded:
-                    if top_node.Name is None:
-                        name = ''
-                    else:
-                        name = str(top_node.Name)
-                        if escape_name and not (name.startswith("'") and \
-                                                name.endswith("'")):
-                            if re.search("""[]['"(),:;_]""", name):
-                                name = "'%s'" % name.replace("'", "''")
-                            else:
-                                name = name.replace(' ','_')
-                    result.append(name)
-                
-                if isinstance(self, PhyloNode):
-                    if with_distances and top_node.Length is not None:
-                        #result.append(":%s" % top_node.Length)
-                        result[-1] = "%s:%s" % (result[-1], top_node.Length)
-
-                result.append(',')
+        result = ''.join(self._newickPieces(with_distances, escape_name))
+        if semicolon:
+            result += ';'
+        return result
 
-        len_result = len(result)
-        if len_result == 2:  # single node no name
-            if semicolon:
-                return ";"
-            else:
-                return ''
-        elif len_result == 3: # single node with name
-            if semicolon:
-                return "%s;" % result[1]
-            else:
-                return result[1]
-        else:
-            if semicolon:
-                result[-1] = ';'
-            else:
-                result.pop(-1)
-            return ''.join(result)
+    def writeNewick(self, outfile, with_distances=False, semicolon=True,
+            escape_name=True):
+        """Writes the newick string for this tree to the open file outfile,
+        as getNewick() but a piece at a time, without building the whole
+        string in memory.
+        """
+        _write_pieces(outfile, self._newickPieces(with_distances, escape_name))
+        if semicolon:
+            outfile.write(';')
     
     def removeNode(self, target):
         """Removes node by identity instead of value.
@@ -1271,30 +1274,48 @@ class TreeNode(object):
         return '\n'.join(lines)
     
     def _getXmlLines(self, indent=0, parent_params=None):
-        """Return the xml strings for this edge.
+        """Yields the xml strings for this edge, each parameter only given
+        where it changes.  Iterative so tree depth is not limited by the
+        recursion limit.
         """
-        params = {}
-        if parent_params is not None:
-            params.update(parent_params)
-        pad = '  ' * indent
-        xml = ["%s<clade>" % pad]
-        if self.NameLoaded:
-            xml.append("%s   <name>%s</name>" % (pad, self.Name))
-        for (n,v) in self.params.items():
-            if v == params.get(n, None):
+        # None marks where a clade closes
+        nodes_stack = [(self, indent, parent_params)]
+        while nodes_stack:
+            (node, indent, parent_params) = nodes_stack.pop()
+            pad = '  ' * indent
+            if node is None:
+                yield pad + "</clade>"
                 continue
-            xml.append("%s   <param><name>%s</name><value>%s</value></param>"
-                    % (pad, n, v))
-            params[n] = v
-        for child in self.Children:
-            xml.extend(child._getXmlLines(indent + 1, params))
-        xml.append(pad + "</clade>")
-        return xml
+            params = {}
+            if parent_params is not None:
+                params.update(parent_params)
+            yield "%s<clade>" % pad
+            if node.NameLoaded:
+                yield "%s   <name>%s</name>" % (pad, node.Name)
+            for (n,v) in node.params.items():
+                if v == params.get(n, None):
+                    continue
+                yield "%s   <param><name>%s</name><value>%s</value></param>" \
+                        % (pad, n, v)
+                params[n] = v
+            nodes_stack.append((None, indent, None))
+            for child in reversed(node.Children):
+                nodes_stack.append((child, indent + 1, params))
+    
+    def _xmlPieces(self):
+        yield '<?xml version="1.0"?>'  # <!DOCTYPE ...
+        for line in self._getXmlLines():
+            yield '\n'
+            yield line
     
     def getXML(self):
         """Return XML formatted tree string."""
-        header = ['<?xml version="1.0"?>']  # <!DOCTYPE ...
-        return '\n'.join(header + self._getXmlLines())
+        return ''.join(self._xmlPieces())
+    
+    def writeXML(self, outfile):
+        """Writes the XML formatted tree to the open file outfile, a piece
+        at a time, without building the whole string in memory."""
+        _write_pieces(outfile, self._xmlPieces())
     
     def writeToFile(self, filename, with_distances=True, format=None):
         """Save the tree to filename
@@ -1310,13 +1331,14 @@ class TreeNode(object):
         else:
             xml = filename.lower().endswith('xml')
         
-        if xml:
-            data = self.getXML()
-        else:
-            data = self.getNewick(with_distances=with_distances)
         outf = open(filename, "w")
-        outf.writelines(data)
-        outf.close()
+        try:
+            if xml:
+                self.writeXML(outf)
+            else:
+                self.writeNewick(outf, with_distances=with_distances)
+        finally:
+            outf.close()
 
     def getNodeNames(self, includeself=True, tipsonly=False):
         """Return a list of edges from this edge - may or may not include self.
@@ -2111,28 +2133,34 @@ class PhyloNode(TreeNode):
 
         return dist_f(self_matrix, other_matrix)
 
-class TreeBuilder(object):
-    # Some tree code which isn't needed once the tree is finished.
-    # Mostly exists to give edges unique names
-    # Children must be created before their parents.
+class UniqueNames(object):
+    """Callable which makes node names unique in the order they are given,
+    as TreeBuilder does.  Unnamed nodes become edge.0, edge.1 edge.2 ...
+    and other duplicates go mouse mouse.2 mouse.3 ..."""
     
-    def __init__(self, mutable=False, constructor=PhyloNode):
+    def __init__(self):
         self._used_names = {'edge':-1}
-        self._known_edges = {}
-        self.TreeNodeClass = constructor
     
-    def _unique_name(self, name):
-        # Unnamed edges become edge.0, edge.1 edge.2 ...
-        # Other duplicates go mouse mouse.2 mouse.3 ...
+    def __call__(self, name):
         if not name:
             name = 'edge'
         if name in self._used_names:
             self._used_names[name] += 1
             name += '.' + str(self._used_names[name])
-            name = self._unique_name(name) # in case of names like 'edge.1.1'
+            name = self(name) # in case of names like 'edge.1.1'
         else:
             self._used_names[name] = 1
         return name
+
+class TreeBuilder(object):
+    # Some tree code which isn't needed once the tree is finished.
+    # Mostly exists to give edges unique names
+    # Children must be created before their parents.
+    
+    def __init__(self, mutable=False, constructor=PhyloNode):
+        self._unique_name = UniqueNames()
+        self._known_edges = {}
+        self.TreeNodeClass = constructor
     
     def _params_for_edge(self, edge):
         # default is just to keep it
@@ -2151,14 +2179,23 @@ class TreeBuilder(object):
     
     def createEdge(self, children, name, params, nameLoaded=True):
         """Callback for newick parser"""
-        if children is None:
-            children = []
         node = self.TreeNodeClass(
-                Children = list(children),
                 Name = self._unique_name(name),
                 NameLoaded = nameLoaded and (name is not None),
                 Params = params,
                 )
+        if children:
+            children = list(children)
+            for child in children:
+                if not isinstance(child, self.TreeNodeClass) or \
+                        child._parent is not None:
+                    node.extend(children)
+                    break
+            else:
+                # parentless edges, as from a parser, can be simply adopted
+                for child in children:
+                    child._parent = node
+                node.Children = children
         self._known_edges[id(node)] = node
         return node
     
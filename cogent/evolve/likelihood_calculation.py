@@ -64,6 +64,44 @@ class PartialLikelihoodProductDefnFixedMotif(PartialLikelihoodProductDefn):
         return result
     
 
+class BinnedPartialLikelihoodProductDefn(_PartialLikelihoodDefn):
+    """Partial likelihoods for every bin at once, as one contiguous
+    [bin, column, motif] array, so that each edge is a single calculation
+    rather than one per bin"""
+    name = "plh"
+    recycling = True
+    
+    def calc(self, recycled_result, fixed_motif, lh_edge, *child_likelihoods):
+        if recycled_result is None:
+            bins = child_likelihoods[0].shape[0]
+            recycled_result = lh_edge.makeBinnedPartialLikelihoodsArray(bins)
+        result = lh_edge.sumBinnedInputLikelihoodsR(
+                recycled_result, *child_likelihoods)
+        if fixed_motif not in [None, -1]:
+            for motif in range(result.shape[-1]):
+                if motif != fixed_motif:
+                    result[..., motif] = 0.0
+        return result
+    
+
+def stack_bins(*values):
+    """One array with a leading bin axis from per-bin arrays"""
+    return numpy.array(values)
+
+def binned_inner(likelihoods, psubs):
+    """numpy.inner(likelihoods[b], psubs[b]) for every bin b in one matrix
+    product.  2D (ie: leaf) likelihoods are shared by all the bins."""
+    return numpy.matmul(likelihoods, numpy.swapaxes(psubs, -1, -2))
+
+def binned_root_likelihoods(likelihoods, mprobs):
+    """[bin, column] likelihoods from [bin, column, motif] partials"""
+    return numpy.matmul(likelihoods, mprobs[:, :, numpy.newaxis])[..., 0]
+
+def call_with_bins(func, lhs):
+    """func(lh of bin 1, lh of bin 2, ...), as for the unbatched bins,
+    from the [bin, column] array lhs"""
+    return func(*lhs)
+
 class LhtEdgeLookupDefn(CalculationDefn):
     name = 'col_index'
     
@@ -101,6 +139,30 @@ def makePartialLikelihoodDefns(edge, lht, psubs, fixed_motifs):
     
     return plh
 
+def makeBinnedPartialLikelihoodDefns(edge, lht, psubs, fixed_motifs,
+        bin_names):
+    kw = {'edge_name':edge.Name}
+    
+    if edge.istip():
+        plh = LeafPartialLikelihoodDefn(lht, **kw)
+    else:
+        lht_edge = LhtEdgeLookupDefn(lht, **kw)
+        children = []
+        for child in edge.Children:
+            child_plh = makeBinnedPartialLikelihoodDefns(child, lht, psubs,
+                    fixed_motifs, bin_names)
+            psub = psubs.selectFromDimension('edge', child.Name)
+            psub = CalcDefn(stack_bins, name='bpsubs')(
+                    *psub.acrossDimension('bin', bin_names))
+            child_plh = CalcDefn(binned_inner)(child_plh, psub)
+            children.append(child_plh)
+        
+        fixed_motif = fixed_motifs.selectFromDimension('edge', edge.Name)
+        plh = BinnedPartialLikelihoodProductDefn(
+                fixed_motif, lht_edge, *children, **kw)
+    
+    return plh
+
 def recursive_lht_build(edge, leaves):
     if edge.istip():
         lhe = leaves[edge.Name]
@@ -128,7 +190,12 @@ class LikelihoodTreeAlignmentSplitterDefn(CalculationDefn):
     
 
 def makeTotalLogLikelihoodDefn(tree, leaves, psubs, mprobs, bprobs, bin_names,
-        locus_names, sites_independent):
+        locus_names, sites_independent, batch_bins=False):
+    """The total log likelihood.  With batch_bins and more than one bin
+    the partial likelihoods for all the bins are held in a single
+    [bin, column, motif] array per edge rather than one array per edge
+    per bin."""
+    batch_bins = batch_bins and len(bin_names) > 1
     
     fixed_motifs = NonParamDefn('fixed_motif', ['edge'])
     
@@ -138,7 +205,11 @@ def makeTotalLogLikelihoodDefn(tree, leaves, psubs, mprobs, bprobs, bin_names,
     parallel_context = NonParamDefn('parallel_context')
     lht = LikelihoodTreeAlignmentSplitterDefn(parallel_context, lht)
     
-    plh = makePartialLikelihoodDefns(tree, lht, psubs, fixed_motifs)
+    if batch_bins:
+        plh = makeBinnedPartialLikelihoodDefns(tree, lht, psubs, fixed_motifs,
+                bin_names)
+    else:
+        plh = makePartialLikelihoodDefns(tree, lht, psubs, fixed_motifs)
     
     # After the root partial likelihoods have been calculated it remains to
     # sum over the motifs, local sites, other sites (ie: cpus), bins and loci.
@@ -148,7 +219,12 @@ def makeTotalLogLikelihoodDefn(tree, leaves, psubs, mprobs, bprobs, bin_names,
     # minimise inter-CPU communicaton.
     
     root_mprobs = mprobs.selectFromDimension('edge', 'root')
-    lh = CalcDefn(numpy.inner, name='lh')(plh, root_mprobs)
+    if batch_bins:
+        root_mprobs = CalcDefn(stack_bins, name='bmprobs')(
+                *root_mprobs.acrossDimension('bin', bin_names))
+        lh = CalcDefn(binned_root_likelihoods, name='lh')(plh, root_mprobs)
+    else:
+        lh = CalcDefn(numpy.inner, name='lh')(plh, root_mprobs)
     if len(bin_names) > 1:
         if sites_independent:
             site_pattern = CalcDefn(BinnedSiteDistribution, name='bdist')(
@@ -159,8 +235,11 @@ def makeTotalLogLikelihoodDefn(tree, leaves, psubs, mprobs, bprobs, bin_names,
             site_pattern = CalcDefn(PatchSiteDistribution, name='bdist')(
                     switch, bprobs)
         blh = CallDefn(site_pattern, lht, name='bindex')
-        tll = CallDefn(blh, *lh.acrossDimension('bin', bin_names),
-                **dict(name='tll'))
+        if batch_bins:
+            tll = CalcDefn(call_with_bins, name='tll')(blh, lh)
+        else:
+            tll = CallDefn(blh, *lh.acrossDimension('bin', bin_names),
+                    **dict(name='tll'))
     else:
         lh = lh.selectFromDimension('bin', bin_names[0])
         tll = CalcDefn(log_sum_across_sites, name='logsum')(lht, lh)
@@ -177,6 +256,69 @@ def makeTotalLogLikelihoodDefn(tree, leaves, psubs, mprobs, bprobs, bin_names,
     
     return tll
 
+def _edges_with_root_columns(edge, columns):
+    # [(lht edge, its column for each root column)] in post order
+    result = []
+    for (index, child) in getattr(edge, '_indexed_children', []):
+        result.extend(_edges_with_root_columns(child, index[columns]))
+    result.append((edge, columns))
+    return result
+
+def length_gradients(root, psubs, dpsubs, mprobs, bprobs):
+    """d lnL / d length for every edge below the likelihood tree 'root',
+    found with one pass down and one pass up the tree per bin.
+    
+    psubs and dpsubs are, for each bin, dicts of {edge_name:matrix} holding
+    P(t) and dP/dlength.  mprobs is the root motif probs for each bin and
+    bprobs the bin probabilities.  Sites are assumed independent."""
+    
+    order = _edges_with_root_columns(root,
+            numpy.arange(len(root.counts)))
+    columns = dict((edge.edge_name, cols) for (edge, cols) in order)
+    total_lh = 0.0
+    gradients = {}
+    for (psub, dpsub, mprob, bprob) in zip(psubs, dpsubs, mprobs, bprobs):
+        # Down: partial likelihoods, each in its own edge's unique columns
+        down = {}
+        for (edge, cols) in order:
+            if hasattr(edge, 'input_likelihoods'):
+                down[edge.edge_name] = edge.input_likelihoods
+            else:
+                down[edge.edge_name] = edge.sumInputLikelihoods(*[
+                        numpy.inner(down[child.edge_name], psub[child.edge_name])
+                        for (index, child) in edge._indexed_children])
+        total_lh = total_lh + bprob * numpy.inner(
+                down[root.edge_name], mprob)
+        
+        # Up: likelihoods of everything outside each edge, in root columns
+        up = {root.edge_name: mprob[numpy.newaxis, :]}
+        for (edge, cols) in order[::-1]:
+            if not hasattr(edge, '_indexed_children'):
+                continue
+            outer = up.pop(edge.edge_name)
+            children = [child for (index, child) in edge._indexed_children]
+            towards = [numpy.inner(down[child.edge_name],
+                    psub[child.edge_name])[columns[child.edge_name]]
+                    for child in children]
+            for (i, child) in enumerate(children):
+                name = child.edge_name
+                outside = outer
+                for (j, toward) in enumerate(towards):
+                    if j != i:
+                        outside = outside * toward
+                d = numpy.inner(down[name], dpsub[name])[columns[name]]
+                gradient = bprob * numpy.sum(outside * d, axis=-1)
+                if name in gradients:
+                    gradients[name] += gradient
+                else:
+                    gradients[name] = gradient
+                if hasattr(child, '_indexed_children'):
+                    up[name] = numpy.dot(outside, psub[name])
+    
+    weights = root.counts / total_lh
+    return dict((name, numpy.inner(weights, gradient))
+            for (name, gradient) in gradients.items())
+
 def log_sum_across_sites(root, root_lh):
     return root.getLogSumAcrossSites(root_lh)
 
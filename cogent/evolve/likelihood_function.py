@@ -5,8 +5,10 @@ import random, numpy
 from cogent.core.alignment import Alignment
 from cogent.util.dict_array import DictArrayTemplate
 from cogent.evolve.simulate import AlignmentEvolver, randomSequence
+from cogent.evolve.likelihood_calculation import length_gradients
 from cogent.util import parallel, table
 from cogent.recalculation.definition import ParameterController
+from cogent.recalculation.calculation import ShardedCalculator
 from cogent.maths.matrix_logarithm import is_generator_unique
 
 __author__ = "Peter Maxwell"
@@ -52,10 +54,17 @@ class LikelihoodFunction(ParameterController):
                 raise
         return DictArrayTemplate(self._motifs, self._motifs).wrap(array)
     
+    def _getLikelihoodValuesForEachBin(self, locus=None):
+        lh = self.getParamValue('lh', locus=locus, bin=self.bin_names[0])
+        if lh.ndim > 1:
+            # batched bins, already a single [bin, site] array
+            return list(lh)
+        return [lh] + [self.getParamValue('lh', locus=locus, bin=bin)
+                for bin in self.bin_names[1:]]
+    
     def _getLikelihoodValuesSummedAcrossAnyBins(self, locus=None):
         if self.bin_names and len(self.bin_names) > 1:
-            root_lhs = [self.getParamValue('lh', locus=locus, bin=bin) for
-                bin in self.bin_names]
+            root_lhs = self._getLikelihoodValuesForEachBin(locus=locus)
             bprobs = self.getParamValue('bprobs')
             root_lh = bprobs.dot(root_lhs)
         else:
@@ -74,6 +83,116 @@ class LikelihoodFunction(ParameterController):
         root_lht = self.getParamValue('root', locus=locus)
         return root_lht.calcGStatistic(root_lh, return_table)
     
+    def getLengthGradients(self, locus=None):
+        """returns a dict of d lnL / d length for each edge, calculated
+        analytically with one pass down and one pass up the tree.
+        
+        Arguments:
+            - locus: a named locus.  Without one the gradients are summed
+              across the loci."""
+        gradients = self._getLengthGradients(self.getParamValue)
+        result = {}
+        for ((edge, locus2), gradient) in gradients.items():
+            if locus is None or locus2 == locus:
+                result[edge] = result.get(edge, 0.0) + gradient
+        return result
+    
+    def _whyNoLengthGradients(self):
+        # Analytic length gradients need independent sites, a continuous
+        # time model with a known rate matrix, and lengths which don't
+        # vary by bin.  None if they can be had.
+        if 'bin_switch' in self.defn_for or 'dpsubs' in self.defn_for:
+            return ('length gradients need independent sites and a '
+                    'continuous time model')
+        if 'Qd' not in self.defn_for:
+            return 'rate matrix not known by this model'
+        if not set(self.defn_for['length'].valid_dimensions) <= set(
+                ['edge', 'locus']):
+            return 'lengths vary by bin'
+        return None
+    
+    def _getLengthGradients(self, value_of):
+        # value_of(par_name, **scope) supplies the current values, either
+        # from self or from a calculator during optimisation.  The
+        # gradients are keyed by (edge, locus).
+        reason = self._whyNoLengthGradients()
+        if reason is not None:
+            raise NotImplementedError(reason)
+        edges = [edge.Name for edge in self._tree.getEdgeVector()
+                if not edge.isroot()]
+        result = {}
+        for locus in self.locus_names:
+            if len(self.bin_names) > 1:
+                bprobs = value_of('bprobs', locus=locus)
+            else:
+                bprobs = [1.0]
+            (psubs, dpsubs, mprobs) = ([], [], [])
+            for bin in self.bin_names:
+                scope = dict(bin=bin, locus=locus)
+                (psub, dpsub) = ({}, {})
+                for edge in edges:
+                    length = value_of('length', edge=edge, **scope)
+                    if 'distance' in self.defn_for:
+                        rate = value_of('rate', edge=edge, **scope)
+                    else:
+                        rate = 1.0
+                    exponentiator = value_of('Qd', edge=edge, **scope)
+                    psub[edge] = value_of('psubs', edge=edge, **scope)
+                    dpsub[edge] = rate * exponentiator.derivative(
+                            length * rate)
+                psubs.append(psub)
+                dpsubs.append(dpsub)
+                mprobs.append(value_of('mprobs', edge='root', **scope))
+            root = value_of('lht', locus=locus)
+            gradients = length_gradients(root, psubs, dpsubs, mprobs, bprobs)
+            for edge in edges:
+                result[(edge, locus)] = gradients[edge]
+        return result
+    
+    def _makeGradientFunction(self, calc):
+        # Numerical derivatives for most parameters, but analytic ones
+        # for the lengths, which are usually most of them.  Those need
+        # all the columns, which a ShardedCalculator doesn't have.
+        if isinstance(calc, ShardedCalculator) or \
+                self._whyNoLengthGradients() is not None:
+            return calc.gradient
+        # Each length parameter gets the gradients of the (edge, locus)
+        # lengths it sets
+        dimensions = self.defn_for['length'].valid_dimensions
+        lengths = []
+        for (i, opt_par) in enumerate(calc.opt_pars):
+            if opt_par.name != 'length':
+                continue
+            keys = []
+            for scope_t in opt_par.scope:
+                scope = dict(zip(dimensions, scope_t))
+                if scope.get('locus', 'all') == 'all':
+                    loci = self.locus_names
+                else:
+                    loci = [scope['locus']]
+                keys.extend((scope['edge'], locus) for locus in loci)
+            lengths.append((i, keys))
+        others = [i for i in range(len(calc.opt_pars))
+                if i not in dict(lengths)]
+        
+        cells = {}
+        def value_of(par_name, **scope):
+            key = (par_name,) + tuple(sorted(scope.items()))
+            if key not in cells:
+                defn = self.defn_for[par_name]
+                posn = defn._getPosnForScope(**scope)
+                cells[key] = calc.results_by_id[id(defn)][posn]
+            return calc._getCurrentCellValue(cells[key])
+        
+        def gradient(x):
+            result = calc.gradient(x, others)
+            gradients = self._getLengthGradients(value_of)
+            for (i, keys) in lengths:
+                result[i] = sum(gradients[key] for key in keys)
+            return result
+        
+        return gradient
+    
     def reconstructAncestralSeqs(self, locus=None):
         """returns a dict of DictArray objects containing probabilities
         of each alphabet state for each node in the tree.
@@ -123,8 +242,7 @@ class LikelihoodFunction(ParameterController):
     
     def getBinProbs(self, locus=None):
         hmm = self.getParamValue('bindex', locus=locus)
-        lhs = [self.getParamValue('lh', locus=locus, bin=bin)
-                for bin in self.bin_names]
+        lhs = self._getLikelihoodValuesForEachBin(locus=locus)
         array = hmm.getPosteriorProbs(*lhs)
         return DictArrayTemplate(self.bin_names, array.shape[1]).wrap(array)
     
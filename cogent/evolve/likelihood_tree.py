@@ -7,6 +7,7 @@ from cogent.util.modules import importVersionedModule, ExpectedImportError
 from cogent.util.parallel import MPI
 from cogent import LoadTable
 
+import weakref
 import numpy
 
 numpy.seterr(all='ignore')
@@ -39,10 +40,18 @@ class _LikelihoodTreeEdge(object):
             assert child.shape[-1] == M
         
         # Unique positions are unique combos of input positions
-        if alignment is None:
+        patterns = getattr(children[0], 'patterns', None)
+        if alignment is None and patterns is not None and all(
+                getattr(c, 'patterns', None) is patterns for c in children):
+            # The children come from the same SitePatterns, so only one
+            # column of each site pattern need be looked at.
+            assignments = [c.index[patterns.first] for c in children]
+        elif alignment is None:
             # The children are pre-aligned gapped sequences
+            patterns = None
             assignments = [c.index for c in children]
         else:
+            patterns = None
             self.alignment = alignment  #XXX preserve through MPI split?
             # The children are ungapped sequences, 'alignment'
             # indicates where gaps need to go.
@@ -60,6 +69,10 @@ class _LikelihoodTreeEdge(object):
                     a.append(u)
                 assignments.append(a)
         (uniq, counts, self.index) = _indexed(zip(*assignments))
+        if patterns is not None:
+            self.patterns = patterns
+            self.index = self.index[patterns.index]
+            counts = list(numpy.bincount(self.index, minlength=len(uniq)))
         
         # extra column for gap
         uniq.append(tuple([len(c.uniq)-1 for c in children]))
@@ -104,9 +117,9 @@ class _LikelihoodTreeEdge(object):
         assert self.comm is None
         U = len(self.uniq) - 1 # Gap column
         (size, rank) = (comm.Get_size(), comm.Get_rank())
+        # With fewer columns than CPUs some get none, as whatever this
+        # is used for gets summed across the CPUs.
         (share, remainder) = divmod(U, size)
-        if share == 0:
-            return self # not enough to share
         share_sizes = [share+1]*remainder + [share]*(size-remainder)
         assert sum(share_sizes) == U
         (lo,hi) = [sum(share_sizes[:i]) for i in (rank, rank+1)]
@@ -180,6 +193,19 @@ class _LikelihoodTreeEdge(object):
         result = numpy.ones(self.shape, self.float_type)
         self.sumInputLikelihoodsR(result, *likelihoods)
         return result
+    
+    def makeBinnedPartialLikelihoodsArray(self, bins):
+        return numpy.ones([bins] + self.shape, self.float_type)
+    
+    def sumBinnedInputLikelihoodsR(self, result, *likelihoods):
+        # [bin, col, motif] version of sumInputLikelihoodsR, all the bins
+        # of each child done in one numpy.take.
+        for (i, index) in enumerate(self.indexes):
+            if i == 0:
+                numpy.take(likelihoods[i], index, axis=-2, out=result)
+            else:
+                result *= numpy.take(likelihoods[i], index, axis=-2)
+        return result
 
     def asLeaf(self, likelihoods):
         (self, likelihoods) = self.parallelReconstructColumns(likelihoods)
@@ -271,17 +297,10 @@ def _indexed(values):
         index[c] = i
     return unique, counts, index
 
-def makeLikelihoodTreeLeaf(sequence, alphabet=None, seq_name=None):    
-    if alphabet is None:
-        alphabet = sequence.MolType.Alphabet
-    if seq_name is None:
-        seq_name = sequence.getName()
-        
+def _makeLeaf(uniq_motifs, counts, index, alphabet, seq_name, sequence,
+        first_posn, patterns=None):
+    # first_posn(motif) is where to report a motif not in the alphabet
     motif_len = alphabet.getMotifLen()
-    sequence2 = sequence.getInMotifSize(motif_len)
-    
-    # Convert sequence to indexed list of unique motifs
-    (uniq_motifs, counts, index) = _indexed(sequence2)
     
     # extra column for gap
     uniq_motifs.append('?' * motif_len)
@@ -295,18 +314,118 @@ def makeLikelihoodTreeLeaf(sequence, alphabet=None, seq_name=None):
             uniq_motifs, FLOAT_TYPE)
     except alphabet.AlphabetError, detail:
         motif = str(detail)
-        posn = list(sequence2).index(motif) * motif_len
+        posn = first_posn(motif) * motif_len
         raise ValueError, '%s at %s:%s not in alphabet' % (
                 repr(motif), seq_name, posn)
     
     return LikelihoodTreeLeaf(uniq_motifs, likelihoods, 
-                counts, index, seq_name, alphabet, sequence)
+                counts, index, seq_name, alphabet, sequence, patterns)
+
+def makeLikelihoodTreeLeaf(sequence, alphabet=None, seq_name=None):    
+    if alphabet is None:
+        alphabet = sequence.MolType.Alphabet
+    if seq_name is None:
+        seq_name = sequence.getName()
+        
+    motif_len = alphabet.getMotifLen()
+    sequence2 = sequence.getInMotifSize(motif_len)
+    
+    # Convert sequence to indexed list of unique motifs
+    (uniq_motifs, counts, index) = _indexed(sequence2)
+    
+    return _makeLeaf(uniq_motifs, counts, index, alphabet, seq_name,
+            sequence, list(sequence2).index)
+
+class SitePatterns(object):
+    """The distinct columns (site patterns) of an alignment, in order of
+    first occurrence, as motifs of length motif_len.
+    
+    Leaves made from a SitePatterns share it, and LikelihoodTreeEdges of
+    such leaves find their own unique columns among the site patterns
+    rather than among all the columns.  It holds no sequence objects so
+    can be pickled, and getAlignmentSitePatterns() keeps it while the
+    alignment exists so it is calculated once for all the models and trees.
+    """
+    
+    def __init__(self, alignment, motif_len=1, recode_gaps=False):
+        self.motif_len = motif_len
+        self.recode_gaps = recode_gaps
+        self.names = list(alignment.getSeqNames())
+        motifs = [alignment.getGappedSeq(name, recode_gaps).getInMotifSize(
+                motif_len) for name in self.names]
+        codes = numpy.empty([len(motifs[0]), len(motifs)], numpy.uint32)
+        for (i, seq_motifs) in enumerate(motifs):
+            if isinstance(seq_motifs, str):
+                codes[:, i] = numpy.fromstring(seq_motifs, numpy.uint8)
+            else:
+                codes[:, i] = _indexed(seq_motifs)[2]
+        # Each row as one comparable value, for numpy.unique
+        rows = numpy.ascontiguousarray(codes).view(
+                numpy.dtype((numpy.void, codes.itemsize * codes.shape[1])))
+        (first, inverse) = numpy.unique(rows.ravel(), return_index=True,
+                return_inverse=True)[1:]
+        order = numpy.argsort(first)
+        rank = numpy.empty([len(order)], INTEGER_TYPE)
+        rank[order] = numpy.arange(len(order))
+        self.first = first[order]
+        self.index = rank[inverse]
+        self.counts = numpy.bincount(self.index,
+                minlength=len(self.first)).astype(FLOAT_TYPE)
+        self.motifs = dict((name, [seq_motifs[i] for i in self.first])
+                for (name, seq_motifs) in zip(self.names, motifs))
+    
+    def __len__(self):
+        return len(self.index)
+    
+    def makeLikelihoodTreeLeaf(self, seq_name, alphabet, sequence=None):
+        """The same leaf as makeLikelihoodTreeLeaf(sequence, alphabet,
+        seq_name) but made from the site patterns"""
+        assert alphabet.getMotifLen() == self.motif_len
+        motifs = self.motifs[seq_name]
+        (uniq_motifs, counts, index) = _indexed(motifs)
+        index = index[self.index]
+        counts = list(numpy.bincount(index, minlength=len(uniq_motifs)))
+        first_posn = lambda motif: int(self.first[motifs.index(motif)])
+        return _makeLeaf(uniq_motifs, counts, index, alphabet, seq_name,
+                sequence, first_posn, self)
+
+# SitePatterns by id(alignment), kept for as long as the alignment is but
+# not on it, so that they aren't pickled along with it.
+_SITE_PATTERNS = {}
+
+def _forgetSitePatterns(ref, key):
+    if key in _SITE_PATTERNS and _SITE_PATTERNS[key][0] is ref:
+        del _SITE_PATTERNS[key]
+
+def getAlignmentSitePatterns(alignment, motif_len=1, recode_gaps=False):
+    """The SitePatterns of alignment, calculated the first time and then
+    kept until the alignment is gone.  They are calculated again if any of
+    the alignment's sequences have been replaced since, but changes made
+    to a sequence in place aren't noticed."""
+    names = tuple(alignment.getSeqNames())
+    seqs = [alignment.NamedSeqs[name] for name in names]
+    key = id(alignment)
+    if key not in _SITE_PATTERNS or _SITE_PATTERNS[key][0]() is not alignment:
+        ref = weakref.ref(alignment,
+                lambda ref: _forgetSitePatterns(ref, key))
+        _SITE_PATTERNS[key] = (ref, {})
+    cache = _SITE_PATTERNS[key][1]
+    kind = (motif_len, recode_gaps, names)
+    if kind in cache:
+        (known_seqs, patterns) = cache[kind]
+        if all(seq is known for (seq, known) in zip(seqs, known_seqs)):
+            return patterns
+    patterns = SitePatterns(alignment, motif_len, recode_gaps)
+    cache[kind] = (seqs, patterns)
+    return patterns
 
 class LikelihoodTreeLeaf(object):
     def __init__(self, uniq, likelihoods, counts, index, edge_name, 
-            alphabet, sequence):
+            alphabet, sequence, patterns=None):
         if sequence is not None:
             self.sequence = sequence 
+        if patterns is not None:
+            self.patterns = patterns
         self.alphabet = alphabet
         self.name = self.edge_name = edge_name
         self.uniq = uniq
@@ -1,5 +1,7 @@
 from __future__ import division
-from numpy import log, zeros, float64, int32, array, sqrt, dot, diag, eye
+import numpy
+from numpy import log, zeros, float32, float64, int32, array, sqrt, dot, \
+        diag, eye, arange, nan, isnan, errstate
 from numpy.linalg import det, norm, inv, LinAlgError
 
 from cogent import DNA, RNA, LoadTable
@@ -75,152 +77,191 @@ def _fill_diversity_matrix(matrix, seq1, seq2):
         matrix[paired[i][0], paired[i][1]] += 1
     
 
-def _jc69_from_matrix(matrix):
-    """computes JC69 stats from a diversity matrix"""
-    invalid = None, None, None, None
-    total = matrix.sum()
-    diffs = total - sum(matrix[i,i] for i in range(matrix.shape[0]))
-    if total == 0:
-        return invalid
-    
-    p = diffs / total
-    if p >= 0.75: # cannot take log
-        return invalid
-    
-    factor = (1 - (4 / 3) * p)
-    
-    dist = -3.0 * log(factor) / 4
-    var = p * (1 - p) / (factor * factor * total)
-    return total, p, dist, var
+def _diversity_matrices(seqs1, seqs2, dim):
+    """diversity matrices for every pair of sequences from seqs1 and seqs2,
+    as a [len(seqs1), len(seqs2), dim, dim] array.
+    
+    Like _fill_diversity_matrix the sequences are index arrays with invalid
+    characters being negative numbers, and all the pairs are counted with
+    one matrix multiplication of the sequences as 0/1 state indicators."""
+    states = arange(dim)
+    one_hot = [(array(seqs)[..., None] == states).astype(float32)
+            for seqs in (seqs1, seqs2)]
+    (n1, length, dim) = one_hot[0].shape
+    n2 = one_hot[1].shape[0]
+    left = one_hot[0].transpose(0, 2, 1).reshape(n1 * dim, length)
+    right = one_hot[1].transpose(1, 0, 2).reshape(length, n2 * dim)
+    matrices = dot(left, right).reshape(n1, dim, n2, dim)
+    return matrices.transpose(0, 2, 1, 3).astype(float64)
 
-def _tn93_from_matrix(matrix, freqs, pur_indices, pyr_indices, pur_coords, pyr_coords, tv_coords):
-    invalid = None, None, None, None
-    
-    total = matrix.sum()
-    freqs = matrix.sum(axis=0) + matrix.sum(axis=1)
-    freqs /= (2*total)
-    
-    if total == 0:
-        return invalid
-    
-    # 
-    p = matrix.take(pur_coords + pyr_coords + tv_coords).sum() / total
-    
-    freq_purs = freqs.take(pur_indices).sum()
-    prod_purs = freqs.take(pur_indices).prod()
-    freq_pyrs = freqs.take(pyr_indices).sum()
-    prod_pyrs = freqs.take(pyr_indices).prod()
-    
-    # purine transition diffs
-    pur_ts_diffs = matrix.take(pur_coords).sum()
-    pur_ts_diffs /= total
-    # pyr transition  diffs
-    pyr_ts_diffs = matrix.take(pyr_coords).sum()
-    pyr_ts_diffs /= total
-    # transversions
-    tv_diffs = matrix.take(tv_coords).sum() / total
-    
-    coeff1 = 2 * prod_purs / freq_purs
-    coeff2 = 2 * prod_pyrs / freq_pyrs
-    coeff3 = 2 * (freq_purs * freq_pyrs - \
-            (prod_purs * freq_pyrs / freq_purs) -\
-            (prod_pyrs * freq_purs / freq_pyrs))
-    
-    
-    term1 = 1 - pur_ts_diffs / coeff1 - tv_diffs / (2*freq_purs)
-    term2 = 1 - pyr_ts_diffs / coeff2 - tv_diffs / (2*freq_pyrs)
-    term3 = 1 - tv_diffs / (2 * freq_purs * freq_pyrs)
-    
-    if term1 <= 0 or term2 <= 0 or term3 <= 0: # log will fail
-        return invalid
-    
-    dist = -coeff1 * log(term1) - coeff2 * log(term2) - coeff3 * log(term3)
-    v1 = 1 / term1
-    v2 = 1 / term2
-    v3 = 1 / term3
-    v4 = (coeff1 * v1 / (2 * freq_purs)) + \
-         (coeff2 * v2 / (2 * freq_pyrs)) + \
-         (coeff3 * v3 / (2 * freq_purs * freq_pyrs))
-    var = v1**2 * pur_ts_diffs + v2**2 * pyr_ts_diffs + v4**2 * tv_diffs - \
-          (v1 * pur_ts_diffs + v2 * pyr_ts_diffs + v4 * tv_diffs)**2
-    var /= total
-    
-    return total, p, dist, var
+def _invalid_to_none(stats):
+    """the per pair result from the stats for a stack of one matrix"""
+    return tuple([None if isnan(stat[0]) else stat[0] for stat in stats])
 
-def _logdetcommon(matrix):
-    invalid = (None,)*5
+def _with_invalid(invalid, *stats):
+    """stats arrays with nan where invalid"""
+    result = []
+    for stat in stats:
+        stat = array(stat, float64)
+        stat[invalid] = nan
+        result.append(stat)
+    return tuple(result)
 
-    total = matrix.sum()
-    diffs = total - matrix.diagonal().sum()
-    if total == 0:
-        return invalid
+def _jc69_from_matrices(matrices):
+    """computes JC69 stats from a stack of diversity matrices"""
+    total = matrices.sum(axis=-1).sum(axis=-1)
+    diffs = total - matrices.diagonal(axis1=-2, axis2=-1).sum(axis=-1)
+    with errstate(divide='ignore', invalid='ignore'):
+        p = diffs / total
+        invalid = (total == 0) | (p >= 0.75) # cannot take log
+        factor = (1 - (4 / 3) * p)
+        dist = -3.0 * log(factor) / 4
+        var = p * (1 - p) / (factor * factor * total)
+    return _with_invalid(invalid, total, p, dist, var)
 
-    p = diffs / total
+def _jc69_from_matrix(matrix):
+    """computes JC69 stats from a diversity matrix"""
+    return _invalid_to_none(_jc69_from_matrices(matrix[None]))
+
+def _tn93_from_matrices(matrices, pur_indices, pyr_indices, pur_coords,
+        pyr_coords, tv_coords):
+    """computes TN93 stats from a stack of diversity matrices"""
+    total = matrices.sum(axis=-1).sum(axis=-1)
+    flat = matrices.reshape(matrices.shape[:-2] + (-1,))
+    
+    def summed(coords):
+        return flat.take(coords, axis=-1).sum(axis=-1)
+    
+    with errstate(divide='ignore', invalid='ignore'):
+        freqs = matrices.sum(axis=-2) + matrices.sum(axis=-1)
+        freqs /= (2*total)[..., None]
+        
+        p = summed(pur_coords + pyr_coords + tv_coords) / total
+        
+        freq_purs = freqs.take(pur_indices, axis=-1).sum(axis=-1)
+        prod_purs = freqs.take(pur_indices, axis=-1).prod(axis=-1)
+        freq_pyrs = freqs.take(pyr_indices, axis=-1).sum(axis=-1)
+        prod_pyrs = freqs.take(pyr_indices, axis=-1).prod(axis=-1)
+        
+        # purine transition diffs
+        pur_ts_diffs = summed(pur_coords) / total
+        # pyr transition  diffs
+        pyr_ts_diffs = summed(pyr_coords) / total
+        # transversions
+        tv_diffs = summed(tv_coords) / total
+        
+        coeff1 = 2 * prod_purs / freq_purs
+        coeff2 = 2 * prod_pyrs / freq_pyrs
+        coeff3 = 2 * (freq_purs * freq_pyrs - \
+                (prod_purs * freq_pyrs / freq_purs) -\
+                (prod_pyrs * freq_purs / freq_pyrs))
+        
+        term1 = 1 - pur_ts_diffs / coeff1 - tv_diffs / (2*freq_purs)
+        term2 = 1 - pyr_ts_diffs / coeff2 - tv_diffs / (2*freq_pyrs)
+        term3 = 1 - tv_diffs / (2 * freq_purs * freq_pyrs)
+        
+        # log will fail
+        invalid = ~((total > 0) & (term1 > 0) & (term2 > 0) & (term3 > 0))
+        
+        dist = -coeff1 * log(term1) - coeff2 * log(term2) - coeff3 * log(term3)
+        v1 = 1 / term1
+        v2 = 1 / term2
+        v3 = 1 / term3
+        v4 = (coeff1 * v1 / (2 * freq_purs)) + \
+             (coeff2 * v2 / (2 * freq_pyrs)) + \
+             (coeff3 * v3 / (2 * freq_purs * freq_pyrs))
+        var = v1**2 * pur_ts_diffs + v2**2 * pyr_ts_diffs + v4**2 * tv_diffs - \
+              (v1 * pur_ts_diffs + v2 * pyr_ts_diffs + v4 * tv_diffs)**2
+        var /= total
+    
+    return _with_invalid(invalid, total, p, dist, var)
 
-    if diffs == 0: # seqs indentical
-        return invalid
+def _tn93_from_matrix(matrix, freqs, pur_indices, pyr_indices, pur_coords, pyr_coords, tv_coords):
+    return _invalid_to_none(_tn93_from_matrices(matrix[None], pur_indices,
+            pyr_indices, pur_coords, pyr_coords, tv_coords))
 
+def _logdetcommon(matrices):
+    """total, p, frequency, freqs, var_term and a validity mask for a stack
+    of diversity matrices.  Only the valid ones are kept in frequency, freqs
+    and var_term"""
+    total = matrices.sum(axis=-1).sum(axis=-1)
+    diffs = total - matrices.diagonal(axis1=-2, axis2=-1).sum(axis=-1)
+    with errstate(divide='ignore', invalid='ignore'):
+        p = diffs / total
+    
+    # diffs == 0 means the seqs are indentical
+    valid = (total > 0) & (diffs > 0)
+    
     # we replace the missing diagonal states with a frequency of 0.5,
     # then normalise
-    frequency = matrix.copy()
-    frequency[(frequency == 0) * eye(*matrix.shape, dtype=bool)] = 0.5
-    frequency /= frequency.sum()
-
-    if det(frequency) <= 0: #if the result is nan
-        return invalid
-
-    # the inverse matrix of frequency, every element is squared
-    M_matrix = inv(frequency)**2
-    freqs = [frequency.sum(axis=axis) for axis in (0, 1)]
-    var_term = dot(M_matrix, frequency).diagonal().sum()
-
-    return total, p, frequency, freqs, var_term
+    frequency = matrices[valid]
+    frequency[(frequency == 0) * eye(*matrices.shape[-2:], dtype=bool)] = 0.5
+    frequency /= frequency.sum(axis=-1).sum(axis=-1)[:, None, None]
     
-def _paralinear(matrix):
-    """the paralinear distance from a diversity matrix"""
+    determinant = det(frequency) if len(frequency) else zeros([0])
+    positive = determinant > 0 # otherwise the result is nan
+    valid[valid] = positive
+    frequency = frequency[positive]
+    determinant = determinant[positive]
     
-    invalid = (None,)*4
+    # the inverse matrix of frequency, every element is squared
+    if len(frequency):
+        M_matrix = inv(frequency)**2
+    else:
+        M_matrix = frequency
+    freqs = [frequency.sum(axis=axis) for axis in (-2, -1)]
+    var_term = numpy.einsum('pij,pji->p', M_matrix, frequency)
     
-    total, p, frequency, freqs, var_term = _logdetcommon(matrix)
-    if frequency is None:
-        return invalid
-   
-    r = matrix.shape[0]
-    d_xy = - log(det(frequency) / sqrt((freqs[0] * freqs[1]).prod())) / r
-    var = (var_term - (1 / sqrt(freqs[0]*freqs[1])).sum()) / (r**2 * total)
+    return total, p, frequency, determinant, freqs, var_term, valid
 
-    return total, p, d_xy, var
-    
+def _paralinear_from_matrices(matrices):
+    """the paralinear distances from a stack of diversity matrices"""
+    total, p, frequency, determinant, freqs, var_term, valid = \
+            _logdetcommon(matrices)
+    d_xy = zeros(total.shape, float64)
+    var = zeros(total.shape, float64)
+    
+    r = matrices.shape[-1]
+    d_xy[valid] = - log(
+            determinant / sqrt((freqs[0] * freqs[1]).prod(axis=-1))) / r
+    var[valid] = (var_term - (1 / sqrt(freqs[0]*freqs[1])).sum(axis=-1)) / \
+            (r**2 * total[valid])
+    
+    return _with_invalid(~valid, total, p, d_xy, var)
 
-def _logdet(matrix, use_tk_adjustment=True):
-    """returns the LogDet from a diversity matrix
+def _paralinear(matrix):
+    """the paralinear distance from a diversity matrix"""
+    return _invalid_to_none(_paralinear_from_matrices(matrix[None]))
+
+def _logdet_from_matrices(matrices, use_tk_adjustment=True):
+    """returns the LogDet from a stack of diversity matrices
     Arguments:
         - use_tk_adjustment: when True, unequal state frequencies are allowed
     """
+    total, p, frequency, determinant, freqs, var_term, valid = \
+            _logdetcommon(matrices)
+    d_xy = zeros(total.shape, float64)
+    var = zeros(total.shape, float64)
     
-    invalid = (None,)*4
-
-    total, p, frequency, freqs, var_term = _logdetcommon(matrix)
-    if frequency is None:
-        return invalid
-    
-    r = matrix.shape[0]
+    r = matrices.shape[-1]
     if use_tk_adjustment:
-        coeff = (sum(sum(freqs)**2)/4 - 1) / (r - 1)
-        d_xy = coeff * log(det(frequency)/sqrt((freqs[0] * freqs[1]).prod()))
-        var = None
+        coeff = (((freqs[0] + freqs[1])**2).sum(axis=-1)/4 - 1) / (r - 1)
+        d_xy[valid] = coeff * log(
+                determinant / sqrt((freqs[0] * freqs[1]).prod(axis=-1)))
+        var[:] = nan
     else:
-        d_xy = - log(det(frequency)) / r - log(r)
-        var = ( var_term / r**2 - 1 ) / total
-
-    return total, p, d_xy, var
+        d_xy[valid] = - log(determinant) / r - log(r)
+        var[valid] = ( var_term / r**2 - 1 ) / total[valid]
+    
+    return _with_invalid(~valid, total, p, d_xy, var)
 
-try:
-    from _pairwise_distance import \
-        _fill_diversity_matrix as fill_diversity_matrix
-    # raise ImportError # for testing
-except ImportError:
-    fill_diversity_matrix = _fill_diversity_matrix
+def _logdet(matrix, use_tk_adjustment=True):
+    """returns the LogDet from a diversity matrix
+    Arguments:
+        - use_tk_adjustment: when True, unequal state frequencies are allowed
+    """
+    return _invalid_to_none(_logdet_from_matrices(matrix[None],
+            use_tk_adjustment))
 
 def _number_formatter(template):
     """flexible number formatter"""
@@ -254,7 +295,7 @@ class _PairwiseDistance(object):
         assert type(alignment.MolType) == type(self.moltype), \
             'Alignment does not have correct MolType'
         
-        self._dists = {}
+        self._dists = None
         self.Names = alignment.Names[:]
         indexed_seqs = []
         for name in self.Names:
@@ -266,60 +307,81 @@ class _PairwiseDistance(object):
     
     @staticmethod
     def func():
-        pass # over ride in subclasses
+        pass # over ride in subclasses, vectorised over diversity matrices
     
     @display_wrap
-    def run(self, alignment=None, ui=None):
-        """computes the pairwise distances"""
+    def run(self, alignment=None, block_size=None, ui=None):
+        """computes the pairwise distances
+        
+        Arguments:
+            - block_size: sequences are compared block_size against
+              block_size at a time, which bounds the memory used for the
+              diversity matrices.  The default, 1024 // dim, keeps a block's
+              dim x dim matrices to about a million counts for any moltype."""
         if alignment is not None:
             self._convert_seqs_to_indices(alignment)
         
-        matrix = zeros((self._dim, self._dim), float64)
+        num_seqs = len(self.Names)
+        if block_size is None:
+            block_size = max(1024 // self._dim, 1)
+        self._dists = zeros((4, num_seqs, num_seqs), float64)
+        self._dists.fill(nan)
+        starts = range(0, num_seqs, block_size)
         done = 0.0
-        to_do = (len(self.Names) * len(self.Names) - 1) / 2
-        for i in range(len(self.Names)-1):
-            name_1 = self.Names[i]
-            s1 = self.IndexedSeqs[i]
-            for j in range(i+1, len(self.Names)):
-                name_2 = self.Names[j]
-                ui.display('%s vs %s' % (name_1, name_2), done / to_do )
+        to_do = len(starts) * (len(starts) + 1) / 2
+        for start_1 in starts:
+            rows = arange(start_1, min(start_1 + block_size, num_seqs))
+            for start_2 in starts[starts.index(start_1):]:
+                cols = arange(start_2, min(start_2 + block_size, num_seqs))
+                ui.display('%s vs %s' % (self.Names[start_1],
+                        self.Names[start_2]), done / to_do)
                 done += 1
-                matrix.fill(0)
-                s2 = self.IndexedSeqs[j]
-                fill_diversity_matrix(matrix, s1, s2)
-                total, p, dist, var = self.func(matrix, *self._func_args)
-                self._dists[(name_1, name_2)] = (total, p, dist, var)
-                self._dists[(name_2, name_1)] = (total, p, dist, var)
-        
+                (i, j) = (rows[:, None] < cols[None, :]).nonzero()
+                if not len(i):
+                    continue
+                matrices = _diversity_matrices(self.IndexedSeqs[rows],
+                        self.IndexedSeqs[cols], self._dim)
+                stats = self.func(matrices[i, j], *self._func_args)
+                for (stat, values) in enumerate(stats):
+                    self._dists[stat, rows[i], cols[j]] = values
+                    self._dists[stat, cols[j], rows[i]] = values
     
     def getPairwiseDistances(self):
         """returns a 2D dictionary of pairwise distances."""
         if self._dists is None:
             return None
         dists = {}
-        for name_1 in self.Names:
-            for name_2 in self.Names:
-                if name_1 == name_2:
+        for (i, name_1) in enumerate(self.Names):
+            for (j, name_2) in enumerate(self.Names):
+                if i == j:
                     continue
-                val = self._dists[(name_1, name_2)][2]
-                dists[(name_1, name_2)] = val
-                dists[(name_2, name_1)] = val
+                val = self._dists[2, i, j]
+                dists[(name_1, name_2)] = None if isnan(val) else val
         
         return dists
     
+    def getPairwiseDistanceArray(self):
+        """returns the pairwise distances as a square array in the order of
+        self.Names, nan where a distance couldn't be computed."""
+        if self._dists is None:
+            return None
+        return self._dists[2].copy()
+    
     def _get_stats(self, stat, transform=None, **kwargs):
         """returns a table for the indicated statistics"""
         if self._dists is None:
             return None
         rows = []
-        for row_name in self.Names:
+        for (i, row_name) in enumerate(self.Names):
             row = [row_name]
-            for col_name in self.Names:
-                if row_name == col_name:
+            for (j, col_name) in enumerate(self.Names):
+                if i == j:
                     row.append('')
                     continue
-                val = self._dists[(row_name, col_name)][stat]
-                if transform is not None:
+                val = self._dists[stat, i, j]
+                if isnan(val):
+                    val = None
+                elif transform is not None:
                     val = transform(val)
                 row.append(val)
             rows.append(row)
@@ -375,7 +437,7 @@ class JC69Pair(_NucleicSeqPair):
     def __init__(self, *args, **kwargs):
         """states: the valid sequence states"""
         super(JC69Pair, self).__init__(*args, **kwargs)
-        self.func = _jc69_from_matrix
+        self.func = _jc69_from_matrices
     
 
 class TN93Pair(_NucleicSeqPair):
@@ -383,7 +445,6 @@ class TN93Pair(_NucleicSeqPair):
     def __init__(self, *args, **kwargs):
         """states: the valid sequence states"""
         super(TN93Pair, self).__init__(*args, **kwargs)
-        self._freqs = zeros(self._dim, float64)
         self.pur_indices = get_purine_indices(self.moltype)
         self.pyr_indices = get_pyrimidine_indices(self.moltype)
         
@@ -400,8 +461,8 @@ class TN93Pair(_NucleicSeqPair):
         self.pur_coords = [i * 4 + j for i, j in self.pur_coords]
         self.tv_coords = [i * 4 + j for i, j in self.tv_coords]
         
-        self.func = _tn93_from_matrix
-        self._func_args = [self._freqs, self.pur_indices,
+        self.func = _tn93_from_matrices
+        self._func_args = [self.pur_indices,
             self.pyr_indices, self.pur_coords,
             self.pyr_coords, self.tv_coords]
         
@@ -414,7 +475,7 @@ class LogDetPair(_PairwiseDistance):
             - use_tk_adjustment: use the correction of Tamura and Kumar 2002
         """
         super(LogDetPair, self).__init__(*args, **kwargs)
-        self.func = _logdet
+        self.func = _logdet_from_matrices
         self._func_args = [use_tk_adjustment]
     
     def run(self, use_tk_adjustment=None, *args, **kwargs):
@@ -427,4 +488,4 @@ class ParalinearPair(_PairwiseDistance):
     """computes the paralinear distance (Lake 1994) between sequence pairs"""
     def __init__(self, *args, **kwargs):
         super(ParalinearPair, self).__init__(*args, **kwargs)
-        self.func = _paralinear
+        self.func = _paralinear_from_matrices
@@ -302,7 +302,8 @@ class AlignmentLikelihoodFunction(_LikelihoodParameterController):
         except KeyError:
             pass
     
-    def makeLikelihoodDefn(self, sites_independent=True, discrete_edges=None):
+    def makeLikelihoodDefn(self, sites_independent=True, discrete_edges=None,
+            batch_bins=False):
         defns = self.model.makeParamControllerDefns(bin_names=self.bin_names)
         if discrete_edges is not None:
             from discrete_markov import PartialyDiscretePsubsDefn
@@ -311,7 +312,7 @@ class AlignmentLikelihoodFunction(_LikelihoodParameterController):
         return likelihood_calculation.makeTotalLogLikelihoodDefn(
             self.tree, defns['align'], defns['psubs'], defns['word_probs'],
             defns['bprobs'], self.bin_names, self.locus_names,
-            sites_independent)
+            sites_independent, batch_bins)
     
     def setAlignment(self, aligns, motif_pseudocount=None):
         """set the alignment to be used for computing the likelihood."""
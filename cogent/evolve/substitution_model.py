@@ -44,7 +44,8 @@ from cogent.evolve.substitution_calculation import (
     ConstDefn, GammaDefn, MonotonicDefn, SelectForDimension, 
     WeightedPartitionDefn)
 from cogent.evolve.discrete_markov import PsubMatrixDefn
-from cogent.evolve.likelihood_tree import makeLikelihoodTreeLeaf
+from cogent.evolve.likelihood_tree import makeLikelihoodTreeLeaf, \
+        getAlignmentSitePatterns
 from cogent.maths.optimisers import ParameterOutOfBoundsError
 
 __author__ = "Peter Maxwell, Gavin Huttley and Andrew Butterfield"
@@ -103,6 +104,11 @@ class _SubstitutionModel(object):
     # Subclasses must provide
     #  .makeParamControllerDefns()
     
+    # Leaves are made from the alignment's site patterns, kept for all the
+    # models.  Subclasses which convert sequences with their own
+    # convertSequence need this to be False.
+    use_site_patterns = True
+    
     def __init__(self, alphabet, 
             motif_probs=None, optimise_motif_probs=False,
             equal_motif_probs=False, motif_probs_from_data=None,
@@ -283,10 +289,20 @@ class _SubstitutionModel(object):
     
     def convertAlignment(self, alignment):
         # this is to support for everything but HMM
+        if not self.use_site_patterns:
+            result = {}
+            for seq_name in alignment.getSeqNames():
+                sequence = alignment.getGappedSeq(seq_name, self.recode_gaps)
+                result[seq_name] = self.convertSequence(sequence, seq_name)
+            return result
+        alphabet = self.getAlphabet()
+        patterns = getAlignmentSitePatterns(alignment, alphabet.getMotifLen(),
+                self.recode_gaps)
         result = {}
         for seq_name in alignment.getSeqNames():
             sequence = alignment.getGappedSeq(seq_name, self.recode_gaps)
-            result[seq_name] = self.convertSequence(sequence, seq_name)
+            result[seq_name] = patterns.makeLikelihoodTreeLeaf(seq_name,
+                    alphabet, sequence)
         return result
     
     def convertSequence(self, sequence, name):
@@ -9,9 +9,13 @@ For distance functions, the API resembles the following (but see function
 docstring for specifics):
     * comparisons are between rows (samples)
     * input: 2D numpy array.  Limited support for non-2D arrays if 
-    strict==False
+    strict==False.  Sparse matrices with a tocsr() method (e.g. from
+    scipy.sparse) are also accepted, and not made dense.
     * output: numpy 2D array float ('d') type.  shape (inputrows, inputrows)
-    for sane input data
+    for sane input data.  condensed_dists() gives just the distances between
+    different rows, calculated in blocks of rows which can be written to
+    a preallocated or memory mapped array and spread over parallel
+    processes.
     * two rows of all zeros *typically* returns 0 distance between them
     * negative values are only allowed for some distance metrics,
     in these cases if strict==True, negative input values return a ValueError, 
@@ -69,6 +73,10 @@ except ImportError:
 # ambiguous. Use a.any() or a.all()
 
 from numpy.linalg import norm
+from cogent.util.array import sparse_nonzero
+from copy import copy
+from itertools import izip
+from cogent.util import parallel
 
 __author__ = "Justin Kuczynski"
 __copyright__ = "Copyright 2007-2016, The Cogent Project"
@@ -81,29 +89,6 @@ __maintainer__ = "Justin Kuczynski"
 __email__ = "justinak@gmail.com"
 __status__ = "Prototype"
 
-def _rankdata(a):
-    """ Ranks the data in a, dealing with ties appropritely.  First ravels 
-    a.  Adapted from Gary Perlman's |Stat ranksort.
-    private helper function
-
-    Returns: array of length equal to a, containing rank scores
-    """
-    a = ravel(a)
-    n = len(a)
-    ivec = argsort(a)
-    svec = take(a, ivec)
-    sumranks = dupcount = 0
-    newarray = zeros(n,'d')
-    for i in range(n):
-        sumranks = sumranks + i
-        dupcount = dupcount + 1
-        if i==n-1 or svec[i] <> svec[i+1]:
-            averank = sumranks / float(dupcount) + 1
-            for j in range(i-dupcount+1,i+1):
-                newarray[ivec[j]] = averank
-                sumranks = dupcount = 0
-    return newarray
-
 def trans_chord(m):
     """perform a chord distance transformation on the rows of m
 
@@ -164,6 +149,514 @@ def trans_hellinger(m):
 
 
 
+class _DenseRows(object):
+    """The rows of a 2D array of data"""
+    def __init__(self, array):
+        self.array = array
+        (self.numrows, self.numcols) = array.shape
+        self.values = array
+
+    def map(self, f):
+        """The rows with f applied to each value, f(0) being 0"""
+        return _DenseRows(f(self.array))
+
+    def scale(self, row_factors=1.0, col_factors=1.0):
+        """The rows with each value multiplied by the factors of its row and
+        column"""
+        return _DenseRows(self.array *
+            numpy.reshape(row_factors, (-1, 1)) * col_factors)
+
+    def sums(self):
+        return self.array.sum(axis=1)
+
+    def col_sums(self):
+        return self.array.sum(axis=0)
+
+    def col_ranges(self):
+        return self.array.max(axis=0) - self.array.min(axis=0)
+
+    def squared_deviations(self, means):
+        return ((self.array - means[:, numpy.newaxis])**2).sum(axis=1)
+
+    def ranks(self):
+        """The ranks of the values within each row (from 1, ties averaged)
+        and the rank of the zeros that aren't among them (here none)"""
+        row = numpy.repeat(numpy.arange(self.numrows), self.numcols)
+        (ranks, zero_ranks) = _row_ranks(row, self.array.ravel(),
+            self.numrows, self.numcols)
+        return (_DenseRows(ranks.reshape(self.array.shape)), zero_ranks)
+
+    def row_costs(self):
+        """The number of distances to calculate for each row"""
+        return self.numrows - numpy.arange(self.numrows)
+
+    def products(self, first, last):
+        """The sums of the products of rows first to last with each row from
+        first on"""
+        return numpy.dot(self.array[first:last], self.array[first:].T)
+
+    def _each_pair(self, first, last, g):
+        """g(row, others) for rows first to last and each row from first on,
+        g giving a value for each of others"""
+        result = zeros((last - first, self.numrows - first))
+        # a few rows at a time, to keep g's arrays small
+        step = max(1, 2**16 // max(1, self.numcols))
+        for start in range(first, self.numrows, step):
+            others = self.array[start:start+step]
+            for i in range(first, last):
+                result[i-first, start-first:start-first+len(others)] = g(
+                    self.array[i], others)
+        return result
+
+    def pair_sums(self, first, last, f):
+        """The sums of f(a, b) for rows first to last with each row from
+        first on, f(0, 0) being 0"""
+        return self._each_pair(first, last,
+            lambda row, others: f(row, others).sum(axis=1))
+
+    def squared_dists(self, first, last):
+        """The squared euclidean distances of rows first to last from each
+        row from first on"""
+        def squared_dists(row, others):
+            diffs = others - row
+            return numpy.einsum('ij,ij->i', diffs, diffs)
+        return self._each_pair(first, last, squared_dists)
+
+class _SparseRows(object):
+    """The rows of a sparse matrix of data, e.g. from scipy.sparse
+
+    Only the shape, indptr, indices and data of data.tocsr() are used, so
+    the rows are never made dense.  The nonzero values are also indexed by
+    column so that the values shared by two rows can be paired without
+    looking at any others.
+    """
+    def __init__(self, data):
+        ((self.numrows, self.numcols), self.row, self.col, values) = \
+            sparse_nonzero(data)
+        self.values = asarray(values, 'd')
+        self.counts = numpy.bincount(self.row, minlength=self.numrows)
+        self.indptr = numpy.concatenate([[0], self.counts.cumsum()])
+        # for each value, where the values of later rows in its column start
+        # and end in the values ordered by column then row
+        keys = self.col * numpy.int64(self.numrows) + self.row
+        self.by_col = numpy.argsort(keys, kind='mergesort')
+        keys = keys[self.by_col]
+        col_ends = numpy.searchsorted(keys,
+            (numpy.arange(self.numcols) + 1) * numpy.int64(self.numrows))
+        self.later_starts = numpy.searchsorted(keys,
+            self.col * numpy.int64(self.numrows) + self.row + 1)
+        self.later_ends = col_ends[self.col]
+
+    def _with_values(self, values):
+        result = copy(self)
+        result.values = values
+        return result
+
+    def map(self, f):
+        return self._with_values(f(self.values))
+
+    def scale(self, row_factors=1.0, col_factors=1.0):
+        row_factors = row_factors * numpy.ones(self.numrows)
+        col_factors = col_factors * numpy.ones(self.numcols)
+        return self._with_values(self.values * row_factors[self.row] *
+            col_factors[self.col])
+
+    def sums(self, values=None):
+        if values is None:
+            values = self.values
+        return numpy.bincount(self.row, values, minlength=self.numrows)
+
+    def col_sums(self):
+        return numpy.bincount(self.col, self.values, minlength=self.numcols)
+
+    def col_ranges(self):
+        order = numpy.lexsort((self.values, self.col))
+        values = self.values[order]
+        counts = numpy.bincount(self.col, minlength=self.numcols)
+        present = counts > 0
+        ends = counts.cumsum()[present]
+        # columns with any zeros range to 0
+        partial = counts < self.numrows
+        high = numpy.where(partial, 0.0, -numpy.inf)
+        low = numpy.where(partial, 0.0, numpy.inf)
+        high[present] = numpy.maximum(high[present], values[ends-1])
+        low[present] = numpy.minimum(low[present],
+            values[ends-counts[present]])
+        return high - low
+
+    def squared_deviations(self, means):
+        return (self.sums((self.values - means[self.row])**2) +
+            (self.numcols - self.counts) * means**2)
+
+    def ranks(self):
+        """The ranks of the values within each row less the rank of the
+        zeros of the row, and the rank of the zeros"""
+        (ranks, zero_ranks) = _row_ranks(self.row, self.values,
+            self.numrows, self.numcols)
+        return (self._with_values(ranks - zero_ranks[self.row]), zero_ranks)
+
+    def row_costs(self):
+        """The number of distances and of pairs of shared values to
+        calculate for each row"""
+        pairs = numpy.bincount(self.row, self.later_ends - self.later_starts,
+            minlength=self.numrows)
+        return self.numrows - numpy.arange(self.numrows) + pairs
+
+    def _pairs(self, first, last):
+        """Both values of each pair of values in the same column of a row
+        from first to last and a later row, and the index of that pair of
+        rows in a (last-first) x (numrows-first) array"""
+        values = numpy.arange(self.indptr[first], self.indptr[last])
+        starts = self.later_starts[values]
+        counts = self.later_ends[values] - starts
+        left = numpy.repeat(values, counts)
+        offsets = numpy.arange(counts.sum()) - numpy.repeat(
+            counts.cumsum() - counts, counts)
+        right = self.by_col[numpy.repeat(starts, counts) + offsets]
+        index = ((self.row[left] - first) * (self.numrows - first) +
+            self.row[right] - first)
+        return (self.values[left], self.values[right], index)
+
+    def products(self, first, last):
+        (a, b, index) = self._pairs(first, last)
+        return numpy.bincount(index, a * b, minlength=(last - first) *
+            (self.numrows - first)).reshape((last - first, -1))
+
+    def pair_sums(self, first, last, f):
+        # the sums for each row as if the other were all zeros, corrected
+        # where both are nonzero
+        (a, b, index) = self._pairs(first, last)
+        shared = numpy.bincount(index, f(a, b) - f(a, 0.0) - f(0.0, b),
+            minlength=(last - first) * (self.numrows - first))
+        only_a = self.sums(f(self.values, 0.0))[first:last]
+        only_b = self.sums(f(0.0, self.values))[first:]
+        return (shared.reshape((last - first, -1)) +
+            only_a[:, numpy.newaxis] + only_b)
+
+    def squared_dists(self, first, last):
+        # sums of squares can round to just below 0
+        return numpy.maximum(self.pair_sums(first, last, _sqdiff), 0.0)
+
+def _row_ranks(row, values, numrows, numcols):
+    """Ranks of values within their rows (from 1, ties averaged), among
+    them and the numcols - (number of values) zeros of each row.  Also
+    returns the rank of those zeros for each row (0 if there are none)."""
+    order = numpy.lexsort((values, row))
+    (row, values) = (row[order], values[order])
+    position = numpy.arange(len(values)) - numpy.searchsorted(row, row)
+    # ties get the average rank of their run of equal values
+    new = numpy.ones(len(values), bool)
+    new[1:] = (row[1:] != row[:-1]) | (values[1:] != values[:-1])
+    run = new.cumsum() - 1
+    run_sizes = numpy.bincount(run)
+    zero_counts = numcols - numpy.bincount(row, minlength=numrows)
+    negatives = numpy.bincount(row[values < 0], minlength=numrows)
+    ranks = numpy.empty(len(values))
+    ranks[order] = (position[new][run] + (run_sizes[run] + 1) / 2.0 +
+        numpy.where(values > 0, zero_counts[row], 0))
+    zero_ranks = numpy.where(zero_counts, negatives + (zero_counts + 1) / 2.0,
+        0.0)
+    return (ranks, zero_ranks)
+
+def _absdiff(a, b):
+    return abs(a - b)
+
+def _sqdiff(a, b):
+    return (a - b)**2
+
+def _presence(values):
+    return (values != 0).astype(float)
+
+def _reciprocal(values):
+    """1/values, or 0 where values are 0"""
+    return numpy.where(values == 0, 0.0, 1.0 / values)
+
+def _euclidean(rows, first, last):
+    return sqrt(rows.squared_dists(first, last))
+
+def _zero_rules(dists, a, b):
+    """dists, except 0 where both a and b (sums, norms etc. of two rows)
+    are 0 and 1 where just one is"""
+    return where((a == 0) | (b == 0), where((a == 0) & (b == 0), 0.0, 1.0),
+        dists)
+
+def _row_blocks(rows, block_size):
+    """(first, last) row of blocks of rows with about block_size distances
+    and shared values to calculate"""
+    costs = rows.row_costs().cumsum()
+    bounds = []
+    first = 0
+    while first < rows.numrows - 1:
+        done = costs[first-1] if first else 0
+        last = max(first + 1, numpy.searchsorted(costs, done + block_size,
+            side='right'))
+        bounds.append((first, last))
+        first = last
+    return bounds
+
+def _dists(datamtx, metric, strict, out=None, block_size=2**22):
+    """(numrows, condensed distances between the rows of datamtx), or None
+    for the empty result.  The checks are those of the dist_ functions."""
+    try:
+        (make_block, nonnegative, binary) = _DIST_BLOCKS[metric]
+    except KeyError:
+        raise ValueError("%s is not a distance function of this module" %
+            getattr(metric, '__name__', metric))
+    rows = None
+    if hasattr(datamtx, 'tocsr'):
+        rows = _SparseRows(datamtx)
+        if binary:
+            rows = rows.map(_presence)
+        values = rows.values
+    else:
+        values = asarray(datamtx)
+        if binary:
+            values = values.astype(bool)
+        values = values.astype(float)
+    if strict:
+        if not all(isfinite(values)):
+            raise ValueError("non finite number in input matrix")
+        if nonnegative and any(values<0.0):
+            raise ValueError("negative value in input matrix")
+    if rows is None:
+        if rank(values) != 2:
+            if strict:
+                raise ValueError("input matrix not 2D")
+            return None
+        rows = _DenseRows(values)
+    if strict and metric is dist_spearman_approx and rows.numcols < 2:
+        raise ValueError("input matrix has < 2 colunms")
+    if rows.numrows == 0 or rows.numcols == 0:
+        return None
+
+    numrows = rows.numrows
+    size = numrows * (numrows - 1) // 2
+    if out is None:
+        out = zeros(size, 'd')
+    elif len(out) != size:
+        raise ValueError("out has %s values, not %s" % (len(out), size))
+    oldstate = seterr(invalid='ignore', divide='ignore')
+    try:
+        block = make_block(rows)
+    finally:
+        seterr(**oldstate)
+    def condensed(bounds):
+        (first, last) = bounds
+        oldstate = seterr(invalid='ignore', divide='ignore')
+        try:
+            dists = block(first, last)
+        finally:
+            seterr(**oldstate)
+        upper = (numpy.arange(numrows - first)[numpy.newaxis] >
+            numpy.arange(last - first)[:, numpy.newaxis])
+        return dists[upper]
+    bounds = _row_blocks(rows, block_size)
+    with parallel.registered(condensed):
+        for ((first, last), dists) in izip(bounds,
+                parallel.imap(condensed, bounds)):
+            start = numrows * first - first * (first + 1) // 2
+            out[start:start+len(dists)] = dists
+    return (numrows, out)
+
+def _square(result):
+    """The full distance matrix from the result of _dists"""
+    if result is None:
+        return zeros((0,0),'d')
+    (numrows, condensed) = result
+    dists = zeros((numrows,numrows),'d')
+    (i, j) = numpy.triu_indices(numrows, 1)
+    dists[i, j] = dists[j, i] = condensed
+    return dists
+
+# Each metric's distances between rows first to last and each row from
+# first on, as a (last-first) x (numrows-first) array, of which the upper
+# triangle is used.
+
+def _bray_curtis_blocks(rows):
+    sums = rows.sums()
+    def block(first, last):
+        totals = sums[first:last, numpy.newaxis] + sums[first:]
+        return where(totals > 0,
+            rows.pair_sums(first, last, _absdiff) / totals, 0.0)
+    return block
+
+def _bray_curtis_magurran_blocks(rows):
+    sums = rows.sums()
+    def block(first, last):
+        totals = sums[first:last, numpy.newaxis] + sums[first:]
+        minsums = rows.pair_sums(first, last, numpy.minimum)
+        return where(totals == 0, 0.0, 1 - (2 * minsums / totals))
+    return block
+
+def _canberra_terms(a, b):
+    return nan_to_num(abs(a - b) / (a + b))
+
+def _canberra_nonzeros(a, b):
+    return (_canberra_terms(a, b) != 0).astype(float)
+
+def _canberra_blocks(rows):
+    def block(first, last):
+        net = rows.pair_sums(first, last, _canberra_terms)
+        num_nonzeros = rows.pair_sums(first, last, _canberra_nonzeros)
+        return nan_to_num(net / num_nonzeros)
+    return block
+
+def _chisq_blocks(rows):
+    sums = rows.sums()
+    colsums = rows.col_sums()
+    colsums[colsums == 0.0] = 1.0
+    sqrt_grand_sum = sqrt(sums.sum())
+    profiles = rows.scale(_reciprocal(sums), 1.0 / sqrt(colsums))
+    def block(first, last):
+        dists = sqrt_grand_sum * _euclidean(profiles, first, last)
+        return _zero_rules(dists, sums[first:last, numpy.newaxis],
+            sums[first:])
+    return block
+
+def _chord_blocks(rows):
+    norms = sqrt(rows.map(square).sums())
+    unit = rows.scale(_reciprocal(norms))
+    def block(first, last):
+        return _zero_rules(_euclidean(unit, first, last),
+            norms[first:last, numpy.newaxis], norms[first:])
+    return block
+
+def _euclidean_blocks(rows):
+    def block(first, last):
+        dists = _euclidean(rows, first, last)
+        if isnan(dists).any():
+            raise RuntimeError(
+                'ERROR: overflow when computing euclidean distance')
+        return dists
+    return block
+
+def _gower_blocks(rows):
+    coldiffs = rows.col_ranges()
+    coldiffs[coldiffs == 0.0] = 1.0 # numerator will be zero anyway
+    scaled = rows.scale(1.0, 1.0 / coldiffs)
+    def block(first, last):
+        return scaled.pair_sums(first, last, _absdiff)
+    return block
+
+def _hellinger_blocks(rows):
+    sums = rows.sums()
+    roots = rows.scale(_reciprocal(sums)).map(sqrt)
+    def block(first, last):
+        return _zero_rules(_euclidean(roots, first, last),
+            sums[first:last, numpy.newaxis], sums[first:])
+    return block
+
+def _kulczynski_blocks(rows):
+    sums = rows.sums()
+    def block(first, last):
+        (a, b) = (sums[first:last, numpy.newaxis], sums[first:])
+        minsums = rows.pair_sums(first, last, numpy.minimum)
+        return _zero_rules(1.0 - ((minsums / a) + (minsums / b)) / 2.0, a, b)
+    return block
+
+def _manhattan_blocks(rows):
+    def block(first, last):
+        return rows.pair_sums(first, last, _absdiff)
+    return block
+
+def _abund_jaccard_blocks(rows):
+    sums = rows.sums()
+    def block(first, last):
+        (N1, N2) = (sums[first:last, numpy.newaxis], sums[first:])
+        # relative abundances of the shared species
+        u = rows.pair_sums(first, last, lambda a, b: a * (b != 0)) / N1
+        v = rows.pair_sums(first, last, lambda a, b: b * (a != 0)) / N2
+        similarity = where((u == 0.0) & (v == 0.0), 0.0,
+            (u * v) / (u + v - (u * v)))
+        return _zero_rules(1 - similarity, N1, N2)
+    return block
+
+def _morisita_horn_blocks(rows):
+    sums = rows.sums()
+    # d_a etc., 0 if actually 0/0
+    row_ds = rows.map(square).sums()
+    row_ds = where(row_ds != 0.0, row_ds / sums**2, 0.0)
+    def block(first, last):
+        (N1, N2) = (sums[first:last, numpy.newaxis], sums[first:])
+        (d1, d2) = (row_ds[first:last, numpy.newaxis], row_ds[first:])
+        similarity = 2 * rows.products(first, last) / ((d1 + d2) * N1 * N2)
+        return _zero_rules(1 - similarity, N1, N2)
+    return block
+
+def _pearson_blocks(rows):
+    n = rows.numcols
+    means = rows.sums() / n
+    sumsqs = rows.squared_deviations(means)
+    if not isinstance(rows, _SparseRows):
+        rows = _DenseRows(rows.array - means[:, numpy.newaxis])
+        means = zeros(rows.numrows)
+    def block(first, last):
+        (m1, m2) = (means[first:last, numpy.newaxis], means[first:])
+        (sum1, sum2) = (sumsqs[first:last, numpy.newaxis], sumsqs[first:])
+        top = rows.products(first, last) - n * m1 * m2
+        # flat rows have r 1 with each other and 0 with others
+        return _zero_rules(1.0 - top / sqrt(sum1 * sum2), sum1, sum2)
+    return block
+
+def _soergel_blocks(rows):
+    def block(first, last):
+        top = rows.pair_sums(first, last, _absdiff)
+        bot = rows.pair_sums(first, last, numpy.maximum)
+        return where(bot <= 0.0, 0.0, top / bot)
+    return block
+
+def _spearman_approx_blocks(rows):
+    n = rows.numcols
+    (ranks, zero_ranks) = rows.ranks()
+    rank_sums = ranks.sums()
+    def block(first, last):
+        if n < 2:
+            # formula fails for < 2 elements per row
+            return zeros((last - first, rows.numrows - first))
+        # ranks are zero_ranks more than the values of ranks
+        offsets = zero_ranks[first:last, numpy.newaxis] - zero_ranks[first:]
+        dsqsum = (ranks.pair_sums(first, last, _sqdiff) + 2 * offsets *
+            (rank_sums[first:last, numpy.newaxis] - rank_sums[first:]) +
+            n * offsets**2)
+        return 6*dsqsum / float(n*(n**2-1))
+    return block
+
+def _specprof_blocks(rows):
+    sums = rows.sums()
+    profiles = rows.scale(_reciprocal(sums))
+    def block(first, last):
+        return _zero_rules(_euclidean(profiles, first, last),
+            sums[first:last, numpy.newaxis], sums[first:])
+    return block
+
+def _binary_blocks(f):
+    """Blocks of f(a, b, c) where a and b are the number of 1's in each
+    row and c the number that are 1's in both"""
+    def blocks(rows):
+        sums = rows.sums()
+        def block(first, last):
+            return f(sums[first:last, numpy.newaxis], sums[first:],
+                rows.products(first, last))
+        return block
+    return blocks
+
+def _sorensen_dice(a, b, c):
+    bottom = a + b
+    return where(bottom == 0, 0.0, 1 - (2 * c / bottom))
+
+def _hamming(a, b, c):
+    return a + b - (2.0*c)
+
+def _jaccard(a, b, c):
+    return where((a == 0.0) & (b == 0.0), 0.0, 1.0 - (c/(a+b-c)))
+
+def _lennon(a, b, c):
+    return where((a == 0.0) & (b == 0.0), 0.0,
+        where(c == 0.0, 1.0, 1.0 - (c/(c + numpy.minimum(a-c, b-c)))))
+
+def _ochiai(a, b, c):
+    return _zero_rules(1.0 - (c/sqrt(a*b)), a, b)
+
 def dist_bray_curtis(datamtx, strict=True):
     """ returns bray curtis distance (normalized manhattan distance) btw rows
     
@@ -186,36 +679,7 @@ def dist_bray_curtis(datamtx, strict=True):
     entries.  If rank of input data is < 2, returns an empty 2d array (shape:
     (0, 0) ).  If 0 rows or 0 colunms, also returns an empty 2d array.
     """
-    if strict:
-        if not all(isfinite(datamtx)):
-            raise ValueError("non finite number in input matrix")
-        if any(datamtx<0.0):
-            raise ValueError("negative value in input matrix")
-        if rank(datamtx) != 2:
-            raise ValueError("input matrix not 2D")
-        numrows, numcols = shape(datamtx)
-    else:
-        try:
-            numrows, numcols = shape(datamtx)
-        except ValueError:
-            return zeros((0,0),'d')
-
-    if numrows == 0 or numcols == 0:
-        return zeros((0,0),'d')
-
-    dists = zeros((numrows,numrows),'d')
-    for i in range(numrows):
-        r1 = datamtx[i,:]
-        for j in range(i):
-            r2 = datamtx[j,:]
-            abs_v = float(sum(abs(r1 - r2)))
-            v = sum(r1 + r2)
-            cur_d = 0.0 
-            if v > 0:
-                cur_d = abs_v/v
-
-            dists[i][j] = dists[j][i] = cur_d
-    return dists
+    return _square(_dists(datamtx, dist_bray_curtis, strict))
 
 dist_bray_curtis_faith = dist_bray_curtis
 
@@ -240,38 +704,7 @@ def dist_bray_curtis_magurran(datamtx, strict=True):
     entries.  If rank of input data is < 2, returns an empty 2d array (shape:
     (0, 0) ).  If 0 rows or 0 colunms, also returns an empty 2d array.
     """
-    if strict:
-        if not numpy.all(numpy.isfinite(datamtx)):
-            raise ValueError("non finite number in input matrix")
-        if numpy.any(datamtx<0.0):
-            raise ValueError("negative value in input matrix")
-        if rank(datamtx) != 2:
-            raise ValueError("input matrix not 2D")
-        numrows, numcols = numpy.shape(datamtx)
-    else:
-        try:
-            numrows, numcols = numpy.shape(datamtx)
-        except ValueError:
-            return numpy.zeros((0,0),'d')
-
-    if numrows == 0 or numcols == 0:
-        return numpy.zeros((0,0),'d')
-
-    dists = numpy.zeros((numrows,numrows),'d')
-    for i in range(numrows):
-        r1 = datamtx[i,:]
-        r1sum = r1.sum()
-        for j in range(i):
-            r2 = datamtx[j,:]
-            r2sum = r2.sum()
-            minvals = numpy.min([r1,r2],axis=0)
-
-            if (r1sum + r2sum) == 0:
-                dists[i][j] = dists[j][i] = 0.0
-            else:
-                dissim = 1 - ( (2*minvals.sum()) / (r1sum + r2sum) )
-                dists[i][j] = dists[j][i] = dissim
-    return dists
+    return _square(_dists(datamtx, dist_bray_curtis_magurran, strict))
 
 def dist_canberra(datamtx, strict=True):
     """returns a row-row canberra dist matrix
@@ -295,37 +728,7 @@ def dist_canberra(datamtx, strict=True):
     * chisq dist normalizes by column sums - empty columns (all zeros) are
     ignored here
     """
-    if strict:
-        if not all(isfinite(datamtx)):
-            raise ValueError("non finite number in input matrix")
-        if any(datamtx<0.0):
-            raise ValueError("negative value in input matrix")
-        if rank(datamtx) != 2:
-            raise ValueError("input matrix not 2D")
-        numrows, numcols = shape(datamtx)
-    else:
-        try:
-            numrows, numcols = shape(datamtx)
-        except ValueError:
-            return zeros((0,0),'d')
-
-    oldstate = seterr(invalid='ignore',divide='ignore')
-    if numrows == 0 or numcols == 0:
-        return zeros((0,0),'d')
-    dists = zeros((numrows,numrows),'d')
-    for i in range(numrows):
-        r1 = datamtx[i]
-        for j in range(i):
-            r2 = datamtx[j]
-            dist = 0.0
-            net = abs( r1 - r2 ) / (r1 + r2)
-
-            net = nan_to_num(net)
-            num_nonzeros = nonzero(net)[0].size
-            dists[i,j] = dists[j,i] = nan_to_num(net.sum()/num_nonzeros)
-            
-    seterr(**oldstate)
-    return dists
+    return _square(_dists(datamtx, dist_canberra, strict))
 
 def dist_chisq(datamtx, strict=True):
     """returns a row-row chisq dist matrix
@@ -350,45 +753,7 @@ def dist_chisq(datamtx, strict=True):
     * chisq dist normalizes by column sums - empty columns (all zeros) are
     ignored here
     """
-    if strict:
-        if not all(isfinite(datamtx)):
-            raise ValueError("non finite number in input matrix")
-        if any(datamtx<0.0):
-            raise ValueError("negative value in input matrix")
-        if rank(datamtx) != 2:
-            raise ValueError("input matrix not 2D")
-        numrows, numcols = shape(datamtx)
-    else:
-        try:
-            numrows, numcols = shape(datamtx)
-        except ValueError:
-            return zeros((0,0),'d')
-
-    if numrows == 0 or numcols == 0:
-        return zeros((0,0),'d')
-    dists = zeros((numrows,numrows),'d')
-    sqrt_grand_sum = sqrt(sum(datamtx))
-    rowsums, colsums = sum(datamtx, axis=1), sum(datamtx, axis=0)
-    if not colsums.all():
-        for i in range(len(colsums)):
-            if colsums[i] == 0.0:
-                colsums[i] = 1.0
-    for i in range(numrows):
-        r1 = datamtx[i]
-        r1sum = rowsums[i]
-        for j in range(i):
-            r2 = datamtx[j]
-            r2sum = rowsums[j]
-            if r1sum == 0.0 or r2sum == 0.0:
-                if r1sum == 0.0 and r2sum == 0.0:
-                    dist = 0.0
-                else: dist = 1.0
-            else:
-                dist = sqrt_grand_sum *\
-                    sqrt(sum( multiply((1./colsums) ,
-                    square(r1/r1sum - r2/r2sum)) ))
-            dists[i,j] = dists[j,i] = dist
-    return dists
+    return _square(_dists(datamtx, dist_chisq, strict))
 
 def dist_chord(datamtx, strict=True):
     """returns a row-row chord dist matrix
@@ -409,36 +774,7 @@ def dist_chord(datamtx, strict=True):
     If rank of input data is < 2, returns an empty 2d array (shape:
     (0, 0) ).  If 0 rows or 0 colunms, also returns an empty 2d array.
     """
-    if strict:
-        if not all(isfinite(datamtx)):
-            raise ValueError("non finite number in input matrix")
-        if rank(datamtx) != 2:
-            raise ValueError("input matrix not 2D")
-        numrows, numcols = shape(datamtx)
-    else:
-        try:
-            numrows, numcols = shape(datamtx)
-        except ValueError:
-            return zeros((0,0),'d')
-
-    if numrows == 0 or numcols == 0:
-        return zeros((0,0),'d')
-    dists = zeros((numrows,numrows),'d')
-    for i in range(numrows):
-        r1 = datamtx[i] # cache here
-        r1norm = norm(r1)
-        for j in range(i):
-            r2 = datamtx[j]
-            r2norm = norm(r2)
-            if r1norm == 0.0 or r2norm == 0.0:
-                if r1norm == 0.0 and r2norm == 0.0:
-                    dist = 0.0
-                else: dist = 1.0
-            else:
-                dist = norm(r1/r1norm - r2/r2norm)
-            dists[i,j] = dists[j,i] = dist
-
-    return dists
+    return _square(_dists(datamtx, dist_chord, strict))
 
 def dist_euclidean(datamtx, strict=True):
     """returns a row by row euclidean dist matrix
@@ -455,30 +791,7 @@ def dist_euclidean(datamtx, strict=True):
     If rank of input data is < 2, returns an empty 2d array (shape:
     (0, 0) ).  If 0 rows or 0 colunms, also returns an empty 2d array.
     """
-    datamtx = asarray(datamtx, 'd')
-    if strict:
-        if not all(isfinite(datamtx)):
-            raise ValueError("non finite number in input matrix")
-        if rank(datamtx) != 2:
-            raise ValueError("input matrix not 2D")
-        numrows, numcols = shape(datamtx)
-    else:
-        try:
-            numrows, numcols = shape(datamtx)
-        except ValueError:
-            return zeros((0,0),'d')
-
-    if numrows == 0 or numcols == 0:
-        return zeros((0,0),'d')
-    dists = zeros((numrows,numrows),'d')
-    for r in range(numrows):
-        for c in range(r):
-            dist = norm(datamtx[r] - datamtx[c])
-            if isnan(dist):
-                raise RuntimeError('ERROR: overflow when computing euclidean distance')
-            dists[r,c] = dists[c,r] = dist
-
-    return dists
+    return _square(_dists(datamtx, dist_euclidean, strict))
 
 def dist_gower(datamtx, strict=True):
     """returns a row-row gower dist matrix
@@ -502,35 +815,7 @@ def dist_gower(datamtx, strict=True):
     If rank of input data is < 2, returns an empty 2d array (shape:
     (0, 0) ).  If 0 rows or 0 colunms, also returns an empty 2d array.
     """
-    if strict:
-        if not all(isfinite(datamtx)):
-            raise ValueError("non finite number in input matrix")
-        if rank(datamtx) != 2:
-            raise ValueError("input matrix not 2D")
-        numrows, numcols = shape(datamtx)
-    else:
-        try:
-            numrows, numcols = shape(datamtx)
-        except ValueError:
-            return zeros((0,0),'d')
-
-    if numrows == 0 or numcols == 0:
-        return zeros((0,0),'d')
-    dists = zeros((numrows,numrows),'d')
-    coldiffs = datamtx.max(axis=0) - datamtx.min(axis=0)
-    for i in range(numcols):
-        if coldiffs[i] == 0.0:
-            coldiffs[i] = 1.0 # numerator will be zero anyway
-
-    for i in range(numrows):
-        r1 = datamtx[i]
-        for j in range(i):
-            r2 = datamtx[j]
-            rowdiff = r2 - r1
-            dist = sum(abs(r1 - r2) / coldiffs)
-            dists[i,j] = dists[j,i] = dist
-
-    return dists
+    return _square(_dists(datamtx, dist_gower, strict))
 
 def dist_hellinger(datamtx, strict=True):
     """returns a row-row hellinger dist matrix
@@ -548,38 +833,7 @@ def dist_hellinger(datamtx, strict=True):
     entries.  If rank of input data is < 2, returns an empty 2d array (shape:
     (0, 0) ).  If 0 rows or 0 colunms, also returns an empty 2d array.
     """
-    if strict:
-        if not all(isfinite(datamtx)):
-            raise ValueError("non finite number in input matrix")
-        if any(datamtx<0.0):
-            raise ValueError("negative value in input matrix")
-        if rank(datamtx) != 2:
-            raise ValueError("input matrix not 2D")
-        numrows, numcols = shape(datamtx)
-    else:
-        try:
-            numrows, numcols = shape(datamtx)
-        except ValueError:
-            return zeros((0,0),'d')
-
-    if numrows == 0 or numcols == 0:
-        return zeros((0,0),'d')
-    dists = zeros((numrows,numrows),'d')
-    for i in range(numrows):
-        r1 = datamtx[i]
-        r1sum = sum(r1)
-        for j in range(i):
-            r2 = datamtx[j]
-            r2sum = sum(r2)
-            if r1sum == 0.0 or r2sum == 0.0:
-                if r1sum == 0.0 and r2sum == 0.0:
-                    dist = 0.0
-                else: dist = 1.0
-            else:
-                dist = norm(sqrt(r1/r1sum) - sqrt(r2/r2sum))
-            dists[i,j] = dists[j,i] = dist
-
-    return dists
+    return _square(_dists(datamtx, dist_hellinger, strict))
 
 def dist_kulczynski(datamtx, strict=True):
     """ calculates the kulczynski distances between rows of a matrix
@@ -601,41 +855,7 @@ def dist_kulczynski(datamtx, strict=True):
     entries.  If rank of input data is < 2, returns an empty 2d array (shape:
     (0, 0) ).  If 0 rows or 0 colunms, also returns an empty 2d array.
     """
-    if strict:
-        if not all(isfinite(datamtx)):
-            raise ValueError("non finite number in input matrix")
-        if any(datamtx<0.0):
-            raise ValueError("negative value in input matrix")
-        if rank(datamtx) != 2:
-            raise ValueError("input matrix not 2D")
-        numrows, numcols = shape(datamtx)
-    else:
-        try:
-            numrows, numcols = shape(datamtx)
-        except ValueError:
-            return zeros((0,0),'d')
-
-    if numrows == 0 or numcols == 0:
-        return zeros((0,0),'d')
-    dists = zeros((numrows,numrows),'d')
-    rowsums = datamtx.sum(axis=1)
-    # rowsum: the sum of elements in a row
-    # cache to avoid recalculating for each pair
-    for i in range(numrows):
-        irowsum = rowsums[i]
-        r1 = datamtx[i]
-        for j in range(i):
-            r2 = datamtx[j]
-            jrowsum = rowsums[j]
-            rowminsum = float(sum(where(r1<r2, r1,r2)))
-            if (irowsum == 0.0 and jrowsum == 0.0):
-                cur_d = 0.0 # => two rows of zeros
-            elif (irowsum == 0.0 or jrowsum == 0.0):
-                cur_d = 1.0 # one row zeros, one not all zeros
-            else:
-                cur_d = 1.0 - (((rowminsum/irowsum) + (rowminsum/jrowsum))/2.0)
-            dists[i][j] = dists[j][i] = cur_d
-    return dists
+    return _square(_dists(datamtx, dist_kulczynski, strict))
 
 def dist_manhattan(datamtx, strict=True):
     """ returns manhattan (city block) distance between rows
@@ -654,27 +874,7 @@ def dist_manhattan(datamtx, strict=True):
     If rank of input data is < 2, returns an empty 2d array (shape:
     (0, 0) ).  If 0 rows or 0 colunms, also returns an empty 2d array.
     """
-    if strict:
-        if not all(isfinite(datamtx)):
-            raise ValueError("non finite number in input matrix")
-        if rank(datamtx) != 2:
-            raise ValueError("input matrix not 2D")
-        numrows, numcols = shape(datamtx)
-    else:
-        try:
-            numrows, numcols = shape(datamtx)
-        except ValueError:
-            return zeros((0,0),'d')
-
-    if numrows == 0 or numcols == 0:
-        return zeros((0,0),'d')
-    dists = zeros((numrows,numrows),'d')
-    for i in range(numrows):
-        r1 = datamtx[i] # cache here
-        for j in range(i):
-            dists[i,j] = dists[j,i] = sum(abs(r1 - datamtx[j]))
-            
-    return dists
+    return _square(_dists(datamtx, dist_manhattan, strict))
 
 def dist_abund_jaccard(datamtx, strict=True):
     """Calculate abundance-based Jaccard distance between rows
@@ -702,50 +902,7 @@ def dist_abund_jaccard(datamtx, strict=True):
     entries.  If rank of input data is < 2, returns an empty 2d array (shape:
     (0, 0) ).  If 0 rows or 0 colunms, also returns an empty 2d array.
     """
-    if strict:
-        if not all(isfinite(datamtx)):
-            raise ValueError("non finite number in input matrix")
-        if any(datamtx<0.0):
-            raise ValueError("negative value in input matrix")
-        if rank(datamtx) != 2:
-            raise ValueError("input matrix not 2D")
-        numrows, numcols = shape(datamtx)
-    else:
-        try:
-            numrows, numcols = shape(datamtx)
-        except ValueError:
-            return zeros((0,0),'d')
-
-    if numrows == 0 or numcols == 0:
-        return zeros((0,0),'d')
-    dists = zeros((numrows,numrows),'d')
-    
-    rowsums = datamtx.sum(axis=1, dtype='float')
-
-    for i in range(numrows):
-        row1 = datamtx[i]
-        N1 = rowsums[i]
-
-        for j in range(i):
-            row2 = datamtx[j]
-            N2 = rowsums[j]
-
-            if N1 == 0.0 and N2 == 0.0:
-                similarity = 1.0
-            elif N1 == 0.0 or N2 == 0.0:
-                similarity = 0.0
-            else:
-                shared = logical_and(row1, row2)
-                u = sum(row1[shared]) / N1
-                v = sum(row2[shared]) / N2
-                # Verified by graphical inspection
-                if u == 0.0 and v == 0.0:
-                    similarity = 0.0
-                else:
-                    similarity = (u * v) / (u + v - (u * v))
-
-            dists[i][j] = dists[j][i] = 1 - similarity
-    return dists
+    return _square(_dists(datamtx, dist_abund_jaccard, strict))
 
 def dist_morisita_horn(datamtx, strict=True):
     """ returns morisita-horn distance between rows
@@ -767,50 +924,7 @@ def dist_morisita_horn(datamtx, strict=True):
     entries.  If rank of input data is < 2, returns an empty 2d array (shape:
     (0, 0) ).  If 0 rows or 0 colunms, also returns an empty 2d array.
     """
-    if strict:
-        if not all(isfinite(datamtx)):
-            raise ValueError("non finite number in input matrix")
-        if any(datamtx<0.0):
-            raise ValueError("negative value in input matrix")
-        if rank(datamtx) != 2:
-            raise ValueError("input matrix not 2D")
-        numrows, numcols = shape(datamtx)
-    else:
-        try:
-            numrows, numcols = shape(datamtx)
-        except ValueError:
-            return zeros((0,0),'d')
-
-    if numrows == 0 or numcols == 0:
-        return zeros((0,0),'d')
-    dists = zeros((numrows,numrows),'d')
-    
-    rowsums = datamtx.sum(axis=1, dtype='float')
-    row_ds = (datamtx**2).sum(axis=1, dtype='float') # these are d_a, etc
-    
-    for i in range(numrows):
-        if row_ds[i] !=0.:
-            row_ds[i] = row_ds[i] / rowsums[i]**2
-    # this leaves row_ds zero if actually 0/0
-    for i in range(numrows):
-        row1 = datamtx[i]
-        N1 = rowsums[i]
-        d1 = row_ds[i]
-        for j in range(i):
-            row2 = datamtx[j]
-            N2 = rowsums[j]
-            d2 = row_ds[j]
-            if N2 == 0.0 and N1==0.0:
-                dist = 0.0
-            elif N2 == 0.0 or N1==0.0:
-                dist = 1.0
-            else:
-            # d's zero only if N's zero, and we already checked for that
-                similarity = 2*sum(row1*row2)
-                similarity = similarity / ( (d1 + d2) * N1 * N2 )
-                dist = 1 - similarity
-            dists[i][j] = dists[j][i] = dist
-    return dists
+    return _square(_dists(datamtx, dist_morisita_horn, strict))
 
 def dist_pearson(datamtx, strict=True):
     """ Calculates pearson distance (1-r) between rows
@@ -839,50 +953,7 @@ def dist_pearson(datamtx, strict=True):
     If rank of input data is < 2, returns an empty 2d array (shape:
     (0, 0) ).  If 0 rows or 0 colunms, also returns an empty 2d array.
     """
-    if strict:
-        if not all(isfinite(datamtx)):
-            raise ValueError("non finite number in input matrix")
-        if rank(datamtx) != 2:
-            raise ValueError("input matrix not 2D")
-        numrows, numcols = shape(datamtx)
-    else:
-        try:
-            numrows, numcols = shape(datamtx)
-        except ValueError:
-            return zeros((0,0),'d')
-
-    if numrows == 0 or numcols == 0:
-        return zeros((0,0),'d')
-
-    rowmeans =  mean(datamtx, axis=1)
-    rowstds =  std(datamtx, axis=1)
-
-    dists = zeros((numrows,numrows),'d')
-    n = float(numrows)
-
-    for i in range(numrows):
-        r1 = datamtx[i,:]
-        r1m = rowmeans[i]
-        r1dev = r1 - r1m
-        for j in range(i):
-            r2 = datamtx[j,:]
-            r2m = rowmeans[j]
-            r2dev = r2 - r2m
-            top = sum(r1dev*r2dev)
-            sum1 = sum(r1dev**2)
-            sum2 = sum(r2dev**2)
-
-            if (sum1 == 0.0 and sum2 == 0.0):
-                r = 1.0
-            elif (sum1 == 0.0 or sum2 == 0.0):
-                r = 0.0
-            else:
-                bottom = sqrt(sum1 * sum2)
-                r = top/bottom
-                
-            dists[i][j] = dists[j][i] = 1.0 - r
-            
-    return dists
+    return _square(_dists(datamtx, dist_pearson, strict))
 
 def dist_soergel(datamtx, strict=True):
     """ Calculate soergel distance between rows of a matrix
@@ -903,35 +974,7 @@ def dist_soergel(datamtx, strict=True):
     entries.  If rank of input data is < 2, returns an empty 2d array (shape:
     (0, 0) ).  If 0 rows or 0 colunms, also returns an empty 2d array.
     """
-    if strict:
-        if not all(isfinite(datamtx)):
-            raise ValueError("non finite number in input matrix")
-        if any(datamtx<0.0):
-            raise ValueError("negative value in input matrix")
-        if rank(datamtx) != 2:
-            raise ValueError("input matrix not 2D")
-        numrows, numcols = shape(datamtx)
-    else:
-        try:
-            numrows, numcols = shape(datamtx)
-        except ValueError:
-            return zeros((0,0),'d')
-
-    if numrows == 0 or numcols == 0:
-        return zeros((0,0),'d')
-    dists = zeros((numrows,numrows),'d')
-    for i in range(numrows):
-        r1 = datamtx[i,:]
-        for j in range(i):
-            r2 = datamtx[j,:]
-            top = float(sum(abs(r1 - r2)))
-            bot = float(sum(where(r1>r2, r1,r2)))
-            if bot <= 0.0:
-                cur_d = 0.0
-            else:
-                cur_d = top/bot
-            dists[i][j] = dists[j][i] = cur_d
-    return dists
+    return _square(_dists(datamtx, dist_soergel, strict))
 
 def dist_spearman_approx(datamtx, strict=True):
     """ Calculate spearman rank distance (1-r) using an approximation formula
@@ -955,39 +998,7 @@ def dist_spearman_approx(datamtx, strict=True):
     If rank of input data is < 2, returns an empty 2d array (shape:
     (0, 0) ).  If 0 rows or 0 colunms, also returns an empty 2d array.
     """
-    if strict:
-        if not all(isfinite(datamtx)):
-            raise ValueError("non finite number in input matrix")
-        if rank(datamtx) != 2:
-            raise ValueError("input matrix not 2D")
-        numrows, numcols = shape(datamtx)
-        if numcols < 2:
-            raise ValueError("input matrix has < 2 colunms")
-    else:
-        try:
-            numrows, numcols = shape(datamtx)
-        except ValueError:
-            return zeros((0,0),'d')
-
-    if numrows == 0 or numcols == 0:
-        return zeros((0,0),'d')
-    dists = zeros((numrows,numrows),'d')
-    
-    if numcols < 2:
-        return dists # formula fails for < 2 elements per row
-    
-    for i in range(numrows):
-        r1 = datamtx[i,:]
-        rank1 = _rankdata(r1)
-        for j in range(i):
-            r2 = datamtx[j,:]
-            rank2 = _rankdata(r2)
-            rankdiff = rank1 - rank2
-            dsqsum = sum((rankdiff)**2)
-            dist = 6*dsqsum / float(numcols*(numcols**2-1))
-            
-            dists[i][j] = dists[j][i] = dist
-    return dists
+    return _square(_dists(datamtx, dist_spearman_approx, strict))
 
 def dist_specprof(datamtx, strict=True):
     """returns a row-row species profile distance matrix
@@ -1005,38 +1016,7 @@ def dist_specprof(datamtx, strict=True):
     entries.  If rank of input data is < 2, returns an empty 2d array (shape:
     (0, 0) ).  If 0 rows or 0 colunms, also returns an empty 2d array.
     """
-    if strict:
-        if not all(isfinite(datamtx)):
-            raise ValueError("non finite number in input matrix")
-        if any(datamtx<0.0):
-            raise ValueError("negative value in input matrix")
-        if rank(datamtx) != 2:
-            raise ValueError("input matrix not 2D")
-        numrows, numcols = shape(datamtx)
-    else:
-        try:
-            numrows, numcols = shape(datamtx)
-        except ValueError:
-            return zeros((0,0),'d')
-
-    if numrows == 0 or numcols == 0:
-        return zeros((0,0),'d')
-    dists = zeros((numrows,numrows),'d')
-    for i in range(numrows):
-        r1 = datamtx[i]
-        r1sum = sum(r1)
-        for j in range(i):
-            r2 = datamtx[j]
-            r2sum = sum(r2)
-            if r1sum == 0.0 or r2sum == 0.0:
-                if r1sum == 0.0 and r2sum == 0.0:
-                    dist = 0.0
-                else: dist = 1.0
-            else:
-                dist = norm((r1/r1sum) - (r2/r2sum))
-            dists[i,j] = dists[j,i] = dist
-
-    return dists
+    return _square(_dists(datamtx, dist_specprof, strict))
 
 def binary_dist_otu_gain(otumtx):
     """ Calculates number of new OTUs observed in sample A wrt sample B
@@ -1063,9 +1043,7 @@ def binary_dist_chisq(datamtx, strict=True):
 
     converts input array to bool, then uses dist_chisq
     """
-    datamtx = datamtx.astype(bool)
-    datamtx = datamtx.astype(float)
-    return dist_chisq(datamtx, strict=True)
+    return _square(_dists(datamtx, binary_dist_chisq, True))
 
 def binary_dist_chord(datamtx, strict=True):
     """Calculates binary chord dist between rows, returns dist matrix.
@@ -1073,9 +1051,7 @@ def binary_dist_chord(datamtx, strict=True):
     converts input array to bool, then uses dist_chisq
     for binary data, this is identical to a binary hellinger distance
     """
-    datamtx = datamtx.astype(bool)
-    datamtx = datamtx.astype(float)
-    return dist_chord(datamtx, strict=True)
+    return _square(_dists(datamtx, binary_dist_chord, True))
 
 def binary_dist_sorensen_dice(datamtx, strict=True):
     """Calculates Sorensen-Dice distance btw rows, returning distance matrix.
@@ -1104,46 +1080,14 @@ def binary_dist_sorensen_dice(datamtx, strict=True):
     * negative input values are not allowed - will return nonsensical results 
     and/or throw errors
     """
-    datamtx = datamtx.astype(bool)
-    datamtx = datamtx.astype(float)
-    if strict:
-        if not all(isfinite(datamtx)):
-            raise ValueError("non finite number in input matrix")
-        if any(datamtx<0.0):
-            raise ValueError("negative value in input matrix")
-        if rank(datamtx) != 2:
-            raise ValueError("input matrix not 2D")
-        numrows, numcols = shape(datamtx)
-    else:
-        try:
-            numrows, numcols = shape(datamtx)
-        except ValueError:
-            return zeros((0,0),'d')
-
-    if numrows == 0 or numcols == 0:
-        return zeros((0,0),'d')
-    dists = zeros((numrows,numrows),'d')
-    rowsums = datamtx.sum(axis=1)
-    
-    for i in range(numrows):
-        row1 = datamtx[i]
-        for j in range(i):
-            row2 = datamtx[j]
-            bottom = float(rowsums[i] + rowsums[j])
-            cur_d = 0.0
-            if bottom:
-                cur_d = 1-(2*logical_and(row1,row2).sum()/bottom)
-            dists[i][j] = dists[j][i] = cur_d
-    return dists
+    return _square(_dists(datamtx, binary_dist_sorensen_dice, strict))
 
 def binary_dist_euclidean(datamtx, strict=True):
     """Calculates binary euclidean distance between rows, returns dist matrix.
 
     converts input array to bool, then uses dist_euclidean
     """
-    datamtx = datamtx.astype(bool)
-    datamtx = datamtx.astype(float)
-    return dist_euclidean(datamtx, strict=True)
+    return _square(_dists(datamtx, binary_dist_euclidean, True))
 
 def binary_dist_hamming(datamtx, strict=True):
     """Calculates hamming distance btw rows, returning distance matrix.
@@ -1171,38 +1115,8 @@ def binary_dist_hamming(datamtx, strict=True):
     entries.  If rank of input data is < 2, returns an empty 2d array (shape:
     (0, 0) ).  If 0 rows or 0 colunms, also returns an empty 2d array.
     """
-    datamtx = datamtx.astype(bool)
-    datamtx = datamtx.astype(float)
-    if strict:
-        if not all(isfinite(datamtx)):
-            raise ValueError("non finite number in input matrix")
-        if any(datamtx<0.0):
-            raise ValueError("negative value in input matrix")
-        if rank(datamtx) != 2:
-            raise ValueError("input matrix not 2D")
-        numrows, numcols = shape(datamtx)
-    else:
-        try:
-            numrows, numcols = shape(datamtx)
-        except ValueError:
-            return zeros((0,0),'d')
+    return _square(_dists(datamtx, binary_dist_hamming, strict))
 
-    if numrows == 0 or numcols == 0:
-        return zeros((0,0),'d')
-    dists = zeros((numrows,numrows),'d')
-    rowsums = datamtx.sum(axis=1)
-    
-    for i in range(numrows):
-        first = datamtx[i]
-        a = rowsums[i]
-        for j in range(i):
-            second = datamtx[j]
-            b = rowsums[j]
-            c = float(logical_and(first, second).sum())
-            dist = a + b - (2.0*c)
-            dists[i][j] = dists[j][i] = dist
-    return dists
-    
 def binary_dist_jaccard(datamtx, strict=True):
     """Calculates jaccard distance between rows, returns distance matrix.
 
@@ -1229,40 +1143,7 @@ def binary_dist_jaccard(datamtx, strict=True):
     entries.  If rank of input data is < 2, returns an empty 2d array (shape:
     (0, 0) ).  If 0 rows or 0 colunms, also returns an empty 2d array.
     """
-    datamtx = datamtx.astype(bool)
-    datamtx = datamtx.astype(float)
-    if strict:
-        if not all(isfinite(datamtx)):
-            raise ValueError("non finite number in input matrix")
-        if any(datamtx<0.0):
-            raise ValueError("negative value in input matrix")
-        if rank(datamtx) != 2:
-            raise ValueError("input matrix not 2D")
-        numrows, numcols = shape(datamtx)
-    else:
-        try:
-            numrows, numcols = shape(datamtx)
-        except ValueError:
-            return zeros((0,0),'d')
-
-    if numrows == 0 or numcols == 0:
-        return zeros((0,0),'d')
-    dists = zeros((numrows,numrows),'d')
-    
-    rowsums = datamtx.sum(axis=1)
-    for i in range(numrows):
-        first = datamtx[i]
-        a = rowsums[i]
-        for j in range(i):
-            second = datamtx[j]
-            b = rowsums[j]
-            c = float(logical_and(first, second).sum())
-            if a==0.0 and b==0.0:
-                dist = 0.0
-            else:
-                dist = 1.0 - (c/(a+b-c))
-            dists[i][j] = dists[j][i] = dist
-    return dists
+    return _square(_dists(datamtx, binary_dist_jaccard, strict))
 
 def binary_dist_lennon(datamtx, strict=True):
     """Calculates lennon distance between rows, returns distance matrix.
@@ -1290,42 +1171,7 @@ def binary_dist_lennon(datamtx, strict=True):
     entries.  If rank of input data is < 2, returns an empty 2d array (shape:
     (0, 0) ).  If 0 rows or 0 colunms, also returns an empty 2d array.
     """
-    datamtx = datamtx.astype(bool)
-    datamtx = datamtx.astype(float)
-    if strict:
-        if not all(isfinite(datamtx)):
-            raise ValueError("non finite number in input matrix")
-        if any(datamtx<0.0):
-            raise ValueError("negative value in input matrix")
-        if rank(datamtx) != 2:
-            raise ValueError("input matrix not 2D")
-        numrows, numcols = shape(datamtx)
-    else:
-        try:
-            numrows, numcols = shape(datamtx)
-        except ValueError:
-            return zeros((0,0),'d')
-
-    if numrows == 0 or numcols == 0:
-        return zeros((0,0),'d')
-    dists = zeros((numrows,numrows),'d')
-    
-    rowsums = datamtx.sum(axis=1)
-    for i in range(numrows):
-        first = datamtx[i]
-        a = rowsums[i]
-        for j in range(i):
-            second = datamtx[j]
-            b = rowsums[j]
-            c = float(logical_and(first, second).sum())
-            if a==0.0 and b==0.0:
-                dist = 0.0
-            elif c==0.0:
-                dist = 1.0
-            else:
-                dist = 1.0 - (c/(c + min([a-c,b-c])))
-            dists[i][j] = dists[j][i] = dist
-    return dists
+    return _square(_dists(datamtx, binary_dist_lennon, strict))
 
 def binary_dist_ochiai(datamtx, strict=True):
     """Calculates ochiai distance btw rows, returning distance matrix.
@@ -1353,52 +1199,68 @@ def binary_dist_ochiai(datamtx, strict=True):
     entries.  If rank of input data is < 2, returns an empty 2d array (shape:
     (0, 0) ).  If 0 rows or 0 colunms, also returns an empty 2d array.
     """
-    datamtx = datamtx.astype(bool)
-    datamtx = datamtx.astype(float)
-    if strict:
-        if not all(isfinite(datamtx)):
-            raise ValueError("non finite number in input matrix")
-        if any(datamtx<0.0):
-            raise ValueError("negative value in input matrix")
-        if rank(datamtx) != 2:
-            raise ValueError("input matrix not 2D")
-        numrows, numcols = shape(datamtx)
-    else:
-        try:
-            numrows, numcols = shape(datamtx)
-        except ValueError:
-            return zeros((0,0),'d')
+    return _square(_dists(datamtx, binary_dist_ochiai, strict))
 
-    if numrows == 0 or numcols == 0:
-        return zeros((0,0),'d')
-    dists = zeros((numrows,numrows),'d')
-    rowsums = datamtx.sum(axis=1)
-    
-    for i in range(numrows):
-        first = datamtx[i]
-        a = rowsums[i]
-        for j in range(i):
-            second = datamtx[j]
-            b = rowsums[j]
-            c = float(logical_and(first, second).sum())
-            if a==0.0 and b==0.0:
-                dist = 0.0
-            elif a==0.0 or b==0.0:
-                dist = 1.0
-            else:
-                dist = 1.0 - (c/sqrt(a*b))
-            dists[i][j] = dists[j][i] = dist
-    return dists
-    
 def binary_dist_pearson(datamtx, strict=True):
     """Calculates binary pearson distance between rows, returns distance matrix
 
     converts input array to bool, then uses dist_pearson
     """
-
-    datamtx = datamtx.astype(bool)
-    datamtx = datamtx.astype(float)
-    return dist_pearson(datamtx, strict=True)
+    return _square(_dists(datamtx, binary_dist_pearson, True))
+
+_DIST_BLOCKS = {
+    # metric: (blocks of distances, no negative values, binary)
+    dist_bray_curtis: (_bray_curtis_blocks, True, False),
+    dist_bray_curtis_magurran: (_bray_curtis_magurran_blocks, True, False),
+    dist_canberra: (_canberra_blocks, True, False),
+    dist_chisq: (_chisq_blocks, True, False),
+    dist_chord: (_chord_blocks, False, False),
+    dist_euclidean: (_euclidean_blocks, False, False),
+    dist_gower: (_gower_blocks, False, False),
+    dist_hellinger: (_hellinger_blocks, True, False),
+    dist_kulczynski: (_kulczynski_blocks, True, False),
+    dist_manhattan: (_manhattan_blocks, False, False),
+    dist_abund_jaccard: (_abund_jaccard_blocks, True, False),
+    dist_morisita_horn: (_morisita_horn_blocks, True, False),
+    dist_pearson: (_pearson_blocks, False, False),
+    dist_soergel: (_soergel_blocks, True, False),
+    dist_spearman_approx: (_spearman_approx_blocks, False, False),
+    dist_specprof: (_specprof_blocks, True, False),
+    binary_dist_chisq: (_chisq_blocks, True, True),
+    binary_dist_chord: (_chord_blocks, False, True),
+    binary_dist_sorensen_dice: (_binary_blocks(_sorensen_dice), True, True),
+    binary_dist_euclidean: (_euclidean_blocks, False, True),
+    binary_dist_hamming: (_binary_blocks(_hamming), True, True),
+    binary_dist_jaccard: (_binary_blocks(_jaccard), True, True),
+    binary_dist_lennon: (_binary_blocks(_lennon), True, True),
+    binary_dist_ochiai: (_binary_blocks(_ochiai), True, True),
+    binary_dist_pearson: (_pearson_blocks, False, True),
+    }
+
+def condensed_dists(datamtx, metric=dist_euclidean, strict=True, out=None,
+        block_size=2**22):
+    """returns the distances between rows as a condensed distance matrix
+
+    result[numrows*i - i*(i+1)/2 + j - i - 1] is metric(datamtx)[i,j] for
+    rows i < j, the upper triangle of the distance matrix row by row, as
+    from scipy.spatial.distance.pdist.
+
+    * datamtx: as for metric, or a sparse matrix with a tocsr() method (e.g.
+    from scipy.sparse).  Sparse data is never made dense, and only the
+    values shared by two rows are paired.
+    * metric: a dist_ or binary_dist_ function of this module
+    * strict: as for metric
+    * out: a vector of numrows*(numrows-1)/2 floats to write the result to,
+    e.g. a numpy.memmap, rather than a new array.
+    * block_size: about how many distances (and pairs of shared values) to
+    calculate at once.  Blocks of rows are calculated by parallel.imap, so
+    in parallel within a parallel.parallel_context.
+    * if metric would return an empty 2d array, returns an empty vector.
+    """
+    result = _dists(datamtx, metric, strict, out, block_size)
+    if result is None:
+        return zeros(0,'d')
+    return result[1]
 
 
 if __name__ == "__main__":
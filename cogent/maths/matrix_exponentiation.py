@@ -9,10 +9,13 @@
 # SemiSym    slow           fast           mprobs > 0
 # Pade       instant        slow
 # Taylor     instant        very slow
+#
+# P matrices are remembered in PSUB_CACHE, so a repeated (Q, t) is free.
 
 from cogent.util.modules import importVersionedModule, ExpectedImportError
 import warnings
 import numpy
+from collections import deque
 from numpy.linalg import inv, eig, solve, LinAlgError
 
 __author__ = "Peter Maxwell"
@@ -24,13 +27,91 @@ __maintainer__ = "Gavin Huttley"
 __email__ = "gavin.huttley@anu.edu.au"
 __status__ = "Production"
 
+class ExponentiatorCache(object):
+    """Recently used P matrices, keyed on the contents of the Q which made
+    them (so shared by all the edges with the same Q) and t.  When more
+    than max_bytes are held the least recently used are dropped.  The
+    hits and misses counters are for assessing how useful it is.  Cached
+    matrices are shared so they are made read-only, and exponentiators
+    return copies of them."""
+    
+    def __init__(self, max_bytes=2**26):
+        self.max_bytes = max_bytes
+        # key -> (tick of last use, P), with the (tick, key) of each use
+        # oldest first.  Uses superseded by a later one are skipped.
+        self._cache = {}
+        self._uses = deque()
+        self.clear()
+    
+    def clear(self):
+        self._cache.clear()
+        self._uses.clear()
+        self._tick = 0
+        self.nbytes = 0
+        self.hits = self.misses = 0
+    
+    def __len__(self):
+        return len(self._cache)
+    
+    def setMaxBytes(self, max_bytes):
+        """Change the size limit, 0 disabling the cache"""
+        self.max_bytes = max_bytes
+        self._evict()
+    
+    def _evict(self):
+        while self.nbytes > self.max_bytes and self._cache:
+            (tick, key) = self._uses.popleft()
+            if self._cache[key][0] == tick:
+                (tick, P) = self._cache.pop(key)
+                self.nbytes -= P.nbytes + len(key[0][-1])
+    
+    def _use(self, key, P):
+        self._tick += 1
+        self._cache[key] = (self._tick, P)
+        self._uses.append((self._tick, key))
+        if len(self._uses) > 2 * len(self._cache) + 16:
+            # drop the superseded uses
+            self._uses = deque(sorted((tick, key)
+                    for (key, (tick, P)) in self._cache.items()))
+    
+    def __call__(self, exponentiator, t):
+        """exponentiator(t), remembered"""
+        if not self.max_bytes:
+            return exponentiator._exponentiate(t)
+        # From Q as it is now, in case it has been changed in place
+        Q = numpy.asarray(exponentiator.Q)
+        q_key = (type(exponentiator), Q.shape, Q.dtype.char, Q.tostring())
+        key = (q_key, float(t))
+        if key in self._cache:
+            self.hits += 1
+            P = self._cache[key][1]
+            self._use(key, P)
+        else:
+            self.misses += 1
+            P = exponentiator._exponentiate(t)
+            P.flags.writeable = False
+            self.nbytes += P.nbytes + len(key[0][-1])
+            self._use(key, P)
+            self._evict()
+        return P
+    
+
+PSUB_CACHE = ExponentiatorCache()
+
 class _Exponentiator(object):
     def __init__(self, Q):
         self.Q = Q
     
+    def __call__(self, t=1.0):
+        return PSUB_CACHE(self, t).copy()
+    
     def __repr__(self):
         return "%s(%s)" % (self.__class__.__name__, repr(self.Q))
     
+    def derivative(self, t=1.0):
+        """dP/dt at t, ie: Q*exp(Q*t)"""
+        return numpy.dot(self.Q, self(t))
+    
 
 class EigenExponentiator(_Exponentiator):
     """A matrix ready for fast exponentiation.  P=exp(Q*t)"""
@@ -44,7 +125,7 @@ class EigenExponentiator(_Exponentiator):
         self.ev = ev
         self.roots = roots
     
-    def __call__(self, t):
+    def _exponentiate(self, t):
         exp_roots = numpy.exp(t*self.roots)
         result = numpy.inner(self.evT * exp_roots, self.evI)
         if result.dtype.kind == "c":
@@ -52,6 +133,14 @@ class EigenExponentiator(_Exponentiator):
         result = numpy.maximum(result, 0.0)
         return result
     
+    def derivative(self, t=1.0):
+        """dP/dt at t, reusing the eigen decomposition"""
+        exp_roots = self.roots * numpy.exp(t*self.roots)
+        result = numpy.inner(self.evT * exp_roots, self.evI)
+        if result.dtype.kind == "c":
+            result = numpy.asarray(result.real)
+        return result
+    
 
 def SemiSymmetricExponentiator(motif_probs, Q):
     """Like EigenExponentiator, but more numerically stable and
@@ -79,7 +168,7 @@ class TaylorExponentiator(_Exponentiator):
         self.Q = Q
         self.q = 21
     
-    def __call__(self, t=1.0):
+    def _exponentiate(self, t=1.0):
         """Compute the matrix exponential using a Taylor series of order q."""
         A = self.Q * t
         M = A.shape[0]
@@ -102,7 +191,7 @@ class PadeExponentiator(_Exponentiator):
     def __init__(self, Q):
         self.Q = Q
     
-    def __call__(self, t=1.0):
+    def _exponentiate(self, t=1.0):
         """Compute the matrix exponential using Pade approximation of order q.
         """
         A = self.Q * t
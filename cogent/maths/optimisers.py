@@ -6,7 +6,7 @@
 
 from cogent.util import progress_display as UI
 from simannealingoptimiser import SimulatedAnnealing
-from scipy_optimisers import DownhillSimplex, Powell
+from scipy_optimisers import DownhillSimplex, Powell, BFGS
 import warnings
 import numpy
 
@@ -108,13 +108,15 @@ def minimise(f, *args, **kw):
 def maximise(f, xinit, bounds=None, local=None, filename=None, interval=None,
         max_restarts=None, max_evaluations=None, limit_action='warn',
         tolerance=1e-6, global_tolerance=1e-1, ui=None,
-        return_eval_count=False,
+        return_eval_count=False, gradient=None,
         **kw):
     """Find input values that optimise this function.
     'local' controls the choice of optimiser, the default being to run
     both the global and local optimisers. 'filename' and 'interval'
-    control checkpointing.  Unknown keyword arguments get passed on to
-    the global optimiser.
+    control checkpointing.  If 'gradient', a function returning the
+    gradient of f at x, is given then the local optimiser is BFGS rather
+    than Powell.  Unknown keyword arguments get passed on to the global
+    optimiser.
     """
     do_global = (not local) or local is None
     do_local = local or local is None
@@ -169,7 +171,10 @@ def maximise(f, xinit, bounds=None, local=None, filename=None, interval=None,
         if do_local:
             callback = unsteadyProgressIndicator(ui.display, 'Local', gend, 1.0)
             #ui.display('local opt', 1.0-per_opt, per_opt)
-            opt = LocalOptimiser()
+            if gradient is None:
+                opt = LocalOptimiser()
+            else:
+                opt = BFGS(gradient, bounds)
             x = opt.maximise(f, x, tolerance=tolerance, 
                     max_restarts=max_restarts, show_remaining=callback)
     finally:
@@ -47,7 +47,9 @@ def bound_brent(func, brack=None, **kw):
 
 class _SciPyOptimiser(object):
     """This class is abstract.  Subclasses must provide a
-    _minimise(self, f, x) that can sanely handle +inf.
+    _minimise(self, f, x) that can sanely handle +inf, returning
+    (xopt, fval, iterations, func_calls, warnflag).  BFGS counts gradient
+    calls rather than iterations.
     
     Since these are local optimisers, we sometimes restart them to
     check the result is stable.  Cost is less than 2-fold slowdown"""
@@ -109,4 +111,107 @@ class DownhillSimplex(_SciPyOptimiser):
         return fmin(f, x, **kw)
     
 
+class _BoundsTransform(object):
+    """Maps unbounded optimiser coordinates y onto bounded x, sin() for
+    parameters with both bounds, sqrt() for one bound, as in MINUIT.
+    Bounds beyond +/-1e10 (the recalculation default) count as absent."""
+    
+    def __init__(self, bounds, size):
+        (lower, upper) = bounds or (None, None)
+        if lower is None:
+            lower = -numpy.inf
+        if upper is None:
+            upper = numpy.inf
+        lower = numpy.resize(numpy.asarray(lower, float), [size])
+        upper = numpy.resize(numpy.asarray(upper, float), [size])
+        lower = numpy.where(lower > -1e10, lower, -numpy.inf)
+        upper = numpy.where(upper < 1e10, upper, numpy.inf)
+        self.both = numpy.isfinite(lower) & numpy.isfinite(upper)
+        self.lower_only = numpy.isfinite(lower) & ~self.both
+        self.upper_only = numpy.isfinite(upper) & ~self.both
+        # stand-in values so the unused branches of numpy.where are finite
+        self._lower = numpy.where(numpy.isfinite(lower), lower, 0.0)
+        self._upper = numpy.where(numpy.isfinite(upper), upper, 1.0)
+        self._upper = numpy.where(self.both, self._upper, self._lower + 1.0)
+    
+    def toOptimiser(self, x):
+        (l, u) = (self._lower, self._upper)
+        # keep away from the bounds, where the gradient in y would be 0
+        x = numpy.clip(x, l + 1e-8 * (u-l), u - 1e-8 * (u-l))
+        y = numpy.array(x, float)
+        s = numpy.clip(2.0 * (x - l) / (u - l) - 1.0, -1.0, 1.0)
+        y = numpy.where(self.both, numpy.arcsin(s), y)
+        y = numpy.where(self.lower_only,
+                numpy.sqrt(numpy.maximum((x - l + 1.0)**2 - 1.0, 0.0)), y)
+        y = numpy.where(self.upper_only,
+                numpy.sqrt(numpy.maximum((u - x + 1.0)**2 - 1.0, 0.0)), y)
+        return y
+    
+    def __call__(self, y):
+        (l, u) = (self._lower, self._upper)
+        x = numpy.array(y, float)
+        x = numpy.where(self.both, l + (u - l) * (numpy.sin(y) + 1.0) / 2, x)
+        x = numpy.where(self.lower_only, l - 1.0 + numpy.sqrt(y*y + 1.0), x)
+        x = numpy.where(self.upper_only, u + 1.0 - numpy.sqrt(y*y + 1.0), x)
+        return x
+    
+    def derivative(self, y):
+        """dx/dy"""
+        (l, u) = (self._lower, self._upper)
+        d = numpy.ones(numpy.shape(y), float)
+        d = numpy.where(self.both, (u - l) * numpy.cos(y) / 2, d)
+        d = numpy.where(self.lower_only, y / numpy.sqrt(y*y + 1.0), d)
+        d = numpy.where(self.upper_only, -y / numpy.sqrt(y*y + 1.0), d)
+        return d
+    
+
+class BFGS(_SciPyOptimiser):
+    """Quasi-Newton optimiser, so needs 'gradient', a function giving the
+    gradient of the function being optimised.  'bounds' are (lower, upper)
+    arrays, respected by optimising transformed coordinates that can't
+    leave them.  'gtol' is the gradient norm at which it stops, separate
+    from the tolerance on changes in the function value."""
+    
+    def __init__(self, gradient, bounds=None, gtol=1e-5):
+        self.gradient = gradient
+        self.bounds = bounds
+        self.gtol = gtol
+    
+    def maximise(self, function, *args, **kw):
+        def nf(x):
+            return -1 * function(x)
+        def ngradient(x):
+            return -1 * numpy.asarray(self.gradient(x))
+        return BFGS(ngradient, self.bounds, self.gtol).minimise(nf,
+                *args, **kw)
+    
+    def _minimise(self, f, x, ftol, callback=None, **kw):
+        transform = _BoundsTransform(self.bounds, len(x))
+        def ft(y):
+            return f(transform(y))
+        def gt(y):
+            return numpy.asarray(self.gradient(transform(y))) * \
+                    transform.derivative(y)
+        last = [numpy.inf, numpy.inf]
+        def _callback(fcalls, y, fval):
+            if last[1] == numpy.inf:
+                delta = 1.0
+            else:
+                delta = last[1] - fval
+            last[:] = [last[1], fval]
+            if callback is not None:
+                callback(fcalls, transform(y), fval, delta)
+        (yopt, fval, gopt, Hopt, func_calls, grad_calls, warnflag) = \
+                fmin_bfgs(ft, transform.toOptimiser(x), fprime=gt,
+                gtol=self.gtol, callback=_callback, **kw)
+        # warnflag 2, no further progress possible along the search
+        # direction, is the usual way to finish on a noisy function, so
+        # is only worth a warning if the last step still changed f by
+        # more than ftol.
+        if warnflag == 2 and abs(last[0] - last[1]) <= ftol:
+            warnflag = 0
+        # gradient calls in place of the iterations the others return
+        return (transform(yopt), fval, grad_calls, func_calls, warnflag)
+    
+
 DefaultLocalOptimiser = Powell
@@ -3,8 +3,12 @@ from __future__ import division
 from cogent.maths.stats.special import lgam
 from cogent.maths.optimisers import minimise
 from math import ceil, e
-from numpy import array, zeros, concatenate, arange, log, sqrt, exp, asarray
+from numpy import array, zeros, concatenate, arange, log, sqrt, exp, asarray, \
+    unique, repeat, bincount, where, maximum, searchsorted, lexsort, \
+    seterr, nan
+from numpy.random import permutation, random
 from cogent.maths.scipy_optimize import fmin_powell
+from cogent.util.array import sparse_nonzero
 import cogent.maths.stats.rarefaction as rarefaction
 
 __author__ = "Rob Knight"
@@ -235,12 +239,15 @@ def michaelis_menten_fit(counts, num_repeats=1, params_guess=None,
 
     # observed # of species vs # of individuals sampled, S vs n
     xvals = arange(1,counts.sum()+1)
-    ymtx = []
+    # each subsample is a prefix of one shuffle per repeat, so the species
+    # observed by n are those whose first occurrence in it is before n
+    yvals = zeros(len(xvals))
     for i in range(num_repeats):
-        ymtx.append( array([observed_species(rarefaction.subsample(counts,n)) \
-        for n in xvals]))
-    ymtx = asarray(ymtx)
-    yvals = ymtx.mean(0)
+        permuted = permutation(rarefaction.expand_counts(counts))
+        firsts = zeros(len(permuted), int)
+        firsts[unique(permuted, return_index=True)[1]] = 1
+        yvals += firsts.cumsum()
+    yvals /= num_repeats
     
     # fit to obs_sp = max_sp * num_idiv / (num_indiv + B)
     # return max_sp
@@ -493,3 +500,307 @@ def diversity(indices,f=chao1,step=1,start=None,verbose=False):
         i=j
     return array(result)
 
+
+class _CountRows(object):
+    """The nonzero counts in each row of a samples x species table.
+
+    data can be a dense 2D array or a sparse matrix with a tocsr() method,
+    e.g. from scipy.sparse, which is used without being made dense.  The
+    counts are kept as parallel vectors of row, col and value, grouped by
+    row, so that sums over each row are a bincount.
+    """
+    def __init__(self, data):
+        if hasattr(data, 'tocsr'):
+            ((self.num_rows, self.num_cols), self.row, self.col,
+                self.values) = sparse_nonzero(data)
+        else:
+            data = asarray(data)
+            (self.num_rows, self.num_cols) = data.shape
+            (self.row, self.col) = data.nonzero()
+            self.values = data[self.row, self.col]
+        self.n = self.sum(self.values)
+        self.observed = bincount(self.row, minlength=self.num_rows)
+
+    def sum(self, values):
+        """Returns the sum of values (one per count) in each row."""
+        return bincount(self.row, values.astype(float),
+            minlength=self.num_rows)
+
+    def count(self, selected):
+        """Returns the number of selected (one per count) in each row."""
+        return bincount(self.row[selected], minlength=self.num_rows)
+
+    def max(self, values):
+        """Returns the largest of values (one per count) in each row."""
+        result = zeros(self.num_rows)
+        nonempty = self.observed > 0
+        result[nonempty] = maximum.reduceat(values, self.starts()[nonempty])
+        return result
+
+    def starts(self):
+        """Returns the index of the first count of each row."""
+        return searchsorted(self.row, arange(self.num_rows))
+
+    def within_sum(self, values):
+        """Returns the cumulative sum of values (one per count) within
+        each row."""
+        total = values.cumsum()
+        return total - (total - values)[self.starts()[self.row]]
+
+    def sorted(self):
+        """Returns the counts of each row in increasing order."""
+        return self.values[lexsort((self.values, self.row))]
+
+    def toarray(self):
+        """Returns the counts as a dense array."""
+        result = zeros((self.num_rows, self.num_cols), self.values.dtype)
+        result[self.row, self.col] = self.values
+        return result
+
+def _lgam(values):
+    """lgam of each of values, calling lgam once per distinct value."""
+    (distinct, index) = unique(values, return_inverse=True)
+    return array(map(lgam, distinct), float)[index]
+
+def _shannon_rows(rows, base=2):
+    freqs = rows.values / rows.n[rows.row]
+    return -rows.sum(freqs*log(freqs))/log(base)
+
+def _dominance_rows(rows):
+    return rows.sum(rows.values**2) / rows.n**2
+
+def _simpson_rows(rows):
+    return 1 - _dominance_rows(rows)
+
+def _reciprocal_simpson_rows(rows):
+    return 1.0/_simpson_rows(rows)
+
+def _singles_rows(rows):
+    return rows.count(rows.values == 1)
+
+def _doubles_rows(rows):
+    return rows.count(rows.values == 2)
+
+def _osd_rows(rows):
+    return rows.observed, _singles_rows(rows), _doubles_rows(rows)
+
+def _kempton_taylor_q_rows(rows, lower_quantile=.25, upper_quantile=.75):
+    n = rows.num_cols
+    lower = int(ceil(n*lower_quantile))
+    upper = int(n*upper_quantile)
+    # sorted rows start with their zeros, then the sorted counts
+    ordered = rows.sorted()
+    starts = rows.starts() - (n - rows.observed)
+    def quantile(i):
+        present = i >= n - rows.observed
+        return where(present, ordered[where(present, starts+i, 0)], 0)
+    lowest = quantile(lower)
+    # no slope to estimate if the lower quantile is of unobserved species
+    return where(lowest > 0, (upper-lower)/log(quantile(upper)/lowest), nan)
+
+def _strong_rows(rows):
+    order = lexsort((-rows.values, rows.row))
+    ordered = rows.values[order].astype(float)
+    starts = rows.starts()[rows.row]
+    sorted_sum = rows.within_sum(ordered)
+    i = arange(1, len(ordered)+1) - starts
+    # beyond the observed species the differences only decrease
+    return rows.max(sorted_sum/rows.n[rows.row] - i/rows.observed[rows.row])
+
+def _fisher_alpha_rows(rows, bounds=(1e-3,1e12)):
+    n = rows.n
+    s = rows.observed
+    # alpha*log(1+n/alpha) increases with alpha, so bisect for s
+    lower = zeros(rows.num_rows) + log(bounds[0])
+    upper = zeros(rows.num_rows) + log(bounds[1])
+    for i in range(100):
+        middle = (lower + upper) / 2
+        alpha = exp(middle)
+        too_big = alpha * log(1 + (n/alpha)) > s
+        upper = where(too_big, middle, upper)
+        lower = where(too_big, lower, middle)
+    alpha = exp((lower + upper) / 2)
+    # undefined for empty rows, rather than not converging
+    alpha[n == 0] = nan
+    if ((alpha * log(1 + (n/alpha)) - s)**2 > 1.0).any():
+        raise RuntimeError("optimizer failed to converge (error > 1.0)," +\
+            " so no fisher alpha returned")
+    return alpha
+
+def _chao1_rows(rows, bias_corrected=True):
+    o, s, d = _osd_rows(rows)
+    uncorrected = (not bias_corrected) & (s > 0) & (d > 0)
+    return where(uncorrected, o + s**2/(2.0*where(d, d, 1)),
+        o + s*(s-1)/(2.0*(d+1)))
+
+def _chao1_var_rows(rows, bias_corrected=True):
+    o, s, d = _osd_rows(rows)
+    s, d = s.astype(float), d.astype(float)
+    chao = _chao1_rows(rows, bias_corrected)
+    no_doubletons = s*(s-1)/2 + s*(2*s-1)**2/4 - s**4/(4*chao)
+    no_singletons = o*exp(-rows.n/o)*(1-exp(-rows.n/o))
+    if bias_corrected:
+        both = s*(s-1)/(2*(d+1)) + (s*(2*s-1)**2)/(4*(d+1)**2) + \
+            (s**2 * d * (s-1)**2)/(4*(d+1)**4)
+    else:
+        r = s/d
+        both = d*(.5*r**2 + r**3 + .24*r**4)
+    return where(d == 0, no_doubletons, where(s == 0, no_singletons, both))
+
+def _chao1_confidence_rows(rows, bias_corrected=True, zscore=1.96):
+    o, s, d = _osd_rows(rows)
+    chao = _chao1_rows(rows, bias_corrected)
+    var_chao = _chao1_var_rows(rows, bias_corrected)
+    T = chao - o
+    K = exp(abs(zscore)*sqrt(log(1+(var_chao/T**2))))
+    lower = where(T == 0, o, o + T/K)
+    upper = where(T == 0, o, o + T*K)
+    # no singletons
+    P = exp(-rows.n/o)
+    k = zscore*sqrt(o*P/(1-P))
+    lower = where(s, lower, maximum(o, o/(1-P) - k))
+    upper = where(s, upper, o/(1-P) + k)
+    return lower, upper
+
+def _ACE_rows(rows, rare_threshold=10):
+    values = rows.values
+    singletons = _singles_rows(rows)
+    rare = values <= rare_threshold
+    s_rare = rows.count(rare)
+    s_abun = rows.count(~rare)
+    # as ACE, which checks for rare species below rare_threshold
+    below = rows.count(values < rare_threshold)
+    if ((below > 0) & (singletons == below)).any():
+        raise ValueError("only rare species are singletons, ACE "+\
+            "metric is undefined. EstimateS suggests using bias corrected Chao1")
+    n_rare = rows.sum(where(rare, values, 0))
+    c_ace = 1 - singletons/n_rare
+    top = s_rare*rows.sum(where(rare, values*(values-1), 0))
+    bottom = c_ace*n_rare*(n_rare-1.0)
+    gamma_ace = maximum(top/bottom - 1.0, 0)
+    result = s_abun + (s_rare/c_ace) + ((singletons/c_ace)*gamma_ace)
+    return where(below == 0, s_abun, result)
+
+def _michaelis_menten_fit_rows(rows, num_repeats=1, params_guess=None,
+    return_b=False, block_size=2**22):
+    if params_guess is not None:
+        raise ValueError("params_guess can't be used by diversity_matrix, "+\
+            "which fits B with a bounded search")
+    # for each B the least squares Smax is sum(y*h)/sum(h*h), where
+    # h = n/(B+n), so only B is searched for, in all rows at once
+    smax = zeros(rows.num_rows)
+    b = zeros(rows.num_rows)
+    totals = rows.n.astype(int)
+    starts = concatenate([[0], totals.cumsum()])
+    first = 0
+    while first < rows.num_rows:
+        last = max(first+1, searchsorted(starts, starts[first]+block_size,
+            side='right') - 1)
+        last = min(last, rows.num_rows)
+        in_block = (rows.row >= first) & (rows.row < last)
+        reads = repeat(rows.row[in_block] - first,
+            rows.values[in_block].astype(int))
+        species = repeat(rows.col[in_block], rows.values[in_block].astype(int))
+        read_starts = starts[first:last] - starts[first]
+        xvals = arange(len(reads)) - read_starts[reads] + 1.0
+        yvals = zeros(len(reads))
+        for i in range(num_repeats):
+            shuffled = species[lexsort((random(len(reads)), reads))]
+            firsts = zeros(len(reads))
+            firsts[unique(reads * rows.num_cols + shuffled,
+                return_index=True)[1]] = 1
+            observed = firsts.cumsum()
+            yvals += observed - (observed - firsts)[read_starts[reads]]
+        yvals /= num_repeats
+        def score(log_b):
+            h = xvals / (exp(log_b)[reads] + xvals)
+            yh = bincount(reads, yvals*h, minlength=last-first)
+            hh = bincount(reads, h*h, minlength=last-first)
+            return yh, hh, yh*yh/hh
+        lower = zeros(last-first) + log(1e-6)
+        upper = log(1e6 * (totals[first:last] + 1.0))
+        ratio = (sqrt(5) - 1) / 2
+        for i in range(100):
+            left = upper - ratio*(upper - lower)
+            right = lower + ratio*(upper - lower)
+            better_left = score(left)[2] > score(right)[2]
+            upper = where(better_left, right, upper)
+            lower = where(better_left, lower, left)
+        log_b = (lower + upper) / 2
+        yh, hh, ignore = score(log_b)
+        smax[first:last] = yh/hh
+        b[first:last] = exp(log_b)
+        first = last
+    if return_b:
+        return array([smax, b]).T
+    return smax
+
+_ROWS_FUNCTIONS = {
+    observed_species: lambda rows: rows.observed,
+    singles: _singles_rows,
+    doubles: _doubles_rows,
+    osd: _osd_rows,
+    margalef: lambda rows: (rows.observed-1)/log(rows.n),
+    menhinick: lambda rows: rows.observed/sqrt(rows.n),
+    dominance: _dominance_rows,
+    simpson: _simpson_rows,
+    reciprocal_simpson: _reciprocal_simpson_rows,
+    simpson_reciprocal: lambda rows: 1.0/_dominance_rows(rows),
+    shannon: _shannon_rows,
+    equitability: lambda rows, base=2: _shannon_rows(rows, base) /
+        (log(rows.observed)/log(base)),
+    berger_parker_d: lambda rows: rows.max(rows.values)/rows.n,
+    mcintosh_d: lambda rows: (rows.n - sqrt(rows.sum(rows.values**2))) /
+        (rows.n - sqrt(rows.n)),
+    brillouin_d: lambda rows: (_lgam(rows.n+1) -
+        rows.sum(_lgam(rows.values+1)))/rows.n,
+    kempton_taylor_q: _kempton_taylor_q_rows,
+    strong: _strong_rows,
+    fisher_alpha: _fisher_alpha_rows,
+    mcintosh_e: lambda rows: sqrt(rows.sum(rows.values**2)) /
+        sqrt((rows.n-rows.observed+1)**2 + rows.observed - 1),
+    heip_e: lambda rows: exp(_shannon_rows(rows, base=e)-1) /
+        (rows.observed-1),
+    simpson_e: lambda rows: _reciprocal_simpson_rows(rows)/rows.observed,
+    robbins: lambda rows: _singles_rows(rows)/rows.n,
+    robbins_confidence: lambda rows, alpha=0.05: (
+        (_singles_rows(rows) - sqrt((rows.n+1)/alpha))/(rows.n+1),
+        (_singles_rows(rows) + sqrt((rows.n+1)/alpha))/(rows.n+1)),
+    chao1: _chao1_rows,
+    chao1_var: _chao1_var_rows,
+    chao1_confidence: _chao1_confidence_rows,
+    chao1_lower: lambda rows, **kw: _chao1_confidence_rows(rows, **kw)[0],
+    chao1_upper: lambda rows, **kw: _chao1_confidence_rows(rows, **kw)[1],
+    ACE: _ACE_rows,
+    michaelis_menten_fit: _michaelis_menten_fit_rows,
+    }
+
+def diversity_matrix(data, f=chao1, **kwargs):
+    """Calculates diversity index f (default: chao1) for each row of data.
+
+    data: samples x species array of counts, or a sparse matrix with a
+    tocsr() method (e.g. from scipy.sparse), which is not made dense.
+    f: f(counts) -> diversity measure, e.g. from this module.
+    kwargs: passed to f, e.g. base for shannon.
+
+    Returns an array with f of each row, or a tuple of arrays if f returns
+    a tuple.  The functions of this module are calculated for all the rows
+    at once, other functions one row at a time.  As for those functions,
+    rows that f is undefined for (e.g. empty ones) may give nan or inf,
+    and errors (e.g. from fisher_alpha or ACE) apply to the whole table.
+    Empty rows give nan for fisher_alpha, as do rows with a lower quantile
+    of 0 for kempton_taylor_q.  michaelis_menten_fit fits with
+    a bounded search instead, so raises ValueError if given params_guess.
+    """
+    rows = _CountRows(data)
+    old_settings = seterr(divide='ignore', invalid='ignore')
+    try:
+        rows_f = _ROWS_FUNCTIONS.get(f)
+        if rows_f is not None:
+            return rows_f(rows, **kwargs)
+        result = [f(counts, **kwargs) for counts in rows.toarray()]
+    finally:
+        seterr(**old_settings)
+    if result and isinstance(result[0], tuple):
+        return tuple(map(array, zip(*result)))
+    return array(result)
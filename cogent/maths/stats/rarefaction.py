@@ -1,7 +1,9 @@
 #!/usr/bin/env python
-from numpy import concatenate, repeat, array, zeros, histogram, arange, uint, zeros
+from numpy import concatenate, repeat, array, zeros, histogram, arange, uint, zeros, \
+    asarray, argsort, minimum, searchsorted, bincount, empty
 from numpy.random import permutation, randint, sample, multinomial
 from random import Random, _ceil, _log
+from cogent.util import parallel
 
 """Given array of objects (counts or indices), perform rarefaction analyses."""
 
@@ -82,6 +84,11 @@ _inst = MyRandom()
 sample = _inst.sample_array
 
 
+def expand_counts(counts):
+    """Returns vector of the index of each item counted in counts."""
+    counts = asarray(counts)
+    return repeat(arange(len(counts)), counts.astype(int))
+
 def subsample(counts, n):
     """Subsamples new vector from vector of orig items.
     
@@ -89,12 +96,66 @@ def subsample(counts, n):
     """
     if counts.sum() <= n:
         return counts
-    nz = counts.nonzero()[0]
-    unpacked = concatenate([repeat(array(i,), counts[i]) for i in nz])
-    permuted = permutation(unpacked)[:n]
-    result = zeros(len(counts))
-    for p in permuted:
-        result[p] += 1
+    permuted = permutation(expand_counts(counts))[:n]
+    return bincount(permuted, minlength=len(counts)).astype(float)
+
+def subsample_depths(counts, depths, permutation_f=permutation):
+    """Returns array of counts subsampled to each of depths.
+
+    Row i holds the counts of the first depths[i] items of one permutation
+    of the expanded counts, so each row is a subsample without replacement,
+    the rows are nested as along a rarefaction curve, and the counts are
+    expanded and shuffled only once for all the depths.  Depths of more
+    than counts.sum() give all the counts, as from subsample.
+    """
+    counts = asarray(counts)
+    depths = asarray(depths, int)
+    num_items = len(counts)
+    result = empty((len(depths), num_items), int)
+    if not len(depths):
+        return result
+    permuted = permutation_f(expand_counts(counts))
+    order = argsort(depths, kind='mergesort')
+    sorted_depths = minimum(depths[order], len(permuted))
+    #each position in the shuffle counts toward the depths beyond it
+    positions = arange(sorted_depths[-1])
+    first_depth = searchsorted(sorted_depths, positions, side='right')
+    added = bincount(first_depth * num_items + permuted[positions],
+        minlength=len(depths) * num_items)
+    result[order] = added.reshape(len(depths), num_items).cumsum(0)
+    return result
+
+def rarefied_diversity(data, depths, metrics, iterations=10, seed=None,
+    permutation_f=permutation):
+    """Returns array of metrics of each sample in data at each of depths.
+
+    data: samples x items array of counts
+    depths: numbers of items to subsample
+    metrics: functions of a vector of counts, e.g. from alpha_diversity
+    iterations: number of subsamples of each sample at each depth
+
+    result[sample, iteration, depth, metric] is metric applied to the counts
+    of sample subsampled to depth (see subsample_depths, each iteration
+    shuffles a sample once for all the depths).  Metrics are calculated
+    for all the depths at once by alpha_diversity.diversity_matrix.
+
+    Samples are shuffled and spread over any parallel processes by
+    parallel.seeded_imap, so a seed gives the same result however many
+    processes are used.
+    """
+    from cogent.maths.stats.alpha_diversity import diversity_matrix
+    data = asarray(data)
+    def sample_diversity(sample, shuffle):
+        result = zeros((iterations, len(depths), len(metrics)), float)
+        for i in range(iterations):
+            subsamples = subsample_depths(data[sample], depths, shuffle)
+            for k, f in enumerate(metrics):
+                result[i, :, k] = diversity_matrix(subsamples, f)
+        return result
+    result = zeros((len(data), iterations, len(depths), len(metrics)), float)
+    for sample, diversity in enumerate(parallel.seeded_imap(sample_diversity,
+            range(len(data)), seed, permutation_f)):
+        result[sample] = diversity
     return result
 
 def subsample_freq_dist_nonzero(counts, n, dtype=uint):
@@ -195,8 +256,7 @@ def rarefaction(data, start=0, stop=None, stride=1, histogram_f=None, \
     need to do something like res = [r.copy() for r in rarefaction(params)].
     """
     if is_counts:   #need to transform data into indices
-        nz = array(data).nonzero()[0]
-        indices = concatenate([repeat(array(i,), data[i]) for i in nz])
+        indices = expand_counts(data)
     else:
         indices = array(data)
 
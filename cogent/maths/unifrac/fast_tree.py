@@ -3,9 +3,12 @@
 
 from numpy import (logical_and, logical_or, sum, take, nonzero, repeat, 
     array, concatenate, zeros, put, transpose, flatnonzero, newaxis,
-    logical_xor, logical_not)
+    logical_xor, logical_not, arange, argsort, cumsum, searchsorted, hstack,
+    dot, bincount, int64, divide, subtract)
+from itertools import izip
 from numpy.random import permutation
 from cogent.core.tree import PhyloNode
+from cogent.util import parallel
 
 __author__ = "Rob Knight and Micah Hamady"
 __copyright__ = "Copyright 2007-2016, The Cogent Project"
@@ -124,6 +127,67 @@ def index_envs(env_counts, tree_index, array_constructor=int):
     #return all the data structures we created; will be useful for other tasks
     return result, unique_envs, env_to_index, node_to_index
 
+def index_tip_ranges(t):
+    """Returns first, last, tips: the run of tips under each node of t.
+
+    Tips are numbered in traversal order, so the tips under the node with
+    _leaf_index i are tips[first[i]:last[i]], given as tree indices.
+    Requires index_tree(t) to have been run.
+    """
+    num_nodes = t._leaf_index + 1
+    first = zeros(num_nodes, int)
+    last = zeros(num_nodes, int)
+    tips = []
+    for n in t.traverse(self_before=False, self_after=True):
+        i = n._leaf_index
+        if n.Children:
+            first[i] = first[n.Children[0]._leaf_index]
+            last[i] = last[n.Children[-1]._leaf_index]
+        else:
+            first[i] = len(tips)
+            tips.append(i)
+            last[i] = len(tips)
+    return first, last, array(tips, int)
+
+def index_envs_sparse(env_counts, tips, tree_index):
+    """Returns the taxon x env counts of env_counts without a dense array.
+
+    env_counts should be the output of count_envs(lines), tips as from
+    index_tip_ranges and tree_index the id_index of index_tree(t).
+
+    Returns keys, cum_counts, unique_envs, env_to_index.  keys holds
+    env_index*len(tips)+tip_number for each count, sorted, and cum_counts
+    the running total of those counts starting from 0, so the count of an
+    env in a run of tips is the difference of two cum_counts located by
+    searchsorted (see descendant_counts).
+    """
+    unique_envs, num_envs = get_unique_envs(env_counts)
+    env_to_index = dict([(e, i) for i, e in enumerate(unique_envs)])
+    num_tips = len(tips)
+    tip_numbers = dict([(tree_index[i].Name, n) for n, i in enumerate(tips)])
+    keys = []
+    counts = []
+    for name in env_counts:
+        tip_number = tip_numbers[name]
+        for env, count in env_counts[name].items():
+            keys.append(env_to_index[env] * num_tips + tip_number)
+            counts.append(count)
+    keys = array(keys, int64)
+    order = argsort(keys, kind='mergesort')
+    cum_counts = concatenate([[0], cumsum(take(counts, order))])
+    return keys[order], cum_counts, unique_envs, env_to_index
+
+def descendant_counts(keys, cum_counts, num_tips, first, last, num_envs):
+    """Returns nodes x envs array of the counts under each node.
+
+    keys, cum_counts are from index_envs_sparse, first and last the tip
+    ranges of the wanted nodes from index_tip_ranges.  Gives the same rows
+    as sum_descendants on the dense array of index_envs.
+    """
+    offsets = arange(num_envs, dtype=int64) * num_tips
+    return cum_counts[searchsorted(keys, last[:,newaxis] + offsets)] - \
+        cum_counts[searchsorted(keys, first[:,newaxis] + offsets)]
+
 def get_branch_lengths(tree_index):
     """Returns array of branch lengths, in tree index order."""
     result = zeros(len(tree_index), float)
@@ -276,6 +340,28 @@ class FitchCounter(object):
         return result
 
 
+class FitchCounterBatch(object):
+    """Returns parsimony result for child states, for a batch of arrays.
+
+    As FitchCounter, for arrays with a batch of permutations along their
+    second axis (see permute_selected_rows_batch), so Changes becomes an
+    array of the number of changes for each permutation.
+    """
+    def __init__(self):
+        """Returns new FitchCounterBatch, with Changes = 0."""
+        self.Changes = 0
+
+    def __call__(self, a, ignored):
+        """Returns intersection(a), or, if zero, union(a), for each item."""
+        nonzero_rows = a.any(-1)
+        present = nonzero_rows.any(0)
+        result = lar(logical_or(a, logical_not(nonzero_rows)[...,newaxis]))
+        result &= present[:,newaxis]
+        changed = logical_and(present, logical_not(result.any(-1)))
+        result[changed] = lor(a)[changed]
+        self.Changes = self.Changes + changed
+        return result
+
 def fitch_descendants(bound_indices, counter=FitchCounter):
     """Sets each internal node to Fitch parsimony assignment, returns # changes."""
     f = counter()
@@ -304,6 +390,22 @@ def permute_selected_rows(rows, orig, new, permutation_f=permutation):
     for r, s in zip(rows, shuffled):
         new[s] = orig[r]
 
+def permute_selected_rows_batch(rows, orig, permutations):
+    """Returns orig with selected rows permuted, for each of permutations.
+
+    The permutations are along the second axis of the result: result[:,k]
+    has orig[rows] placed as by permute_selected_rows with the kth of
+    permutations (each as from permutation_f(len(rows))), and is 0
+    elsewhere.  Arrays bound to such a result are filled in for all the
+    permutations by a single traversal, e.g. by bool_descendants.
+    """
+    permutations = array(permutations, int)
+    result = zeros((len(orig), len(permutations)) + orig.shape[1:],
+        orig.dtype)
+    result[take(rows, permutations), arange(len(permutations))[:,newaxis]] = \
+        take(orig, rows, axis=0)
+    return result
+
 def prep_items_for_jackknife(col):
     """Takes column of a, returns vector with multicopy states unpacked.
     
@@ -617,3 +719,107 @@ def weighted_unifrac_vector(branch_lengths, m, tip_indices, bl_correct=False,
             rest_col, i_sum, rest_sum)
         result.append(curr)
     return array(result)
+
+
+def iter_descendant_counts(branch_lengths, first, last, keys, cum_counts,
+    num_tips, num_envs, block_size=2**20):
+    """Yields (lengths, counts) for blocks of the nodes with branch length.
+
+    counts are from descendant_counts, with about block_size values per
+    block, so only one block of the nodes x envs array exists at a time.
+    """
+    nodes = flatnonzero(branch_lengths)
+    rows = max(1, block_size // max(1, num_envs))
+    for start in range(0, len(nodes), rows):
+        block = nodes[start:start+rows]
+        yield branch_lengths[block], descendant_counts(keys, cum_counts,
+            num_tips, first[block], last[block], num_envs)
+
+def unifrac_stripes(node_counts, num_envs, start, end, env_sums=None):
+    """Returns stripes start to end-1 of the UniFrac sums between envs.
+
+    node_counts: (lengths, counts) blocks as from iter_descendant_counts.
+
+    Stripe d holds, for each env i and j = (i+d) % num_envs, the sum over
+    nodes of branch length times whether both i and j are present or, if
+    env_sums is given, times abs(i/i_sum - j/j_sum) as in _weighted_unifrac.
+    Each row of counts is only read along its length, which keeps this
+    cache friendly however many envs there are.
+    """
+    result = zeros((end-start, num_envs), float)
+    for lengths, counts in node_counts:
+        if env_sums is None:
+            counts = (counts > 0).astype(float)
+        else:
+            counts = counts / env_sums
+        wrapped = hstack([counts, counts[:,:end]])
+        for d in range(start, end):
+            other = wrapped[:,d:d+num_envs]
+            if env_sums is None:
+                stripe = counts * other
+            else:
+                stripe = abs(counts - other)
+            result[d-start] += dot(lengths, stripe)
+    return result
+
+def striped_unifrac_matrix(branch_lengths, first, last, tips, keys,
+    cum_counts, num_envs, weighted=False, tip_distances=None,
+    block_size=2**20, stripes_per_job=None):
+    """Calculates unifrac or weighted unifrac(i,j) for all envs i,j.
+
+    Works from the sparse counts of index_envs_sparse and the tip ranges of
+    index_tip_ranges, so that no nodes x envs array is needed: blocks of
+    node counts are made as required (see iter_descendant_counts) and the
+    pairs of envs are taken in stripes (see unifrac_stripes), groups of
+    stripes_per_job stripes being spread over any parallel processes.
+    Each group makes every block of node counts once, so by default there
+    is one group per process.
+
+    weighted: if 'correct', weighted unifrac with the branch length
+        correction, for which tip_distances (per node, 0 except for tips)
+        is required; otherwise weighted unifrac if True, else unifrac.
+    """
+    num_tips = len(tips)
+    env_sums = descendant_counts(keys, cum_counts, num_tips, array([0]),
+        array([num_tips]), num_envs)[0].astype(float)
+    if weighted:
+        first_stripe, stripe_env_sums = 1, env_sums
+    else:
+        # stripe 0 of the unweighted sums is the branch length of each env
+        first_stripe, stripe_env_sums = 0, None
+    end_stripe = num_envs // 2 + 1
+    if stripes_per_job is None:
+        cpus = parallel.getContext().size
+        stripes_per_job = (end_stripe - first_stripe - 1) // cpus + 1
+    stripes_per_job = max(1, stripes_per_job)
+    jobs = [(d, min(d+stripes_per_job, end_stripe))
+        for d in range(first_stripe, end_stripe, stripes_per_job)]
+    def stripe_job(job):
+        node_counts = iter_descendant_counts(branch_lengths, first, last,
+            keys, cum_counts, num_tips, num_envs, block_size)
+        return unifrac_stripes(node_counts, num_envs, job[0], job[1],
+            stripe_env_sums)
+    result = zeros((num_envs, num_envs), float)
+    envs = arange(num_envs)
+    for (start, end), sums in izip(jobs, parallel.imap(stripe_job, jobs)):
+        for d, stripe in zip(range(start, end), sums):
+            other = (envs + d) % num_envs
+            result[envs, other] = stripe
+            result[other, envs] = stripe
+    if not weighted:
+        env_lengths = result.diagonal().copy()
+    elif weighted == 'correct':
+        env_tips = keys // num_tips
+        tip_counts = cum_counts[1:] - cum_counts[:-1]
+        tip_lengths = take(tip_distances, take(tips, keys % num_tips))
+        corrections = bincount(env_tips, tip_lengths * tip_counts,
+            num_envs) / env_sums
+    # in place a row at a time, so there are no more envs x envs arrays
+    for i, row in enumerate(result):
+        if not weighted:
+            union = env_lengths[i] + env_lengths - row
+            divide(row, union, out=row)
+            subtract(1, row, out=row)
+        elif weighted == 'correct':
+            row /= corrections[i] + corrections
+    return result
@@ -2,7 +2,7 @@
 """Fast implementation of UniFrac for use with very large datasets"""
 
 from random import shuffle
-from numpy import ones, ma, where
+from numpy import ones, ma, where, dot, logical_and, logical_or
 from numpy.random import permutation
 from cogent.maths.unifrac.fast_tree import *
 # not imported by import *
@@ -12,6 +12,7 @@ from cogent.cluster.metric_scaling import *
 from cogent.core.tree import PhyloNode, TreeError
 from cogent.cluster.UPGMA import UPGMA_cluster
 from cogent.phylo.nj import nj
+from cogent.util import parallel
 from StringIO import StringIO
 
 __author__ = "Rob Knight and Micah Hamady"
@@ -100,13 +101,18 @@ def fast_unifrac_permutations_file(tree_in, envs_in, weighted=False,
         real_env_mat, unique_envs = results[UNIFRAC_DIST_MATRIX]
         num_uenvs = real_env_mat.shape[0] 
         cur_num_comps = num_comps(num_uenvs)
-        for i in range(num_uenvs): 
-            first_env = unique_envs[i]
-            for j in range(i+1, num_uenvs): 
-                second_env = unique_envs[j]
+        pairs = [(i, j) for i in range(num_uenvs)
+            for j in range(i+1, num_uenvs)]
+        # the permutations of every pair are registered together so that
+        # one set of worker processes serves all of them
+        setup = _fast_unifrac_setup(t, envs)
+        permuted = [_unifrac_permutations_f(setup, weighted, unique_envs[i],
+            unique_envs[j]) for (i, j) in pairs]
+        with parallel.registered(*[f for (f, values) in permuted]):
+            for ((i, j), (permuted_unifrac, values)) in zip(pairs, permuted):
+                first_env, second_env = unique_envs[i], unique_envs[j]
                 real = real_env_mat[i][j]
-                sim = fast_unifrac_permutations(t, envs, weighted, num_iters, 
-                    first_env=first_env, second_env=second_env)
+                sim = _permutations(permuted_unifrac, num_iters, values)
                 raw_pval, cor_pval = mcarlo_sig(real, sim, cur_num_comps, 
                     tail='high')
                 result.append((first_env, second_env, raw_pval, cor_pval))
@@ -143,14 +149,18 @@ def fast_p_test_file(tree_in, envs_in, num_iters=1000, verbose=False,
     # calculate real, sim vals and p-vals for each pair of envs in tree 
     if test_on == TEST_ON_PAIRWISE:
         cur_num_comps = num_comps(num_uenvs) 
-        for i in range(num_uenvs): 
-            first_env = unique_envs[i]
-            for j in range(i+1, num_uenvs): 
-                second_env = unique_envs[j]
-                real = fast_p_test(t, envs, num_iters=1, first_env=first_env, 
-                    second_env=second_env, permutation_f=identity)[0]
-                sim = fast_p_test(t, envs, num_iters, first_env=first_env, 
-                    second_env=second_env)
+        pairs = [(unique_envs[i], unique_envs[j]) for i in range(num_uenvs)
+            for j in range(i+1, num_uenvs)]
+        # as for fast_unifrac_permutations_file
+        setup = _fast_unifrac_setup(t, envs)
+        permuted = [_p_test_f(setup, first_env, second_env)
+            for (first_env, second_env) in pairs]
+        with parallel.registered(*[f for (f, values) in permuted]):
+            for ((first_env, second_env), (permuted_changes, values)) in zip(
+                    pairs, permuted):
+                real = _permutations(permuted_changes, 1, values,
+                    permutation_f=identity)[0]
+                sim = _permutations(permuted_changes, num_iters, values)
                 raw_pval, cor_pval = mcarlo_sig(real, sim, cur_num_comps, 
                     tail='low')
                 result.append((first_env, second_env, raw_pval, cor_pval))
@@ -168,18 +178,22 @@ def fast_p_test_file(tree_in, envs_in, num_iters=1000, verbose=False,
 
     return result
 
+def _make_subtree(t, envs):
+    """Returns copy of t without the tips that are not in envs."""
+    t2 = t.copy()
+    wanted = set(envs.keys())
+    def delete_test(node):
+        if node.istip() and node.Name not in wanted:
+            return True
+        return False
+    t2.removeDeleted(delete_test)
+    t2.prune()
+    return t2
+
 def _fast_unifrac_setup(t, envs, make_subtree=True):
     """Setup shared by fast_unifrac and by significance tests."""
     if make_subtree:
-        t2 = t.copy()
-        wanted = set(envs.keys())
-        def delete_test(node):
-            if node.istip() and node.Name not in wanted:
-                return True
-            return False
-        t2.removeDeleted(delete_test)
-        t2.prune()
-        t = t2
+        t = _make_subtree(t, envs)
 
     #index tree
     node_index, nodes = index_tree(t)
@@ -247,21 +261,58 @@ def PD_generic_whole_tree(t, envs, metric=PD):
     result = PD_vector(branch_lengths, count_array,metric)
     return unique_envs, result
 
+def _batch_sizes(num_iters, batch_size, values):
+    """Returns the sizes of the batches of num_iters permutations.
+
+    values is the size of the array permuted, used to limit batches to about
+    2**22 values when batch_size is None.
+    """
+    if batch_size is None:
+        batch_size = max(1, min(100, 2**22 // max(1, values)))
+    return [min(batch_size, num_iters-start)
+        for start in range(0, num_iters, batch_size)]
+
+def _permutations(permuted_f, num_iters, values, seed=None,
+    permutation_f=permutation, batch_size=None):
+    """Results of num_iters permutations by permuted_f(size, permutation_f),
+    in batches as for permute_selected_rows_batch of an array with values
+    values"""
+    result = []
+    batches = _batch_sizes(num_iters, batch_size, values)
+    for curr in parallel.seeded_imap(permuted_f, batches, seed, permutation_f):
+        result.extend(curr)
+    return result
+
 def fast_unifrac_permutations(t, envs, weighted, num_iters, first_env, 
-    second_env, permutation_f=permutation, unifrac_f=_weighted_unifrac):
+    second_env, permutation_f=permutation, unifrac_f=_weighted_unifrac,
+    seed=None, batch_size=None):
     """Performs UniFrac permutations between specified pair of environments.
     
     NOTE: this function just gives you the result of the permutations, need to 
     compare to real values from doing a single unifrac.
+
+    The permutations are done in batches of batch_size (see
+    permute_selected_rows_batch) spread over any parallel processes by
+    parallel.seeded_imap, so a seed gives the same permutations on every run.
     """
-    result = []
-    envs, count_array, unique_envs, env_to_index, node_to_index, env_names, branch_lengths, nodes, t = _fast_unifrac_setup(t, envs)
+    (permuted_unifrac, values) = _unifrac_permutations_f(
+        _fast_unifrac_setup(t, envs), weighted, first_env, second_env,
+        unifrac_f)
+    return _permutations(permuted_unifrac, num_iters, values, seed,
+        permutation_f, batch_size)
+
+def _unifrac_permutations_f(setup, weighted, first_env, second_env,
+    unifrac_f=_weighted_unifrac):
+    """The function of (size, permutation_f) giving size permuted UniFrac
+    values between first_env and second_env, and how many counts it permutes.
+
+    setup: the result of _fast_unifrac_setup, which may be shared by pairs.
+    """
+    envs, count_array, unique_envs, env_to_index, node_to_index, env_names, branch_lengths, nodes, t = setup
 
     first_index,second_index = env_to_index[first_env], env_to_index[second_env]
     count_array = count_array[:,[first_index,second_index]] #ditch rest of array
-    bound_indices = bind_to_array(nodes, count_array)
     orig_count_array = count_array.copy()
-    first_col, second_col = count_array[:,0], count_array[:,1]
     tip_indices = [n._leaf_index for n in t.tips()]
 
     #figure out whether doing weighted or unweighted analysis: for weighted,
@@ -271,46 +322,66 @@ def fast_unifrac_permutations(t, envs, weighted, num_iters, first_env,
         tip_ds = branch_lengths.copy()[:,newaxis]
         bindings = bind_to_parent_array(t, tip_ds)
         tip_distances(tip_ds, bindings, tip_indices)
+        tip_ds = tip_ds.ravel()
         if weighted == 'correct':
             bl_correct = True
         else:
             bl_correct = False
         first_sum, second_sum = [sum(take(count_array[:,i], tip_indices)) for i in range(2)]
-        for i in range(num_iters):
-            permute_selected_rows(tip_indices, orig_count_array, count_array, permutation_f)
+
+    def permuted_unifrac(size, permutation_f):
+        count_arrays = permute_selected_rows_batch(tip_indices,
+            orig_count_array, [permutation_f(len(tip_indices))
+            for i in range(size)])
+        bound_indices = bind_to_array(nodes, count_arrays)
+        first_cols, second_cols = count_arrays[:,:,0], count_arrays[:,:,1]
+        if weighted:
             sum_descendants(bound_indices)
-            curr = unifrac_f(branch_lengths, first_col, second_col, first_sum, second_sum)
+            first_cols = first_cols / float(first_sum)
+            second_cols = second_cols / float(second_sum)
+            if unifrac_f is _weighted_unifrac:
+                curr = dot(branch_lengths, abs(first_cols - second_cols))
+            else:
+                curr = array([unifrac_f(branch_lengths, first_col,
+                    second_col, first_sum, second_sum) for first_col,
+                    second_col in zip(count_arrays[:,:,0].T,
+                    count_arrays[:,:,1].T)])
             if bl_correct:
-                curr /= _branch_correct(tip_ds, first_col, second_col, first_sum, second_sum)
-            result.append(curr)
-    else:
-        for i in range(num_iters):
-            permute_selected_rows(tip_indices, orig_count_array, count_array, permutation_f)
-
-            # commenting out these (??)
-            #first = count_array.copy()
-            #permute_selected_rows(tip_indices, orig_count_array, count_array, permutation_f)
-            #second = count_array.copy()
-
+                curr /= dot(tip_ds, first_cols + second_cols)
+        else:
             bool_descendants(bound_indices)
-            curr = unifrac(branch_lengths, first_col, second_col)
-            result.append(curr)
-    return result
+            curr = 1 - dot(branch_lengths, logical_and(first_cols,
+                second_cols)) / dot(branch_lengths, logical_or(first_cols,
+                second_cols))
+        return list(curr)
+
+    return (permuted_unifrac, count_array.size)
 
 def fast_p_test(t, envs, num_iters, first_env=None, second_env=None, 
-    permutation_f=permutation):
+    permutation_f=permutation, seed=None, batch_size=None):
     """Performs Andy Martin's p test between specified pair of environments.
 
     t: tree 
     envs: envs 
     first_env: name of first env, or None if doing whole tree
     second_env: name of second env, or None if doing whole tree
+    seed, batch_size: as for fast_unifrac_permutations
 
     NOTE: this function just gives you the result of the permutations, need to 
     compare to real Fitch parsimony values. Sleazy way to get the real values 
     is to set num_iters to 1, permutation_f to identity."""
-    result = []
-    envs, count_array, unique_envs, env_to_index, node_to_index, env_names, branch_lengths, nodes, t = _fast_unifrac_setup(t, envs)
+    (permuted_changes, values) = _p_test_f(_fast_unifrac_setup(t, envs),
+        first_env, second_env)
+    return _permutations(permuted_changes, num_iters, values, seed,
+        permutation_f, batch_size)
+
+def _p_test_f(setup, first_env=None, second_env=None):
+    """The function of (size, permutation_f) giving size permuted Fitch
+    parsimony values, and how many counts it permutes.
+
+    setup: the result of _fast_unifrac_setup, which may be shared by pairs.
+    """
+    envs, count_array, unique_envs, env_to_index, node_to_index, env_names, branch_lengths, nodes, t = setup
 
     # check if doing pairwise
     if not (first_env is None or second_env is None):
@@ -320,16 +391,18 @@ def fast_p_test(t, envs, num_iters, first_env=None, second_env=None,
     elif not (first_env is None and second_env is None):
         raise ValueError, "Both envs must either have a value or be None."
 
-    bound_indices = bind_to_array(nodes, count_array)
     orig_count_array = count_array.copy()
     tip_indices = [n._leaf_index for n in t.tips()]
-    for i in range(num_iters):
-        count_array *= 0
-        permute_selected_rows(tip_indices, orig_count_array, count_array, 
-            permutation_f=permutation_f)
-        curr = fitch_descendants(bound_indices)
-        result.append(curr)
-    return result
+
+    def permuted_changes(size, permutation_f):
+        count_arrays = permute_selected_rows_batch(tip_indices,
+            orig_count_array, [permutation_f(len(tip_indices))
+            for i in range(size)])
+        bound_indices = bind_to_array(nodes, count_arrays)
+        changes = fitch_descendants(bound_indices, counter=FitchCounterBatch)
+        return list(changes + zeros(count_arrays.shape[1], int))
+
+    return (permuted_changes, count_array.size)
 
 def shared_branch_length(t, envs, env_count=1):
     """Returns the shared branch length env_count combinations of envs
@@ -417,8 +490,43 @@ def shared_branch_length_to_root(t, envs):
 
     return result
 
+def fast_unifrac_striped(t, envs, weighted=False, make_subtree=True,
+    block_size=2**20, stripes_per_job=None):
+    """Returns UniFrac distance matrix and env names, for many samples.
+
+    Parameters as for fast_unifrac.  Rather than a dense array of counts for
+    each node in each env, which is too big for tens of thousands of envs
+    on a tree of hundreds of thousands of tips, only the tip counts are
+    kept, sparse, and the distances are calculated from bounded blocks of
+    node counts in stripes spread over any parallel processes (see
+    striped_unifrac_matrix in fast_tree.py).  Only the unifrac and weighted
+    unifrac metrics are available this way.
+    """
+    if make_subtree:
+        t = _make_subtree(t, envs)
+    node_index, nodes = index_tree(t)
+    first, last, tips = index_tip_ranges(t)
+    envs = dict([(node_index[i].Name, envs[node_index[i].Name])
+        for i in tips if node_index[i].Name in envs])
+    if not envs:
+        raise ValueError, "No valid samples/environments found. Check whether tree tips match otus/taxa present in samples/environments"
+    keys, cum_counts, env_names, env_to_index = index_envs_sparse(envs, tips,
+        node_index)
+    branch_lengths = get_branch_lengths(node_index)
+    tip_ds = None
+    if weighted == 'correct':
+        tip_ds = branch_lengths.copy()[:,newaxis]
+        bindings = bind_to_parent_array(t, tip_ds)
+        tip_distances(tip_ds, bindings, tips)
+        tip_ds = tip_ds.ravel()
+    u = striped_unifrac_matrix(branch_lengths, first, last, tips, keys,
+        cum_counts, len(env_names), weighted=weighted, tip_distances=tip_ds,
+        block_size=block_size, stripes_per_job=stripes_per_job)
+    return u, env_names
+
 def fast_unifrac(t, envs, weighted=False, metric=unifrac, is_symmetric=True, 
-    modes=UNIFRAC_DEFAULT_MODES, weighted_unifrac_f=_weighted_unifrac,make_subtree=True):
+    modes=UNIFRAC_DEFAULT_MODES, weighted_unifrac_f=_weighted_unifrac,make_subtree=True,
+    striped=False):
     """ Run fast unifrac.
     
     t: phylogenetic tree relating the sequences.  pycogent phylonode object
@@ -433,6 +541,10 @@ def fast_unifrac(t, envs, weighted=False, metric=unifrac, is_symmetric=True,
     is_symmetric: if the desired distance matrix is symmetric 
         (dist(sampleA, sampleB) == dist(sampleB, sampleA)), then set this True
         to prevent calculating the same number twice
+    striped: if True, calculates the distance matrix with
+        fast_unifrac_striped, which needs far less memory for large numbers
+        of samples, but only for the default metric and weighted_unifrac_f
+        and without the 'distance_vector' mode.
 
     using default modes, returns a dictionary with the following (key:value) pairs:
 
@@ -463,6 +575,14 @@ def fast_unifrac(t, envs, weighted=False, metric=unifrac, is_symmetric=True,
     if not modes or modes - UNIFRAC_VALID_MODES:
         raise ValueError, "Invalid run modes: %s, valid: %s" % (str(modes),str(UNIFRAC_VALID_MODES))
 
+    if striped:
+        if metric is not unifrac or not is_symmetric or \
+                weighted_unifrac_f is not _weighted_unifrac or \
+                UNIFRAC_DIST_VECTOR in modes:
+            raise ValueError, "Striped UniFrac only calculates unifrac and weighted unifrac distance matrices"
+        u, env_names = fast_unifrac_striped(t, envs, weighted, make_subtree)
+        return unifrac_tasks_from_matrix(u, env_names, modes=modes)
+
     envs, count_array, unique_envs, env_to_index, node_to_index, env_names, branch_lengths, nodes, t = _fast_unifrac_setup(t, envs, make_subtree)
     bound_indices = bind_to_array(nodes, count_array)
     #initialize result
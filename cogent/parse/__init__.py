@@ -16,9 +16,11 @@ __all__ = ['aaindex',
            'ct',
            'cut',
            'cutg',
+           'dense_alignment',
            'dialign',
            'dynalign',
            'ebi',
+           'faidx',
            'fasta',
            'fastq',
            'foldalign',
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""A binary file format for DenseAlignments which can be memory mapped.
+
+The file starts with a line identifying the format and a header, which is
+a pickled dict of the sequence names, the MolType label, the name of the
+alphabet (MolType.Alphabet or one of MolType.Alphabets), and the array
+type and shape.  The array of alphabet indices, one row per sequence,
+starts at the next multiple of 4096 bytes.
+
+load_dense_alignment() memory maps that array rather than reading it, so
+only the parts used are read from disk, and processes using the same file
+share it through the page cache.
+"""
+
+import cPickle
+import numpy
+from cogent.core import moltype
+from cogent.core.alignment import DenseAlignment
+from cogent.parse.record import FileFormatError
+
+__author__ = "Peter Maxwell"
+__copyright__ = "Copyright 2007-2016, The Cogent Project"
+__credits__ = ["Peter Maxwell"]
+__license__ = "GPL"
+__version__ = "1.9"
+__maintainer__ = "Peter Maxwell"
+__email__ = "pm67nz@gmail.com"
+__status__ = "Development"
+
+_MAGIC = 'PyCogent DenseAlignment 1\n'
+_PAGE_SIZE = 4096
+_ALPHABET_NAMES = ['Alphabet', 'Base', 'Gapped', 'Degen', 'DegenGapped']
+
+def _moltypes():
+    return dict((m.label, m) for m in vars(moltype).values()
+        if isinstance(m, moltype.MolType))
+
+def _get_alphabet(mtype, name):
+    if name == 'Alphabet':
+        return mtype.Alphabet
+    return getattr(getattr(mtype, 'Alphabets', None), name, None)
+
+def save_dense_alignment(aln, filename):
+    """Writes DenseAlignment aln to filename in the memory mappable
+    format"""
+    mtype = aln.MolType
+    if mtype is None or _moltypes().get(mtype.label) is not mtype:
+        raise ValueError("Only alignments of the standard MolTypes can be "
+            "saved")
+    for alphabet_name in _ALPHABET_NAMES:
+        if _get_alphabet(mtype, alphabet_name) is aln.Alphabet:
+            break
+    else:
+        raise ValueError("Only the alphabets of the MolType can be saved")
+    shape = (len(aln.Names), aln.SeqLen)
+    dtype = numpy.dtype(aln.Alphabet.ArrayType)
+    header = cPickle.dumps(dict(names=list(aln.Names), moltype=mtype.label,
+        alphabet=alphabet_name, dtype=dtype.str, shape=shape),
+        cPickle.HIGHEST_PROTOCOL)
+    header = '%s%s\n%s' % (_MAGIC, len(header), header)
+    offset = -(-len(header) // _PAGE_SIZE) * _PAGE_SIZE
+    outfile = open(filename, 'wb')
+    try:
+        outfile.write(header.ljust(offset, '\0'))
+        rows = max(1, aln.block_size // max(1, aln.SeqLen))
+        seqs = aln.ArraySeqs
+        for start in range(0, len(seqs), rows):
+            outfile.write(numpy.ascontiguousarray(seqs[start:start+rows],
+                dtype).tostring())
+    finally:
+        outfile.close()
+
+def load_dense_alignment(filename, mode='r'):
+    """A DenseAlignment from a file written by save_dense_alignment, with
+    its array memory mapped.  With mode 'c' the array can be changed in
+    memory, not on disk."""
+    infile = open(filename, 'rb')
+    try:
+        if infile.readline() != _MAGIC:
+            raise FileFormatError("%s isn't a dense alignment file" %
+                filename)
+        length = int(infile.readline())
+        header = cPickle.loads(infile.read(length))
+        offset = infile.tell()
+    finally:
+        infile.close()
+    offset = -(-offset // _PAGE_SIZE) * _PAGE_SIZE
+    mtype = _moltypes()[header['moltype']]
+    alphabet = _get_alphabet(mtype, header['alphabet'])
+    shape = tuple(header['shape'])
+    if 0 in shape:
+        seqs = numpy.zeros(shape, header['dtype'])
+    else:
+        seqs = numpy.memmap(filename, header['dtype'], mode, offset, shape)
+    return DenseAlignment(seqs, Names=header['names'], Alphabet=alphabet,
+        MolType=mtype, force_same_data=True)
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+"""Random access to sequences in large FASTA and FASTQ files through
+a samtools faidx compatible index (a '.fai' file).
+
+build_index(filename) scans the file once and writes filename.fai, with a
+line per record of:
+    NAME LENGTH OFFSET LINEBASES LINEWIDTH [QUALOFFSET]
+where OFFSET is the byte offset of the sequence and QUALOFFSET (FASTQ only)
+that of the qualities.  NAME is the label up to the first white space.
+
+IndexedSequences(filename) uses that index, building it if needed, to
+fetch whole sequences or parts of them with mmap rather than parsing the
+file up to them.
+"""
+
+import os
+import mmap
+import numpy
+from cogent.parse.record import RecordError
+
+__author__ = "Peter Maxwell"
+__copyright__ = "Copyright 2007-2016, The Cogent Project"
+__credits__ = ["Peter Maxwell"]
+__license__ = "GPL"
+__version__ = "1.9"
+__maintainer__ = "Peter Maxwell"
+__email__ = "pm67nz@gmail.com"
+__status__ = "Development"
+
+# Bytes of a multi-line sequence to check at once
+_SCAN_SIZE = 2**26
+
+def _label_name(label):
+    words = label.split()
+    if not words:
+        raise RecordError("Record without a name at %s" % label)
+    return words[0]
+
+def _line_bases(mm, start, end):
+    """Length of the line from start, excluding '\\r\\n'"""
+    while end > start and mm[end-1] in '\r\n':
+        end -= 1
+    return end - start
+
+def _fasta_entry(mm, array, seq_start, end):
+    """(LENGTH, LINEBASES, LINEWIDTH) of the sequence in mm[seq_start:end],
+    checking that all lines but the last are the same length"""
+    # trailing empty lines are allowed
+    while end > seq_start and mm[end-1] in '\r\n':
+        end -= 1
+    if end == seq_start:
+        return (0, 0, 0)
+    first_end = mm.find('\n', seq_start, end)
+    if first_end < 0:
+        length = end - seq_start
+        return (length, length, length+1)
+    line_width = first_end + 1 - seq_start
+    line_bases = _line_bases(mm, seq_start, first_end)
+    # every other line but the last should end line_width after the previous
+    last_newline = first_end
+    for block_start in range(first_end + 1, end, _SCAN_SIZE):
+        block_end = min(end, block_start + _SCAN_SIZE)
+        newlines = numpy.flatnonzero(array[block_start:block_end] == 10)
+        if len(newlines):
+            newlines += block_start
+            if newlines[0] != last_newline + line_width or \
+                    (numpy.diff(newlines) != line_width).any():
+                raise RecordError("Lines of different lengths in record "
+                        "at %s" % seq_start)
+            last_newline = newlines[-1]
+    full_lines = (last_newline + 1 - seq_start) // line_width
+    last_bases = _line_bases(mm, last_newline + 1, end)
+    if last_bases > line_bases:
+        raise RecordError("Lines of different lengths in record at %s" %
+                seq_start)
+    return (full_lines * line_bases + last_bases, line_bases, line_width)
+
+def _fasta_index(mm):
+    array = numpy.frombuffer(mm, numpy.uint8)
+    size = len(mm)
+    if mm[:1] == '>':
+        start = 0
+    else:
+        start = mm.find('\n>')
+        if start >= 0:
+            start += 1
+    while start >= 0:
+        label_end = mm.find('\n', start)
+        if label_end < 0:
+            label_end = size
+        name = _label_name(mm[start+1:label_end])
+        seq_start = min(label_end + 1, size)
+        end = mm.find('\n>', label_end)
+        next_start = end + 1 if end >= 0 else -1
+        if end < 0:
+            end = size
+        else:
+            end += 1
+        (length, line_bases, line_width) = _fasta_entry(
+                mm, array, seq_start, end)
+        yield (name, length, seq_start, line_bases, line_width)
+        start = next_start
+
+def _fastq_index(mm):
+    size = len(mm)
+    start = 0
+    while start < size:
+        ends = []
+        position = start
+        for i in range(4):
+            end = mm.find('\n', position)
+            if end < 0:
+                end = size
+            ends.append(end)
+            position = end + 1
+        label = mm[start:ends[0]]
+        if not label.strip():
+            start = ends[0] + 1
+            continue
+        if label[:1] != '@' or mm[ends[1]+1:ends[1]+2] != '+':
+            raise RecordError("Invalid FASTQ record at %s" % start)
+        name = _label_name(label[1:])
+        seq_start = ends[0] + 1
+        length = _line_bases(mm, seq_start, ends[1])
+        qual_start = ends[2] + 1
+        if _line_bases(mm, qual_start, ends[3]) != length:
+            raise RecordError("Quality and sequence lengths differ for %s" %
+                    name)
+        yield (name, length, seq_start, length, ends[1] + 1 - seq_start,
+                qual_start)
+        start = ends[3] + 1
+
+def _open_mmap(filename):
+    with open(filename, 'rb') as infile:
+        if os.fstat(infile.fileno()).st_size == 0:
+            return ''
+        return mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+
+def build_index(filename, index_filename=None):
+    """Writes a faidx index of a FASTA or FASTQ file, by default to
+    filename.fai, and returns its entries"""
+    if index_filename is None:
+        index_filename = filename + '.fai'
+    mm = _open_mmap(filename)
+    try:
+        first = mm[:1]
+        if first == '@':
+            entries = list(_fastq_index(mm))
+        else:
+            entries = list(_fasta_index(mm))
+    finally:
+        if not isinstance(mm, str):
+            mm.close()
+    names = set()
+    for entry in entries:
+        if entry[0] in names:
+            raise RecordError("Duplicate sequence name %s" % entry[0])
+        names.add(entry[0])
+    with open(index_filename, 'w') as outfile:
+        for entry in entries:
+            outfile.write('\t'.join(map(str, entry)) + '\n')
+    return entries
+
+def load_index(index_filename):
+    """The entries in a faidx index file"""
+    entries = []
+    for line in open(index_filename):
+        fields = line.rstrip('\r\n').split('\t')
+        if len(fields) not in (5, 6):
+            raise RecordError("Invalid index line: %s" % line)
+        entries.append(tuple([fields[0]] + [int(x) for x in fields[1:]]))
+    return entries
+
+
+class IndexedSequences(object):
+    """Lazily loaded sequences from a FASTA or FASTQ file, looked up by name
+    through a faidx index, which will be built if missing or older than
+    the file.  Behaves like a read-only SequenceCollection for getting
+    sequences, and takeSeqs() gives a real one."""
+
+    def __init__(self, filename, MolType=None, index_filename=None):
+        if index_filename is None:
+            index_filename = filename + '.fai'
+        if os.path.exists(index_filename) and \
+                os.path.getmtime(index_filename) >= \
+                os.path.getmtime(filename):
+            entries = load_index(index_filename)
+        else:
+            entries = build_index(filename, index_filename)
+        self.Names = [entry[0] for entry in entries]
+        self._entries = dict((entry[0], entry) for entry in entries)
+        if MolType is None:
+            from cogent.core.moltype import BYTES as MolType
+        self.MolType = MolType
+        self._mmap = _open_mmap(filename)
+
+    def close(self):
+        if not isinstance(self._mmap, str):
+            self._mmap.close()
+
+    def __len__(self):
+        return len(self.Names)
+
+    def __iter__(self):
+        return iter(self.Names)
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    def getSeqNames(self):
+        return self.Names[:]
+
+    def getSeqLength(self, name):
+        return self._entries[name][1]
+
+    def _offset(self, entry, i):
+        (name, length, offset, line_bases, line_width) = entry[:5]
+        if not line_bases:
+            return offset
+        return offset + (i // line_bases) * line_width + i % line_bases
+
+    def _read(self, entry, offset, start, end):
+        length = entry[1]
+        (start, end, step) = slice(start, end).indices(length)
+        if start >= end:
+            return ''
+        entry = (entry[0], length, offset) + entry[3:5]
+        text = self._mmap[self._offset(entry, start):
+                self._offset(entry, end-1)+1]
+        if end - start != len(text):
+            text = text.translate(None, '\r\n')
+        return text
+
+    def getSeqStr(self, name, start=None, end=None):
+        """The sequence, or the slice of it from start to end, as a str"""
+        entry = self._entries[name]
+        return self._read(entry, entry[2], start, end)
+
+    def getQualityStr(self, name, start=None, end=None):
+        """The FASTQ quality string, or the slice of it from start to end"""
+        entry = self._entries[name]
+        if len(entry) < 6:
+            raise ValueError("%s has no qualities" % name)
+        return self._read(entry, entry[5], start, end)
+
+    def getSeq(self, name, start=None, end=None):
+        """The sequence, or part of it, as a MolType sequence"""
+        return self.MolType.makeSequence(self.getSeqStr(name, start, end),
+                name)
+
+    __getitem__ = getSeq
+
+    def takeSeqs(self, names):
+        """A SequenceCollection of just the named sequences"""
+        from cogent.core.alignment import SequenceCollection
+        return SequenceCollection([(name, self.getSeqStr(name))
+                for name in names], MolType=self.MolType)
@@ -7,6 +7,7 @@ from cogent.core.info import Info, DbRef
 from cogent.core.moltype import BYTES, ASCII
 
 from string import strip
+import numpy
 import cogent
 import re
 
@@ -69,6 +70,115 @@ def MinimalFastaParser(infile, strict=True, \
 
         yield label, seq
 
+# a label line, as for FastaFinder, which strips lines: '>' after a line
+# break and any other leading whitespace
+_label_start = re.compile(r'\n[^\S\n]*>')
+
+def _last_label_start(text):
+    """Index of the line break before the last label in text, or -1"""
+    end = len(text)
+    while True:
+        gt = text.rfind('>', 0, end)
+        if gt < 0:
+            return -1
+        line_start = text.rfind('\n', 0, gt)
+        if line_start < 0:
+            return -1
+        if not text[line_start+1:gt].strip():
+            return line_start
+        end = gt
+
+def _read_fasta_blocks(infile, block_size):
+    """Successive blocks of whole records, each starting with a line break
+    before its first label"""
+    pending = ['\n']
+    while True:
+        block = infile.read(block_size)
+        if not block:
+            break
+        # a record boundary can be split between blocks
+        previous = pending.pop()
+        text = previous + block
+        boundary = _last_label_start(text)
+        if boundary < 0:
+            # keep any whitespace starting the last line as the last piece,
+            # in case the line turns out to be a label
+            line_start = text.rfind('\n')
+            if text.isspace():
+                pending.append(text)
+            elif line_start >= 0 and (line_start == len(text) - 1 or
+                    text[line_start+1:].isspace()):
+                pending.extend([text[:line_start], text[line_start:]])
+            else:
+                pending.extend([previous, block])
+            continue
+        pending.append(text[:boundary+1])
+        yield ''.join(pending)
+        pending = ['\n', text[boundary+1:]]
+    text = ''.join(pending)
+    if text.strip():
+        yield text + '\n'
+
+_not_just_sequence = re.compile('[\n\r\t #]')
+
+def _fasta_seq_lines(seq):
+    # as FastaFinder: lines stripped, blank and comment lines ignored
+    return [line for line in [line.strip() for line in seq.split('\n')]
+            if not is_blank_or_comment(line)]
+
+def ChunkedFastaParser(infile, strict=True, block_size=2**20,
+        as_array=False):
+    """Yields successive sequences from infile as (label, seq) tuples, like
+    MinimalFastaParser but reading large blocks and finding the records in
+    them without going line by line, so much faster for large files.
+    
+    infile can be a file name or an open file.
+    If strict is True (default), raises RecordError when label or seq missing.
+    If as_array is True the sequences are numpy uint8 arrays, which for
+    sequences on a single line are views of the block rather than copies.
+    """
+    if isinstance(infile, basestring):
+        infile = open(infile, 'rb')
+        opened = True
+    else:
+        opened = False
+    
+    for text in _read_fasta_blocks(infile, block_size):
+        if as_array:
+            array = numpy.frombuffer(text, numpy.uint8)
+        # text is '\n' + anything before the first label, then records
+        next_label = _label_start.search(text)
+        end = next_label.start() if next_label else len(text) - 1
+        if strict and _fasta_seq_lines(text[:end]):
+            raise RecordError, "Found Fasta record without label line: %s"%\
+                    text[:end]
+        while next_label:
+            start = next_label.end()
+            next_label = _label_start.search(text, start)
+            end = next_label.start() if next_label else len(text) - 1
+            seq_start = text.find('\n', start)
+            label = text[start:seq_start].strip()
+            if as_array and not _not_just_sequence.search(text,
+                    seq_start+1, end):
+                seq = array[seq_start+1:end]
+            else:
+                seq = text[seq_start+1:end]
+                if '#' in seq or ' ' in seq or '\t' in seq:
+                    seq = ''.join(_fasta_seq_lines(seq))
+                else:
+                    seq = seq.translate(None, '\r\n')
+                if as_array:
+                    seq = numpy.frombuffer(seq, numpy.uint8)
+            if not len(seq):
+                if strict:
+                    raise RecordError, \
+                            "Found label line without sequences: %s" % label
+                continue
+            yield label, seq
+    
+    if opened:
+        infile.close()
+
 GdeFinder = LabeledRecordFinder(is_gde_label, ignore=is_blank) 
 
 def MinimalGdeParser(infile, strict=True, label_to_name=str):
@@ -7,6 +7,10 @@ __maintainer__ = "Gavin Huttley"
 __email__ = "Gavin.Huttley@anu.edu.au"
 __status__ = "Development"
 
+from itertools import izip
+import numpy
+from cogent.parse.record import RecordError
+
 def MinimalFastqParser(data, strict=True):
     """yields name, seq, qual from fastq file
 
@@ -43,3 +47,102 @@ def MinimalFastqParser(data, strict=True):
     if type(data) == file:
         data.close()
 
+def _stripped_spans(array, starts, ends):
+    """starts and ends of the lines of array (ending at the newlines at
+    ends) without their leading and trailing spaces and tabs"""
+    positions = numpy.arange(len(array))
+    text = (array != 32) & (array != 9)
+    # the newlines count as text, so neither search leaves its line
+    last_text = numpy.maximum.accumulate(numpy.where(text, positions, -1))
+    next_text = numpy.minimum.accumulate(
+            numpy.where(text, positions, len(array))[::-1])[::-1]
+    stripped_starts = next_text[starts]
+    stripped_ends = numpy.minimum(numpy.maximum(last_text[ends-1] + 1,
+            stripped_starts), ends)
+    return (stripped_starts, stripped_ends)
+
+def ChunkedFastqParser(data, strict=True, block_size=2**20, as_array=False):
+    """yields name, seq, qual from a fastq file, like MinimalFastqParser
+    but reading it in large blocks and splitting those into lines all at
+    once, so much faster for large files.
+
+    Arguments:
+        - strict: checks the records are well formed and that any label on
+          the '+' line matches the sequence label
+        - block_size: bytes to read at a time
+        - as_array: yield seq and qual as numpy uint8 arrays, which are
+          views of the block rather than copies
+    
+    Lines are stripped as by MinimalFastqParser.  An incomplete record at
+    the end of the file raises a RecordError.
+    """
+    if isinstance(data, basestring):
+        data = open(data, 'rb')
+        opened = True
+    else:
+        opened = False
+    
+    leftover = ''
+    while True:
+        block = data.read(block_size)
+        at_end = not block
+        buf = leftover + block
+        if '\r' in buf:
+            buf = buf.replace('\r', '')
+        if at_end:
+            # could be just empty lines at eof
+            buf = buf.rstrip()
+            if buf:
+                buf += '\n'
+        
+        if as_array:
+            array = numpy.frombuffer(buf, numpy.uint8)
+            ends = numpy.flatnonzero(array == 10)
+            num_records = len(ends) // 4
+            ends = ends[:4*num_records]
+            leftover = buf[ends[-1]+1:] if num_records else buf
+            starts = numpy.concatenate([[0], ends[:-1]+1])
+            if ' ' in buf or '\t' in buf:
+                (starts, ends) = _stripped_spans(array, starts, ends)
+            (starts, ends) = [[x[i::4].tolist() for i in range(4)]
+                    for x in (starts, ends)]
+            labels = [buf[start:end]
+                    for (start, end) in izip(starts[0], ends[0])]
+            pluses = [buf[start:end]
+                    for (start, end) in izip(starts[2], ends[2])]
+        else:
+            lines = buf.split('\n')
+            num_records = (len(lines) - 1) // 4
+            leftover = '\n'.join(lines[4*num_records:])
+            del lines[4*num_records:]
+            if ' ' in buf or '\t' in buf:
+                lines = [line.strip() for line in lines]
+            labels = lines[0::4]
+            pluses = lines[2::4]
+        
+        if strict:
+            for (label, plus) in izip(labels, pluses):
+                if label[:1] != '@' or plus[:1] != '+' or \
+                        (len(plus) > 1 and label[1:] != plus[1:]):
+                    raise RecordError('Invalid format: %s -- %s' %
+                            (label, plus))
+        
+        if as_array:
+            for (label, seq_start, seq_end, qual_start, qual_end) in izip(
+                    labels, starts[1], ends[1], starts[3], ends[3]):
+                yield (label[1:], array[seq_start:seq_end],
+                        array[qual_start:qual_end])
+        else:
+            records = iter(lines)
+            for (label, seq, plus, qual) in izip(
+                    records, records, records, records):
+                yield label[1:], seq, qual
+        
+        if at_end:
+            break
+    
+    if leftover.strip():
+        raise RecordError('Incomplete record at end of file: %s' % leftover)
+    
+    if opened:
+        data.close()
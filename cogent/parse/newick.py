@@ -131,6 +131,38 @@ class _Tokeniser(object):
                 self.token = token
                 yield token  
 
+
+class _BulkTokeniser(_Tokeniser):
+    """Supplies the same tokens as _Tokeniser but for text without quotes
+    or comments, which can be split into labels and punctuation in one go
+    rather than a word at a time.  Much faster for large trees, but errors
+    aren't located, so the text should be reparsed with _Tokeniser to
+    report them.
+    """
+    
+    _split = re.compile("([(),:;\\n])").split
+    
+    def error(self, detail=""):
+        return TreeParseError(detail)
+    
+    def tokens(self):
+        self.token = None
+        pieces = self._split(self.text)
+        # labels, or just whitespace, alternate with the delimiters
+        labels = [text.strip() for text in pieces[::2]]
+        if self.underscore_unmunge and '_' in self.text:
+            labels = [text.replace('_', ' ') for text in labels]
+        pieces[::2] = labels
+        pieces.append(EOT)
+        return iter([token for token in pieces
+                if token != '' and token != '\n'])
+
+def _quotes_or_comments(text):
+    for c in '\'"[]':
+        if c in text:
+            return True
+    return False
+
 def parse_string(text, constructor, **kw):
     """Parses a Newick-format string, using specified constructor for tree.
     
@@ -143,12 +175,20 @@ def parse_string(text, constructor, **kw):
     if "(" not in text and ";" not in text and text.strip():
          # otherwise "filename" is a valid (if small) tree
         raise TreeParseError('Not a Newick tree: "%s"' % text[:10])
+    if not kw.get('strict_labels') and not _quotes_or_comments(text):
+        try:
+            return _parse_tokens(_BulkTokeniser(text, **kw), constructor)
+        except TreeParseError:
+            # reparse to locate the error
+            pass
+    return _parse_tokens(_Tokeniser(text, **kw), constructor)
+
+def _parse_tokens(tokeniser, constructor):
     sentinals = [';', EOT]
     stack = []
     nodes = []
     children = name = expected_attribute = None
     attributes = {}
-    tokeniser = _Tokeniser(text, **kw)
     for token in tokeniser.tokens():
         if expected_attribute is not None:
             (attr_name, attr_cast) = expected_attribute
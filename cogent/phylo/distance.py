@@ -2,9 +2,11 @@
 """Estimating pairwise distances between sequences.
 """
 from warnings import warn
+import hashlib
 from itertools import combinations
 
-from cogent.util import parallel, table, warning, progress_display as UI
+from cogent.util import parallel, table, warning, checkpointing, \
+        progress_display as UI
 from cogent.maths.stats.util import Numbers
 from cogent import LoadSeqs, LoadTree
 
@@ -177,18 +179,68 @@ class EstimateDistances(object):
             
         return result
     
+    def _signature(self, dist_opt_args, aln_opt_args):
+        """what must match for estimates in a checkpoint file to be reused:
+        the model, its moltype, each sequence, and how the estimation is
+        done"""
+        def describe(f):
+            if f is None:
+                return None
+            return (getattr(f, '__module__', None),
+                    getattr(f, '__name__', type(f).__name__))
+        
+        seqs = [(name, hashlib.md5(str(
+                self._seq_collection.NamedSeqs[name])).hexdigest())
+                for name in self._seqnames]
+        motif_probs = self._motif_probs
+        if isinstance(motif_probs, dict):
+            motif_probs = sorted(motif_probs.items())
+        return (str(self._sm), repr(self._sm.MolType), seqs,
+                repr(motif_probs), self._do_pair_align, self._rigorous_align,
+                describe(self._modify_lf), sorted(dist_opt_args.items()),
+                sorted(aln_opt_args.items()))
+    
+    def _checkpoint_state(self):
+        return (self._threeway, self._est_params, self._signature_used,
+                self._param_ests)
+    
+    def _restore(self, checkpointer):
+        (threeway, est_params, signature, param_ests) = checkpointer.load()
+        if (threeway, est_params) != (self._threeway, self._est_params):
+            raise ValueError(
+                "Estimation doesn't match checkpoint file '%s': threeway=%s "\
+                "est_params=%s in file." % (
+                    checkpointer.filename, threeway, est_params))
+        if signature != self._signature_used:
+            raise ValueError(
+                "Estimation doesn't match checkpoint file '%s': the model, "\
+                "sequences or optimisation arguments differ." %
+                    checkpointer.filename)
+        names = set(self._seqnames)
+        for comp in param_ests:
+            if names.issuperset(comp):
+                self._param_ests[comp] = param_ests[comp]
+    
     @UI.display_wrap
-    def run(self, dist_opt_args=None, aln_opt_args=None, ui=None, **kwargs):
+    def run(self, dist_opt_args=None, aln_opt_args=None, filename=None,
+            interval=None, ui=None, **kwargs):
         """Start estimating the distances between sequences. Distance estimation
         is done using the Powell local optimiser. This can be changed using the
-        dist_opt_args and aln_opt_args.
+        dist_opt_args and aln_opt_args.  The sequence pairs (or triads) are
+        shared out across the CPUs of the current cogent.util.parallel
+        context.
         
         Arguments:
             - show_progress: whether to display progress. More detailed progress
               information from individual optimisation is controlled by the
               ..opt_args.
             - dist_opt_args, aln_opt_args: arguments for the optimise method for
-              the distance estimation and alignment estimation respectively."""
+              the distance estimation and alignment estimation respectively.
+            - filename, interval: the estimates done so far are checkpointed
+              to filename every interval seconds, and if filename already
+              exists the run resumes from the estimates it holds.  The file
+              must be from a run with the same model, sequences, modify_lf
+              and optimisation arguments, or a ValueError is raised."""
         
         if 'local' in kwargs:
               warn("local argument ignored, provide it to dist_opt_args or"\
@@ -208,15 +260,30 @@ class EstimateDistances(object):
         else:
             combination_aligns = get_name_combinations(self._seq_collection.Names, 2)
             desc = "pair "
+        
+        self._signature_used = self._signature(dist_opt_args, aln_opt_args)
+        # only estimates restored from the checkpoint file are reused
+        self._param_ests = {}
+        checkpointer = checkpointing.Checkpointer(filename, interval)
+        if checkpointer.available():
+            self._restore(checkpointer)
+        combination_aligns = [comp for comp in combination_aligns
+                if comp not in self._param_ests]
         labels = [desc + ','.join(names) for names in combination_aligns]
                             
         def _one_alignment(comp):
             result = self._doset(comp, dist_opt_args, aln_opt_args)
             return (comp, result)
         
-        for (comp, value) in ui.imap(_one_alignment, combination_aligns,
-                labels=labels):
-            self._param_ests[comp] = value
+        if combination_aligns:
+            with parallel.registered(_one_alignment):
+                for (comp, value) in ui.imap(_one_alignment,
+                        combination_aligns, labels=labels):
+                    self._param_ests[comp] = value
+                    checkpointer.record(self._checkpoint_state(),
+                            "%s %ss done" % (len(self._param_ests),
+                            desc.strip()))
+        checkpointer.record(self._checkpoint_state(), always=True)
     
     def getPairwiseParam(self, param, summary_function="mean"):
         """Return the pairwise statistic estimates as a dictionary keyed by
@@ -25,12 +25,9 @@ def _ancestry2paths(A):
     split metric matrix.  The paths will be in the same triangular matrix order 
     as produced by distanceDictAndNamesTo1D, provided that the tips appear in 
     the correct order in A"""
-    tips = [i for i in range(A.shape[0]) if sum(A[:,i])==1]
-    paths = []
-    for (tip1, tip2) in triangularOrder(tips):
-        path = A[tip1] ^ A[tip2]
-        paths.append(path)
-    return numpy.array(paths)
+    tips = numpy.flatnonzero(A.sum(axis=0) == 1)
+    pairs = numpy.array(list(triangularOrder(tips)), int).reshape([-1, 2])
+    return A[pairs[:, 0]] ^ A[pairs[:, 1]]
 
 class WLS(TreeEvaluator):
     """(err, best_tree) = WLS(dists).trex()"""
@@ -73,6 +70,26 @@ class WLS(TreeEvaluator):
             return (err, lengths)
         return evaluate
     
+    def makeTreeBatchScorer(self, names):
+        """As makeTreeScorer, but solves for the lengths of a list of
+        trees of the same size as one stack of equations"""
+        dists = distanceDictAndNamesTo1D(self.dists, names)
+        weights = distanceDictAndNamesTo1D(self.weights, names)
+        weights_dists = weights * dists
+        def evaluate_batch(ancestries):
+            if not ancestries:
+                return []
+            A = numpy.array([_ancestry2paths(a) for a in ancestries])
+            At = numpy.transpose(A, [0, 2, 1])
+            X = numpy.matmul(weights * At, A)
+            y = numpy.matmul(At, weights_dists)
+            lengths = solve_linear_equations(X, y[..., numpy.newaxis])
+            lengths = numpy.maximum(lengths[..., 0], 0.0)
+            diffs = numpy.matmul(A, lengths[..., numpy.newaxis])[..., 0] - dists
+            errs = numpy.sum(diffs**2, axis=-1)
+            return zip(errs.tolist(), lengths)
+        return evaluate_batch
+    
     def result2output(self, err, ancestry, lengths, names):
         return (err, ancestry2tree(ancestry, lengths, names))
 
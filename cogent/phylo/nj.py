@@ -7,6 +7,10 @@ This is based on the algorithm of Studier and Keppler, as described in the book
 Biological sequence analysis by Durbin et al
 
 Generalised as described by Pearson, Robins & Zhang, 1999.
+
+Plain NJ, where only the one best tree is kept, is done by ArrayNJ, which
+can optionally find each join as described for RapidNJ by Simonsen, Mailund
+& Pedersen, 2008.
 """
 
 from __future__ import division
@@ -28,21 +32,21 @@ __email__ = "gavin.huttley@anu.edu.au"
 __status__ = "Production"
 
 class LightweightTreeTip(str):
-    def convert(self, constructor, length):
+    def convert(self, constructor, length, no_negatives=True):
         node = constructor([], str(self), {})
-        node.Length = max(0.0, length)
+        node.Length = max(0.0, length) if no_negatives else length
         return node
         
 class LightweightTreeNode(frozenset):
     """Set of (length, child node) tuples"""
-    def convert(self, constructor=None, length=None):
+    def convert(self, constructor=None, length=None, no_negatives=True):
         if constructor is None:
             constructor = TreeBuilder().createEdge
-        children = [child.convert(constructor, clength) 
+        children = [child.convert(constructor, clength, no_negatives) 
                 for (clength, child) in self]
         node = constructor(children, None, {})
         if length is not None:
-            node.Length = max(0.0, length)
+            node.Length = max(0.0, length) if no_negatives else length
         return node
         
     def __or__(self, other):
@@ -269,12 +273,194 @@ def gnj(dists, keep=None, dkeep=0, ui=None):
     return ScoredTreeCollection(result)
 
 
-def nj(dists, no_negatives=True):
+class ArrayNJ(object):
+    """Neighbour joining on a distance matrix held in a single array.  Each
+    join is done in place: the new node takes the place of one of the pair
+    and the last row and column move into the place of the other, so the
+    current matrix is always d[:L, :L].  Row sums are updated rather than
+    recalculated, and the join scores are calculated a block of rows at a
+    time, so no other array the size of the distance matrix is needed.
+    
+    With rapid=True the best join is found RapidNJ style, with every row's
+    distances also kept sorted (in single precision) so the search of a
+    row can stop once a lower bound on the rest of it can't beat the best
+    join found so far.
+    Nodes then also have ids, as the sorted rows refer to nodes which
+    may since have been joined.  The sorted rows are rebuilt whenever half
+    of the nodes have gone, to shed those."""
+    
+    _PAD = -1
+    _BLOCK = 2**16
+    
+    def __init__(self, d, nodes, rapid=False):
+        self.d = numpy.array(d, float)
+        self.nodes = list(nodes)
+        self.L = len(self.nodes)
+        self.r = self.d.sum(axis=0)
+        self.rapid = rapid
+        if rapid:
+            n = self.L
+            self.ids = numpy.arange(n)
+            # slot of each node id, -1 once joined.  The extra final entry
+            # is for _PAD, which pads out the sorted rows.
+            self.slot_of = numpy.empty([2*n+1], int)
+            self.slot_of.fill(-1)
+            self.slot_of[:n] = self.ids
+            self.next_id = n
+            self._sortRows()
+    
+    def _sortRow(self, i, values, width):
+        # values of row i, without its own, ascending, in single precision
+        # but never more than the real values, as they are used as bounds.
+        order = numpy.argsort(values)[:width]
+        S = values[order].astype(numpy.float32)
+        too_big = S > values[order]
+        S[too_big] = numpy.nextafter(S[too_big], -numpy.inf)
+        self.S[i, :width] = S
+        self.I[i, :width] = self.ids[order]
+        self.S[i, width:] = numpy.inf
+        self.I[i, width:] = self._PAD
+    
+    def _sortRows(self):
+        L = self.L
+        self.S = numpy.empty([L, L-1], numpy.float32)
+        self.I = numpy.empty([L, L-1], numpy.int32)
+        for i in range(L):
+            values = self.d[i, :L].copy()
+            values[i] = numpy.inf
+            self._sortRow(i, values, L-1)
+        self.rebuild_at = L // 2
+    
+    def _bestJoin(self):
+        L = self.L
+        r = self.r[:L]
+        (q_best, best) = (numpy.inf, None)
+        step = max(1, self._BLOCK // L)
+        for start in range(0, L, step):
+            end = min(start + step, L)
+            q = (L-2) * self.d[start:end, :L]
+            q -= r[start:end, None]
+            q -= r[None, :]
+            q[numpy.arange(end-start), numpy.arange(start, end)] = numpy.inf
+            (k, c) = divmod(int(q.argmin()), L)
+            if q[k, c] < q_best:
+                (q_best, best) = (q[k, c], (start+k, c))
+        return best
+    
+    def _rapidBestJoin(self):
+        L = self.L
+        r = self.r[:L]
+        r_max = r.max()
+        (S, I, slot_of) = (self.S, self.I, self.slot_of)
+        width = S.shape[1]
+        rows = numpy.arange(L)
+        (q_best, best) = (numpy.inf, None)
+        (start, chunk) = (0, 4)
+        while len(rows) and start < width:
+            end = min(start + chunk, width)
+            slots = slot_of[I[rows, start:end]]
+            q = (L-2) * self.d[rows[:, None], slots]
+            q -= r[rows][:, None]
+            q -= r[slots]
+            q[slots < 0] = numpy.inf
+            (k, c) = divmod(int(q.argmin()), end-start)
+            if q[k, c] < q_best:
+                (q_best, best) = (q[k, c], (rows[k], slots[k, c]))
+            start = end
+            chunk *= 2
+            if start < width:
+                # no later entry in a row is smaller than this one
+                bound = (L-2) * S[rows, start] - r[rows] - r_max
+                rows = rows[bound < q_best]
+        return best
+    
+    def join(self, i, j):
+        """Replace nodes i and j with a new node joining them"""
+        (i, j) = (min(i, j), max(i, j))
+        L = self.L
+        (d, r, nodes) = (self.d, self.r, self.nodes)
+        
+        # Branch lengths from i and j to new node
+        ij_dist_diff = (r[i]-r[j]) / (L-2.0)
+        left_length = 0.5 * (d[i,j] + ij_dist_diff)
+        right_length = 0.5 * (d[i,j] - ij_dist_diff)
+        new_node = LightweightTreeNode(
+                [(left_length, nodes[i]), (right_length, nodes[j])])
+        
+        # Store new node at i, leaving j to be overwritten
+        new_dists = 0.5 * (d[i, :L] + d[j, :L] - d[i,j])
+        r[:L] += new_dists - d[i, :L] - d[j, :L]
+        r[i] = new_dists.sum()
+        d[i, :L] = new_dists
+        d[:L, i] = new_dists
+        nodes[i] = new_node
+        
+        # Move the last node to j
+        last = L - 1
+        if j != last:
+            d[j, :L] = d[last, :L]
+            d[:L, j] = d[:L, last]
+            r[j] = r[last]
+            nodes[j] = nodes[last]
+        nodes.pop()
+        self.L = L = L - 1
+        
+        if self.rapid:
+            self.slot_of[self.ids[[i, j]]] = -1
+            self.ids[i] = self.next_id
+            self.next_id += 1
+            if j != last:
+                self.ids[j] = self.ids[last]
+                self.S[j] = self.S[last]
+                self.I[j] = self.I[last]
+            self.slot_of[self.ids[:L]] = numpy.arange(L)
+            if L <= self.rebuild_at:
+                self._sortRows()
+            else:
+                new_dists = d[i, :L].copy()
+                new_dists[i] = numpy.inf
+                self._sortRow(i, new_dists, L-1)
+    
+    def joinBest(self):
+        """Join the best pair of nodes"""
+        if self.rapid:
+            (i, j) = self._rapidBestJoin()
+        else:
+            (i, j) = self._bestJoin()
+        self.join(i, j)
+    
+    def getTree(self, no_negatives=True):
+        assert self.L == 3
+        d = self.d[:3, :3]
+        lengths = numpy.sum(d, axis=0) - numpy.sum(d)/4
+        root = LightweightTreeNode(zip(lengths, self.nodes))
+        tree = root.convert(no_negatives=no_negatives)
+        tree.Name = "root"
+        return tree
+    
+
+@UI.display_wrap
+def nj(dists, no_negatives=True, rapid=False, ui=None):
     """Arguments:
-        - dists: dict of (name1, name2): distance
-        - no_negatives: negative branch lengths will be set to 0
+        - dists: dict of (name1, name2): distance, or a (names, square
+          distance array) tuple
+        - no_negatives: negative branch lengths will be set to 0,
+          otherwise they are kept
+        - rapid: use the RapidNJ search for each join, which does less
+          work than checking every pair but needs another 2 arrays the
+          size of the distance matrix.
     """
-    (result,) = gnj(dists, keep=1)
-    (score, tree) = result
-    return tree
+    if isinstance(dists, dict):
+        (names, d) = distanceDictTo2D(dists)
+    else:
+        (names, d) = dists
+    nodes = [LightweightTreeTip(name) for name in names]
+    engine = ArrayNJ(d, nodes, rapid=rapid)
+    total = engine.L - 3
+    while engine.L > 3:
+        if engine.L % 100 == 0:
+            ui.display('%s nodes left' % engine.L,
+                    progress=1.0 - (engine.L - 3) / total)
+        engine.joinBest()
+    return engine.getTree(no_negatives)
 
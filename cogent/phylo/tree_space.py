@@ -114,11 +114,30 @@ def grown(B, split_edge):
     A[split_edge,parent] = 1
     return A
 
+def edge_chunks(tree_count, edge_count, cpus):
+    """(tree, edges) jobs covering every edge of every tree, with each
+    tree's edges split into enough chunks to make at least 'cpus' jobs
+    where possible"""
+    chunks = min(edge_count, max(1, -(-cpus // max(tree_count, 1))))
+    bounds = [edge_count * i // chunks for i in range(chunks+1)]
+    return [(tree, range(start, end)) for tree in range(tree_count)
+            for (start, end) in zip(bounds[:-1], bounds[1:])]
+
 class TreeEvaluator(object):
-    """Subclass must provide makeTreeScorer and result2output"""
+    """Subclass must provide makeTreeScorer and result2output, and may
+    provide a makeTreeBatchScorer which is faster than scoring each tree
+    alone"""
     
     def results2output(self, results):
         return ScoredTreeCollection(results)
+    
+    def makeTreeBatchScorer(self, names):
+        """A function giving the optimal (err, lengths) for each of a list
+        of ancestry matrices"""
+        evaluate = self.makeTreeScorer(names)
+        def evaluate_batch(ancestries):
+            return [evaluate(ancestry) for ancestry in ancestries]
+        return evaluate_batch
         
     def evaluateTopology(self, tree):
         """Optimal (score, tree) for the one topology 'tree'"""
@@ -218,29 +237,46 @@ class TreeEvaluator(object):
             work_done.append(total_work)
         
         # For each tree size, grow at each edge of each tree. Keep best k.
-        for n in range(init_tree_size+1, tree_size+1):
-            evaluate = self.makeTreeScorer(names[:n])            
-
-            def grown_tree(spec):
-                (tree_ordinal, tree, split_edge) = spec
-                (old_err, old_lengths, old_ancestry) = tree
-                ancestry = grown(old_ancestry, split_edge)
-                (err, lengths) = evaluate(ancestry)
-                return (err, tree_ordinal, split_edge, lengths, ancestry)
-            
-            specs = [(i, tree, edge) 
-                        for (i,tree) in enumerate(trees) 
-                        for edge in range(n*2-5)]
-
-            candidates = ui.imap(grown_tree, specs, noun=('%s leaf tree' % n),
-                start=work_done[n-1]/total_work, end=work_done[n]/total_work)
-            
-            best = ismallest(candidates, k)
-            
-            trees = [(err, lengths, ancestry) for (err, parent_ordinal, 
-                    split_edge, lengths, ancestry) in best]
-            
-            checkpointer.record((n, names[:n], trees))
+        # Each parallel job scores the trees grown at one chunk of the edges
+        # of one tree together and returns its best k.  There are enough
+        # chunks to keep every CPU busy even when few trees are kept.
+        # Candidates are ordered by (err, parent, edge), so the best k of
+        # those is the same however the work was divided.  The one job
+        # function is registered, so the same workers serve every tree size,
+        # and are sent the parent tree with each job.  Only scores are sent
+        # back and the kept trees are regrown here.
+        cpus = parallel.getContext().size
+        scorers = {}
+        def grown_trees(job):
+            (n, tree_ordinal, old_ancestry, split_edges) = job
+            if n not in scorers:
+                scorers.clear()
+                scorers[n] = self.makeTreeBatchScorer(names[:n])
+            ancestries = [grown(old_ancestry, split_edge)
+                    for split_edge in split_edges]
+            candidates = [(err, tree_ordinal, split_edge, lengths)
+                    for (split_edge, (err, lengths))
+                    in zip(split_edges, scorers[n](ancestries))]
+            return ismallest(candidates, k)
+        
+        with parallel.registered(grown_trees):
+            for n in range(init_tree_size+1, tree_size+1):
+                jobs = [(n, tree_ordinal, trees[tree_ordinal][2], split_edges)
+                        for (tree_ordinal, split_edges)
+                        in edge_chunks(len(trees), n*2-5, cpus)]
+                
+                bests = ui.imap(grown_trees, jobs,
+                    noun=('%s leaf tree' % n),
+                    start=work_done[n-1]/total_work,
+                    end=work_done[n]/total_work)
+                
+                best = ismallest(itertools.chain.from_iterable(bests), k)
+                
+                trees = [(err, lengths, grown(trees[parent_ordinal][2],
+                        split_edge)) for (err, parent_ordinal, split_edge,
+                        lengths) in best]
+                
+                checkpointer.record((n, names[:n], trees))
         
         results = (self.result2output(err, ancestry, lengths, names)
                     for (err, lengths, ancestry) in trees)
@@ -18,9 +18,11 @@ __status__ = "Production"
 def namesFromDistanceDict(dists):
     """Unique names from within the tuples which make up the keys of 'dists'"""
     names = []
+    seen = set()
     for key in dists:
         for name in key:
-            if name not in names:
+            if name not in seen:
+                seen.add(name)
                 names.append(name)
     return names
 
@@ -40,12 +42,22 @@ def distanceDictTo2D(dists):
     """(names, dists).  Distances converted into a straightforward distance
     matrix"""
     names = namesFromDistanceDict(dists)
+    index = dict([(name, i) for (i, name) in enumerate(names)])
     L = len(names)
-    d = numpy.zeros([L, L], Float)
-    for (i, a) in enumerate(names):
-        for (j, b) in enumerate(names):
-            if i != j:
-                d[i, j] = lookupSymmetricDict(dists, a, b)
+    d = numpy.empty([L, L], Float)
+    d.fill(numpy.nan)
+    for ((a, b), value) in dists.iteritems():
+        (i, j) = (index[a], index[b])
+        if i == j or value is None:
+            continue
+        if d[i, j] == d[i, j] and d[i, j] != value:
+            raise ValueError("d[%s,%s] != d[%s,%s]" % (a,b,b,a))
+        d[i, j] = d[j, i] = value
+    numpy.fill_diagonal(d, 0.0)
+    missing = numpy.isnan(d)
+    if missing.any():
+        (i, j) = [int(k[0]) for k in missing.nonzero()]
+        raise KeyError((names[i], names[j]))
     return (names, d)
 
 def triangularOrder(keys):
@@ -217,6 +217,9 @@ class Calculator(object):
         self.recycled_cells = [
                 cell.rank for cell in self._cells if cell.recycled]
         self.spare = [None] * len (self._cells)
+        # Ranks of the cells which may hold different values in the two
+        # data sets.  Initially that is anything primed separately in each.
+        self._unsynced = range(len(self._cells))
         
         for cell in self._cells[::-1]:
             for arg in cell.args:
@@ -396,6 +399,28 @@ class Calculator(object):
     
     __call__ = testoptparvector
     
+    def gradient(self, values, ranks=None, epsilon=1e-6):
+        """Forward difference estimate of the gradient at 'values'.  Only
+        the optimisable parameters numbered in 'ranks' (default all) are
+        done, others are left as 0.0.  Cheap since each step only
+        recalculates what depends on one parameter.  The calculator is
+        left at 'values'."""
+        values = list(values)
+        f0 = self.testoptparvector(values)
+        (lower, upper) = self.getBoundsVectors()
+        result = numpy.zeros([len(values)], Float)
+        if ranks is None:
+            ranks = range(len(values))
+        for i in ranks:
+            h = epsilon * max(abs(values[i]), 1.0)
+            if values[i] + h > upper[i]:
+                h = -h
+            x = values[:]
+            x[i] += h
+            result[i] = (self.testoptparvector(x) - f0) / h
+        self.testoptparvector(values)
+        return result
+    
     def testfunction(self):
         """Return the current output value without changing any inputs"""
         return self._getCurrentCellValue(self._cells[-1])
@@ -430,11 +455,18 @@ class Calculator(object):
             data = self.cell_values[self._switch]
             base = self.cell_values[not self._switch]
             
+            # Only the cells set by the previous step can differ between
+            # the two data sets, so only they need copying across.  That
+            # keeps the cost of a step proportional to the length of its
+            # program, eg: the path from one edge to the root.
             # recycle and undo interact in bad ways
-            for rank in self.recycled_cells:
-                if data[rank] is not base[rank]:
+            cells = self._cells
+            for rank in self._unsynced:
+                if cells[rank].recycled and data[rank] is not base[rank]:
                     self.spare[rank] = data[rank]
-            data[:] = base[:]
+                data[rank] = base[rank]
+            self._unsynced = [i for (i, v) in changes] + [
+                    cell.rank for cell in program]
             for cell in program:
                 if cell.recycled:
                     if data[cell.rank] is base[cell.rank]:
@@ -637,3 +669,44 @@ class Calculator(object):
         return tuple(triple)
         
     
+    
+
+class ShardedCalculator(Calculator):
+    """A Calculator for which the optimiser's evaluations are done by
+    persistent worker processes, each with its own Calculator over a
+    shard of the data.  'shards' is a parallel.ShardedFunction taking
+    the optimiser vector and returning each shard's part of the sum.
+    This process's own cells are only brought up to date when the
+    optimisation ends."""
+    
+    def __init__(self, cells, defns, shards=None, **kw):
+        self.shards = shards
+        self._sharded_values = None
+        Calculator.__init__(self, cells, defns, **kw)
+    
+    def testoptparvector(self, values):
+        if self.shards is None:
+            return Calculator.testoptparvector(self, values)
+        assert len(values) == len(self.opt_pars)
+        values = [float(v) for v in values]
+        self.evaluations += 1
+        self._sharded_values = values
+        return sum(self.shards(values))
+    
+    __call__ = testoptparvector
+    
+    def close(self):
+        """Stop the worker processes and catch up with their last input"""
+        if self.shards is not None:
+            self.shards.close()
+            self.shards = None
+        if self._sharded_values is not None:
+            Calculator.testoptparvector(self, self._sharded_values)
+            self._sharded_values = None
+    
+    def optimise(self, **kw):
+        try:
+            Calculator.optimise(self, **kw)
+        finally:
+            self.close()
+    
@@ -1,10 +1,11 @@
 #!/usr/bin/env python
 from __future__ import division, with_statement
 import warnings
+import multiprocessing
 import numpy
 from contextlib import contextmanager
 from .setting import Var, ConstVal
-from .calculation import Calculator
+from .calculation import Calculator, ShardedCalculator
 from cogent.util import parallel
 from cogent.maths.stats.distribution import chdtri
 from cogent.maths.optimisers import MaximumEvaluationsReached
@@ -789,20 +790,47 @@ class ParameterController(object):
     def getNumFreeParams(self):
         return sum(defn.getNumFreeParams() for defn in self.defns if isinstance(defn, _LeafDefn))
 
+    def _makeGradientFunction(self, calc):
+        return calc.gradient
+    
+    def _makeShardCalculator(self, rank, size):
+        # Runs in a worker process, on its own copy of self
+        comm = parallel.ShardCommunicator(rank, size)
+        self.assignAll('parallel_context', value=comm, const=True)
+        return self.makeCalculator()
+    
+    def _makeOptimisableCalculator(self):
+        # With local worker processes available and a function which is
+        # a sum over whatever 'parallel_context' divides up, eg: alignment
+        # columns, give each worker a share to keep and evaluate.  Not
+        # possible from within a pool worker as they can't have children.
+        context = self.overall_parallel_context
+        if (isinstance(context, parallel.MultiprocessingParallelContext)
+                and context.size > 1 and 'parallel_sum' in self.defn_for
+                and self.remaining_parallel_context is parallel.NONE
+                and not multiprocessing.current_process().daemon):
+            shards = context.shardedFunction(self._makeShardCalculator)
+            return self.makeCalculator(calculatorClass=ShardedCalculator,
+                    shards=shards)
+        return self.makeCalculator()
+    
     def optimise(self, local=None, 
             filename=None, interval=None,
             limit_action='warn',  max_evaluations=None, 
-            tolerance=1e-6, global_tolerance=1e-1, **kw):
+            tolerance=1e-6, global_tolerance=1e-1, gradient=False, **kw):
         """Find input values that optimise this function.
         'local' controls the choice of optimiser, the default being to run
         both the global and local optimisers. 'filename' and 'interval'
-        control checkpointing.  Unknown keyword arguments get passed on to
-        the optimiser(s)."""
+        control checkpointing.  'gradient' makes the local optimiser
+        a quasi-Newton one using the gradient of the function.  Unknown
+        keyword arguments get passed on to the optimiser(s)."""
         return_calculator = kw.pop('return_calculator', False) # only for debug
         for n in ['local', 'filename', 'interval', 'max_evaluations', 
                 'tolerance', 'global_tolerance']:
             kw[n] = locals()[n]
-        lc = self.makeCalculator()
+        lc = self._makeOptimisableCalculator()
+        if gradient:
+            kw['gradient'] = self._makeGradientFunction(lc)
         try:
             lc.optimise(**kw)
         except MaximumEvaluationsReached, detail:
@@ -650,3 +650,20 @@ def mutate_array(a, sd, mean=0):
     """Return mutated copy of the array (or vector), adding mean +/- sd."""
     return a + normal(mean, sd, a.shape)
 
+
+def sparse_nonzero(data):
+    """Returns (shape, row, col, values) of the nonzero values of a sparse
+    matrix, e.g. from scipy.sparse, in order of row.
+
+    Only the shape, indptr, indices and data of data.tocsr() are used, so the
+    matrix is never made dense.  Duplicate entries are summed first where
+    the matrix supports it, and explicitly stored zeros are dropped.
+    """
+    data = data.tocsr()
+    if hasattr(data, 'sum_duplicates'):
+        data.sum_duplicates()
+    row = repeat(arange(data.shape[0]), numpy.diff(data.indptr))
+    col = numpy.asarray(data.indices)
+    values = numpy.asarray(data.data)
+    keep = values != 0
+    return data.shape, row[keep], col[keep], values[keep]
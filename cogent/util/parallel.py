@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 from __future__ import with_statement
 import os, sys
+import atexit
 from contextlib import contextmanager
 import warnings
 import threading
@@ -41,6 +42,19 @@ class _FakeCommunicator(object):
 
 FAKE_MPI_COMM = _FakeCommunicator()
 
+class ShardCommunicator(_FakeCommunicator):
+    """Looks like one CPU of an MPI communicator to code which divides its
+    work up by rank, eg: LikelihoodTreeEdge.parallelShare(), but reductions
+    only see the local value.  Combining the shards is left to whoever
+    collects the results from the worker processes."""
+    def __init__(self, rank, size):
+        self.rank = rank
+        self.size = size
+    def Get_rank(self):
+        return self.rank
+    def Get_size(self):
+        return self.size
+
 class _FakeMPI(object):
     # required MPI module constants
     SUM = MAX = DOUBLE = 'fake'
@@ -145,8 +159,102 @@ class MPIParallelContext(ParallelContext):
                     yield results
 
 
-# Helping MultiprocessingParallelContext map unpicklable functions
+# Helping MultiprocessingParallelContext map unpicklable functions.  Worker
+# processes get these by being forked, so nothing here is ever pickled.
 _FUNCTIONS = {}
+_REGISTERED = set()
+_POOLS = {}
+# seeded_imap's wrappers of registered functions, registered along with them
+_SEEDED = {}
+
+def _forget(key):
+    # ids can be reused once the function is gone
+    _FUNCTIONS.pop(key, None)
+    for pool in _POOLS.values():
+        pool.keys.discard(key)
+
+def _register(f):
+    key = id(f)
+    _forget(key)
+    _FUNCTIONS[key] = f
+    _REGISTERED.add(key)
+
+def _unregister(f):
+    key = id(f)
+    _REGISTERED.discard(key)
+    _forget(key)
+
+def register(f):
+    """Keep f available to the worker processes of all pools started from
+    now on, so that later imap(f, ...) and seeded_imap(f, ...) calls can
+    reuse those workers.  Workers see f, and whatever it refers to (eg: an
+    alignment), as they were when they started.  Register f again after
+    changing any of that."""
+    seeded_f = _SEEDED.pop(id(f), None)
+    if seeded_f is not None:
+        _unregister(seeded_f)
+    _register(f)
+    seeded_f = _SEEDED[id(f)] = _seeded(f)
+    _register(seeded_f)
+    return f
+
+def unregister(f):
+    seeded_f = _SEEDED.pop(id(f), None)
+    if seeded_f is not None:
+        _unregister(seeded_f)
+    _unregister(f)
+
+@contextmanager
+def registered(*functions):
+    """register() the functions for the duration of a with block, eg: the
+    functions a long calculation will map many times, so that one set of
+    worker processes serves all of those imap calls.  Registering them all
+    before the first imap call lets one pool know all of them.  Idle
+    worker processes are stopped once no functions remain registered."""
+    for f in functions:
+        register(f)
+    try:
+        yield
+    finally:
+        for f in functions:
+            unregister(f)
+        if not _REGISTERED:
+            close_pools()
+
+class _WorkerPool(object):
+    """A multiprocessing.Pool kept for reuse, with a note of the functions
+    its workers inherited"""
+    def __init__(self, size, initializer):
+        self.pool = multiprocessing.Pool(size, initializer)
+        self.keys = set(_FUNCTIONS)
+        self.busy = 0
+    
+    def knows(self, f):
+        key = id(f)
+        return key in self.keys and _FUNCTIONS.get(key) is f
+    
+    def imap(self, f, s, chunksize):
+        self.busy += 1
+        try:
+            for result in self.pool.imap(PicklableAndCallable(id(f)), s,
+                    chunksize=chunksize):
+                yield result
+        finally:
+            self.busy -= 1
+    
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+def close_pools():
+    """Stop the worker processes of any idle pools"""
+    for (size, pool) in _POOLS.items():
+        if not pool.busy:
+            pool.close()
+            del _POOLS[size]
+
+atexit.register(close_pools)
+
 class PicklableAndCallable(object):
     def __init__(self, key):
         self.key = key
@@ -159,14 +267,90 @@ class PicklableAndCallable(object):
                 raise RuntimeError
         return self.func(*args, **kw)
     
+def _shardWorker(connection, make_function, rank, size, initializer):
+    if initializer is not None:
+        initializer()
+    try:
+        f = make_function(rank, size)
+    except Exception, detail:
+        connection.send((False, detail))
+        return
+    connection.send((True, None))
+    while True:
+        args = connection.recv()
+        if args is None:
+            break
+        try:
+            result = (True, f(*args))
+        except Exception, detail:
+            result = (False, detail)
+        connection.send(result)
+    connection.close()
+
+class ShardedFunction(object):
+    """One function per worker process, each made once by
+    make_function(rank, size) in its own process and kept there.  Calling
+    this sends the same arguments to each and returns the list of their
+    results, so only arguments and results ever need pickling.  Relies on
+    fork() for make_function to reach the workers."""
+    
+    def __init__(self, make_function, size, initializer=None):
+        self.size = size
+        self.connections = []
+        self.processes = []
+        for rank in range(size):
+            (here, there) = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_shardWorker,
+                    args=(there, make_function, rank, size, initializer))
+            process.daemon = True
+            process.start()
+            there.close()
+            self.connections.append(here)
+            self.processes.append(process)
+        try:
+            self._collect()
+        except:
+            self.close()
+            raise
+    
+    def _collect(self):
+        results = [connection.recv() for connection in self.connections]
+        for (ok, value) in results:
+            if not ok:
+                raise value
+        return [value for (ok, value) in results]
+    
+    def __call__(self, *args):
+        for connection in self.connections:
+            connection.send(args)
+        return self._collect()
+    
+    def close(self):
+        for (connection, process) in zip(self.connections, self.processes):
+            try:
+                connection.send(None)
+            except (IOError, EOFError):
+                pass
+            connection.close()
+            process.join()
+        self.connections = self.processes = []
+    
+
 class MultiprocessingParallelContext(ParallelContext):
     """At the outermost opportunity, this parallel context delegates all
     work to a multiprocessing.Pool.  
     Subprocesses may also make pools if the outer pool is more than half idle.
     
-    Ideally the pool would be reused for later tasks, but cogent code mostly 
-    uses map() with functions defined in local scopes, which are unpicklable,
-    so that is hacked around and pools are only ever used for one map() call"""
+    cogent code mostly uses map() with functions defined in local scopes,
+    which are unpicklable, so instead the workers inherit them by being
+    forked after the function is noted in a registry.  Pools, one per size,
+    are kept and reused for as long as they are only asked to map registered
+    functions their workers already have, so mapping a registered function
+    again skips the pool startup and any pickling of whatever data the
+    function uses.  Only the items and results are sent each time.  Any
+    other function gets a new pool, as its workers must see it as it is now.
+    Callers which map the same functions many times register them for the
+    duration with registered()."""
     
     def __init__(self, size=None):
         if size is None:
@@ -196,15 +380,40 @@ class MultiprocessingParallelContext(ParallelContext):
         from cogent.util import progress_display
         progress_display.CURRENT.context = progress_display.NULL_CONTEXT
 
-    def imap(self, f, s, chunksize=1):
+    def shardedFunction(self, make_function):
+        """A ShardedFunction with one persistent worker process per CPU"""
+        return ShardedFunction(make_function, self.size,
+                self._initWorkerProcess)
+    
+    def _getPool(self, f):
         key = id(f)
-        _FUNCTIONS[key] = f
-        f = PicklableAndCallable(id(f))
-        pool = multiprocessing.Pool(self.size, self._initWorkerProcess)
-        for result in pool.imap(f, s, chunksize=chunksize):
-            yield result
-        del _FUNCTIONS[key]
-        pool.close()
+        pool = _POOLS.get(self.size)
+        if key not in _REGISTERED:
+            # Workers only see f as it was when they were forked, so an
+            # unregistered f, which may have changed since, needs new ones
+            _FUNCTIONS[key] = f
+            return _WorkerPool(self.size, self._initWorkerProcess)
+        if pool is not None and pool.knows(f):
+            return pool
+        if pool is not None and pool.busy:
+            # Can't replace a pool still in use, eg: by an outer imap
+            return _WorkerPool(self.size, self._initWorkerProcess)
+        if pool is not None:
+            pool.close()
+        pool = _POOLS[self.size] = _WorkerPool(self.size,
+                self._initWorkerProcess)
+        return pool
+    
+    def imap(self, f, s, chunksize=1):
+        pool = self._getPool(f)
+        try:
+            for result in pool.imap(f, s, chunksize):
+                yield result
+        finally:
+            if _POOLS.get(self.size) is not pool:
+                pool.close()
+                if id(f) not in _REGISTERED:
+                    _FUNCTIONS.pop(id(f), None)
 
 
 class ContextStack(threading.local):
@@ -298,3 +507,30 @@ def sync_random(r):
 
 
     
+def _seeded(f):
+    from numpy.random import RandomState
+    def seeded_f(job):
+        (seed, number, item) = job
+        return f(item, RandomState([seed, number]).permutation)
+    return seeded_f
+
+def seeded_imap(f, items, seed=None, permutation_f=None):
+    """Yields f(item, permutation_f) for each of items, like imap.
+    
+    Without a permutation_f (or with numpy.random.permutation) each item
+    gets the permutation method of its own numpy RandomState, seeded from
+    seed and the item's number, and the items are spread over any parallel
+    processes, so a seed gives the same results however many processes
+    there are.  Without a seed one is drawn from numpy.random.  Any other
+    permutation_f is called in order in this process, as forked copies of
+    it would all repeat the same permutations.  As with imap, a registered
+    f can reuse worker processes."""
+    from numpy.random import randint, permutation
+    items = list(items)
+    if permutation_f is not None and permutation_f is not permutation:
+        return (f(item, permutation_f) for item in items)
+    if seed is None:
+        seed = randint(2**31)
+    seeded_f = _SEEDED.get(id(f)) or _seeded(f)
+    return imap(seeded_f, [(seed, number, item)
+            for (number, item) in enumerate(items)])
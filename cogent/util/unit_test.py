@@ -29,6 +29,9 @@ assertIsPermutation checks that you get a permutation of an expected result that
 differs from the original result, repeating the test a specified number of times
 before giving up and assuming that the result is always the same.
 
+assertSameWithProcesses checks that a result doesn't change when the work
+cogent.util.parallel shares out is done by several worker processes.
+
 """
 #from contextlib import contextmanager
 import numpy; from numpy import testing, array, asarray, ravel, zeros, \
@@ -91,6 +94,20 @@ class FakeRandom(object):
                 self._ptr = 0
         return self._data[self._ptr]
 
+class FakeCSR(object):
+    """Drop-in substitute for a scipy.sparse csr_matrix, made from a dense
+    2D array, with just the attributes code accepting sparse data uses."""
+    
+    def __init__(self, dense):
+        dense = asarray(dense)
+        self.shape = dense.shape
+        (row, self.indices) = dense.nonzero()
+        self.data = dense[row, self.indices]
+        self.indptr = numpy.searchsorted(row, numpy.arange(len(dense)+1))
+    
+    def tocsr(self):
+        return self
+
 class TestCase(orig_TestCase):
     """Adds some additional utility methods to unittest.TestCase.
 
@@ -552,6 +569,17 @@ class TestCase(orig_TestCase):
         (msg or 'Observed %s is not the same as expected %s' % \
         (`observed`, `expected`))
 
+    def assertSameWithProcesses(self, f, processes=2, msg=None):
+        """Fail if f() gives a different result when its parallel work is
+        spread over several worker processes.  Returns the result."""
+        from cogent.util import parallel
+        expected = f()
+        context = parallel.MultiprocessingParallelContext(processes)
+        with parallel.parallel_context(context):
+            observed = f()
+        self.assertEqual(observed, expected, msg)
+        return expected
+
     def assertNotSameObj(self, observed, expected, msg=None):
         """Fail if 'observed is expected'"""
         try:
@@ -27,8 +27,8 @@ except ImportError:
 
 numpy_version = re.split("[^\d]", numpy.__version__)
 numpy_version_info = tuple([int(i) for i in numpy_version if i.isdigit()])
-if numpy_version_info < (1, 3):
-    raise RuntimeError("Numpy-1.3 is required, %s found." % numpy_version)
+if numpy_version_info < (1, 10):
+    raise RuntimeError("Numpy-1.10 is required, %s found." % numpy_version)
 
 # Find arrayobject.h on any system
 numpy_include_dir = numpy.get_include()
@@ -147,7 +147,6 @@ setup(
         CythonExtension("cogent.align._pairwise_pogs"),
         CythonExtension("cogent.evolve._solved_models"),
         CythonExtension("cogent.evolve._likelihood_tree"),
-        CythonExtension("cogent.evolve._pairwise_distance"),
         CythonExtension("cogent.struct._asa"),
         CythonExtension("cogent.struct._contact"),
         CythonExtension("cogent.maths._period"),
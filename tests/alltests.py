@@ -76,6 +76,7 @@ def suite():
         'test_core.test_seq_aln_integration',
         'test_core.test_sequence',
         'test_core.test_tree',
+        'test_core.test_array_tree',
         'test_core.test_usage',
         'test_data.test_molecular_weight',
         'test_evolve.test_best_likelihood',
@@ -86,6 +87,7 @@ def suite():
         'test_evolve.test_substitution_model',
         'test_evolve.test_scale_rules',
         'test_evolve.test_likelihood_function',
+        'test_evolve.test_likelihood_tree',
         'test_evolve.test_newq',
         'test_evolve.test_pairwise_distance',
         'test_evolve.test_parameter_controller',
@@ -97,6 +99,7 @@ def suite():
         'test_maths.test_fit_function',
         'test_maths.test_geometry',
         'test_maths.test_matrix_logarithm',
+        'test_maths.test_matrix_exponentiation',
         'test_maths.test_matrix_exponential_integration',
         'test_maths.test_period',
         'test_maths.test_matrix.test_distance',
@@ -134,8 +137,10 @@ def suite():
         'test_parse.test_ct',
         'test_parse.test_cut',
         'test_parse.test_cutg',
+        'test_parse.test_dense_alignment',
         'test_parse.test_dialign',
         'test_parse.test_ebi',
+        'test_parse.test_faidx',
         'test_parse.test_fasta',
         'test_parse.test_fastq',
         'test_parse.test_gbseq',
@@ -150,6 +155,7 @@ def suite():
         'test_parse.test_meme',
         'test_parse.test_msms',
         'test_parse.test_ncbi_taxonomy',
+        'test_parse.test_newick',
         'test_parse.test_nexus',
         'test_parse.test_nupack',
         'test_parse.test_pdb',
@@ -192,6 +198,7 @@ def suite():
         'test_util.test_array',
         'test_util.test_dict2d',
         'test_util.test_misc',
+        'test_util.test_parallel',
         'test_util.test_organizer',
         'test_util.test_recode_alignment',
         'test_util.test_table.rst',
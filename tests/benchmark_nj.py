@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+"""Times neighbour joining of random additive trees of various sizes.
+Usage: benchmark_nj.py [number of tips ...]"""
+
+import sys
+import time
+import random
+import numpy
+from cogent.phylo.nj import nj
+
+__author__ = "Peter Maxwell"
+__copyright__ = "Copyright 2007-2016, The Cogent Project"
+__credits__ = ["Peter Maxwell"]
+__license__ = "GPL"
+__version__ = "1.9"
+__maintainer__ = "Peter Maxwell"
+__email__ = "pm67nz@gmail.com"
+__status__ = "Production"
+
+def random_distances(size, seed=0):
+    """(names, distance array) for a random tree, plus a little noise"""
+    random.seed(seed)
+    names = ['tip%s' % i for i in range(size)]
+    d = numpy.zeros([size, size])
+    # distance from each tip to the root of the subtree it is in so far
+    depth = numpy.zeros([size])
+    subtrees = [numpy.array([i]) for i in range(size)]
+    while len(subtrees) > 1:
+        (i, j) = sorted(random.sample(range(len(subtrees)), 2))
+        tips_j = subtrees.pop(j)
+        tips_i = subtrees.pop(i)
+        depth[tips_i] += random.random()
+        depth[tips_j] += random.random()
+        between = depth[tips_i][:, None] + depth[tips_j][None, :]
+        d[numpy.ix_(tips_i, tips_j)] = between
+        d[numpy.ix_(tips_j, tips_i)] = between.T
+        subtrees.append(numpy.concatenate([tips_i, tips_j]))
+    noise = numpy.triu(
+            numpy.random.RandomState(seed).normal(0, 0.01, d.shape), 1)
+    d += noise + noise.T
+    return (names, d)
+
+def test(size, rapid):
+    (names, d) = random_distances(size)
+    t0 = time.time()
+    nj((names, d), rapid=rapid, show_progress=False)
+    return time.time() - t0
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1000, 5000, 20000]
+    template = "%10s " * 3
+    print template % ('tips', 'plain', 'rapid')
+    for size in sizes:
+        print template % (size, '%.1f' % test(size, False),
+                '%.1f' % test(size, True))
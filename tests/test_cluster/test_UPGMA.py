@@ -6,7 +6,8 @@ from numpy import array
 import numpy
 Float = numpy.core.numerictypes.sctype2char(float)
 from cogent.cluster.UPGMA import find_smallest_index, condense_matrix, \
-        condense_node_order, UPGMA_cluster, inputs_from_dict2D, upgma
+        condense_node_order, UPGMA_cluster, inputs_from_dict2D, upgma, \
+        condensed_from_matrix
 from cogent.util.dict2d import Dict2D
 
 __author__ = "Rob Knight"
@@ -130,6 +131,42 @@ class UPGMATests(TestCase):
         self.assertEqual(str(tree), \
                 '(((a:0.5,b:0.5):1.75,c:2.25):5.875,(d:1.0,e:1.0):7.125);')
 
+    def test_condensed_from_matrix(self):
+        """condensed_from_matrix keeps the distances above the diagonal"""
+        condensed = condensed_from_matrix(self.matrix)
+        self.assertEqual(condensed.dtype, numpy.float32)
+        self.assertEqual(list(condensed),
+                [1, 4, 20, 22, 5, 21, 23, 10, 12, 2])
+        self.assertEqual(condensed_from_matrix(self.matrix, Float).dtype,
+                numpy.dtype(Float))
+    
+    def test_UPGMA_cluster_condensed(self):
+        """UPGMA_cluster works on a condensed matrix"""
+        condensed = condensed_from_matrix(self.matrix)
+        tree = UPGMA_cluster(condensed, self.node_order)
+        self.assertEqual(str(tree), \
+                '(((a:0.5,b:0.5):1.75,c:2.25):5.875,(d:1.0,e:1.0):7.125);')
+    
+    def test_UPGMA_cluster_closest_pairs(self):
+        """UPGMA_cluster should match repeatedly joining the closest pair"""
+        x = numpy.random.RandomState(0).random_sample([40, 40])
+        matrix = x + x.T
+        names = [str(i) for i in range(40)]
+        expected_nodes = map(PhyloNode, names)
+        expected_matrix = matrix.copy()
+        numpy.fill_diagonal(expected_matrix, 1e305)
+        for i in range(39):
+            index = find_smallest_index(expected_matrix)
+            condense_node_order(expected_matrix, index, expected_nodes)
+            condense_matrix(expected_matrix, index, 1e305)
+        expected = expected_nodes[0]
+        for m in [matrix.copy(), condensed_from_matrix(matrix, Float),
+                condensed_from_matrix(matrix)]:
+            tree = UPGMA_cluster(m, map(PhyloNode, names))
+            self.assertTrue(tree.sameTopology(expected))
+            self.assertFloatEqual(tree.tipToTipDistances()[0],
+                    expected.tipToTipDistances()[0], eps=1e-5)
+
     def test_inputs_from_dict2D(self):
         """inputs_from_dict2D makes an array object and PhyloNode list"""
         matrix = [('1', '2', 0.86), ('2', '1', 0.86), \
@@ -12,7 +12,7 @@ from cogent.core.alignment import SequenceCollection, \
     seqs_from_dict, seqs_from_aln, seqs_from_kv_pairs, seqs_from_empty, \
     aln_from_array, aln_from_model_seqs, aln_from_collection,\
     aln_from_generic, aln_from_fasta, aln_from_dense_aln, aln_from_empty, \
-    DenseAlignment, Alignment, DataError
+    DenseAlignment, Alignment, DataError, PackedDenseAlignment
 
 from cogent.core.moltype import AB, DNA
 from cogent.parse.fasta import MinimalFastaParser
@@ -1833,6 +1833,117 @@ class DenseAlignmentSpecificTests(TestCase):
         e = array([0,0,1,1])
         self.assertEqual(f, e)
 
+    def test_columnSummary(self):
+        """DenseAlignment columnSummary should get counts, entropy and gaps"""
+        a = DenseAlignment({'a':'AC-T', 'b':'AC?T', 'c':'AG-N', 'd':'AGAT'},
+            MolType=DNA)
+        (counts, entropies, gap_fractions) = a.columnSummary()
+        self.assertEqual(counts, a._get_freqs(1))
+        self.assertFloatEqual(entropies, a.getPosEntropy())
+        self.assertFloatEqual(entropies, [0, 1, 1.5, 0.81127812445913283])
+        self.assertFloatEqual(gap_fractions, [0, 0, 0.75, 0])
+        (counts, entropies, gap_fractions) = self.a.columnSummary()
+        self.assertEqual(gap_fractions, [0, 0, 0, 0])
+
+    def test_column_statistics(self):
+        """DenseAlignment column statistics should match Alignment"""
+        data = {'a':'AC-TTGCAN', 'b':'ACCTRGAAT', 'c':'GGG-TTCAY',
+            'd':'AC---TCA-'}
+        dense = DenseAlignment(data, MolType=DNA)
+        aln = Alignment(data, MolType=DNA)
+        for block_size in [4, 2**22]:
+            dense.block_size = block_size
+            self.assertEqual(dense.columnFreqs(), aln.columnFreqs())
+            self.assertFloatEqual(dense.uncertainties(), aln.uncertainties())
+            self.assertFloatEqual(dense.uncertainties('ACGT'),
+                aln.uncertainties('ACGT'))
+            for gap_frac in [0, 0.25, 0.5, 1]:
+                self.assertEqual(dense.omitGapPositions(gap_frac).todict(),
+                    aln.omitGapPositions(gap_frac).todict())
+            result = dense.omitGapPositions(0.3, del_seqs=True)
+            self.assertEqual(result.todict(), {'d':'AC-TCA-'})
+        self.assertEqual(dense.takePositions([8, 0], negate=True).todict(),
+            aln.takePositions([8, 0], negate=True).todict())
+
+class PackedDenseAlignmentTests(TestCase):
+    """Tests of PackedDenseAlignment against DenseAlignment"""
+
+    def setUp(self):
+        self.data = {'a':'ACGTTGCAA', 'b':'ACCTTGAAT', 'c':'GGGTTTCAA'}
+        self.gapped = {'a':'AC-TTGCAN', 'b':'ACCTRGAAT', 'c':'GGG-TTCAY'}
+
+    def test_init(self):
+        """should use 2 bits without gaps, else 4 bits"""
+        for (data, bits, width) in [(self.data, 2, 3), (self.gapped, 4, 5)]:
+            dense = DenseAlignment(data, MolType=DNA)
+            packed = PackedDenseAlignment(data, MolType=DNA)
+            self.assertEqual(packed._bits, bits)
+            self.assertEqual(packed._packed.shape, (3, width))
+            self.assertEqual(packed.ArraySeqs, dense.ArraySeqs)
+            self.assertEqual(packed.ArrayPositions, dense.ArrayPositions)
+            self.assertEqual(str(packed), str(dense))
+            self.assertEqual(str(dense.pack()), str(dense))
+            self.assertEqual(str(packed.unpack()), str(dense))
+        self.assertRaises(ValueError, PackedDenseAlignment, {'a':'AC?'},
+            MolType=DNA)
+
+    def test_getitem(self):
+        """positions and slices should be the same as DenseAlignment"""
+        dense = DenseAlignment(self.gapped, MolType=DNA)
+        packed = PackedDenseAlignment(self.gapped, MolType=DNA)
+        for i in range(-9, 9):
+            self.assertEqual(packed[i], dense[i])
+        for s in [slice(None), slice(2, 7), slice(1, None, 3),
+                slice(None, None, -2), slice(5, 2)]:
+            self.assertEqual(packed[s], dense[s])
+        self.assertRaises(IndexError, packed.__getitem__, 9)
+
+    def test_get_freqs(self):
+        """counts should be the same as DenseAlignment"""
+        dense = DenseAlignment(self.gapped, MolType=DNA)
+        packed = PackedDenseAlignment(self.gapped, MolType=DNA)
+        for block_size in [4, 2**22]:
+            packed.block_size = block_size
+            self.assertEqual(packed._get_freqs(0), dense._get_freqs(0))
+            self.assertEqual(packed._get_freqs(1), dense._get_freqs(1))
+        self.assertEqual(packed.getPosFreqs().Data, dense.getPosFreqs().Data)
+
+    def test_getSubAlignment(self):
+        """sub alignments should be packed"""
+        dense = DenseAlignment(self.gapped, MolType=DNA)
+        packed = PackedDenseAlignment(self.gapped, MolType=DNA)
+        packed.block_size = 10
+        for kw in [dict(pos=[0, 3, 8]), dict(seqs=[2, 0]),
+                dict(seqs=[1], pos=[1, 2], invert_seqs=True, invert_pos=True)]:
+            result = packed.getSubAlignment(**kw)
+            self.assertTrue(isinstance(result, PackedDenseAlignment))
+            self.assertEqual(str(result), str(dense.getSubAlignment(**kw)))
+        result = packed.takeSeqs(['c', 'a'])
+        self.assertTrue(isinstance(result, PackedDenseAlignment))
+        self.assertEqual(str(result), str(dense.takeSeqs(['c', 'a'])))
+        self.assertEqual(packed.takeSeqs(['b'], negate=True).todict(),
+            {'a':'AC-TTGCAN', 'c':'GGG-TTCAY'})
+
+    def test_seqs_and_positions(self):
+        """sequences and positions should be unpacked a block at a time"""
+        dense = DenseAlignment(self.gapped, MolType=DNA)
+        packed = PackedDenseAlignment(self.gapped, MolType=DNA)
+        packed.block_size = 4
+        def whole(*args):
+            raise AssertionError('unpacked the whole alignment')
+        packed._unpack = whole
+        for name in dense.Names:
+            seq = packed.getGappedSeq(name)
+            self.assertEqual(seq, dense.getGappedSeq(name))
+            self.assertEqual(seq.Name, name)
+        del packed._unpack
+        self.assertEqual(list(packed.iterPositions()),
+            list(dense.iterPositions()))
+        self.assertEqual(list(packed.iterPositions([8, 0, -1])),
+            list(dense.iterPositions([8, 0, -1])))
+        self.assertEqual(packed.NamedSeqs, dense.NamedSeqs)
+        self.assertEqual(packed.getGappedSeq('b'), dense.getGappedSeq('b'))
+
 class IntegrationTests(TestCase):
     """Test for integration between regular and model seqs and alns"""
     def setUp(self):
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""Unit tests for the array based tree view."""
+import numpy
+from cogent.util.unit_test import TestCase, main
+from cogent import LoadTree
+from cogent.core.tree import TreeError
+from cogent.parse.newick import TreeParseError
+from cogent.core.array_tree import ArrayTree
+
+__author__ = "Peter Maxwell"
+__copyright__ = "Copyright 2007-2016, The Cogent Project"
+__credits__ = ["Peter Maxwell"]
+__license__ = "GPL"
+__version__ = "1.9"
+__maintainer__ = "Peter Maxwell"
+__email__ = "pm67nz@gmail.com"
+__status__ = "Production"
+
+class ArrayTreeTests(TestCase):
+    """Tests of ArrayTree against the equivalent TreeNode methods"""
+    def setUp(self):
+        self.tree = LoadTree(treestring='((a:1,b:2)ab:3,(c:4,(d:5,e:6)de:7,'
+                'f:8)cf:9,g:10)root;')
+        self.array_tree = ArrayTree(self.tree)
+
+    def test_arrays(self):
+        """arrays should be in preorder"""
+        t = self.array_tree
+        self.assertEqual(t.Names, ('root', 'ab', 'a', 'b', 'cf', 'c', 'de',
+                'd', 'e', 'f', 'g'))
+        self.assertEqual(t.parent, [-1, 0, 1, 1, 0, 4, 4, 6, 6, 4, 0])
+        self.assertEqual(t.end, [11, 4, 3, 4, 10, 6, 9, 8, 9, 10, 11])
+        self.assertEqual(t.getChildren(4), [5, 6, 9])
+        self.assertEqual([t.Names[i] for i in t.postorder],
+                [n.Name for n in self.tree.postorder()])
+        self.assertEqual(t.getTipNames(), self.tree.getTipNames())
+        self.assertTrue(numpy.isnan(t.lengths[0]))
+        self.assertRaises(ValueError, t.parent.__setitem__, 1, 2)
+
+    def test_fromNewick(self):
+        """should match ArrayTree(LoadTree(treestring))"""
+        for treestring in ['((a:1,b:2)ab:3,(c:4,(d:5,e:6)de:7,f:8)cf:9,g:10);',
+                '((,),a);', '(a:1,(b,c)x:2,b)y;', '(a);', '(a,)', '(,);',
+                '(\n a : 0.5 ,\n(b,edge,edge.1,,):1e-3\n):2;\n',
+                "('a b',(c[x],d))", '((a,b)c,(d,e)f);(g,h);', 'a;']:
+            expected = ArrayTree(LoadTree(treestring=treestring))
+            result = ArrayTree.fromNewick(treestring)
+            self.assertEqual(result.Names, expected.Names)
+            self.assertEqual(result.parent, expected.parent)
+            self.assertEqual(numpy.isnan(result.lengths),
+                    numpy.isnan(expected.lengths))
+            self.assertEqual(numpy.nan_to_num(result.lengths),
+                    numpy.nan_to_num(expected.lengths))
+        for treestring in ['(a,b))', '(a:1:2,b);', '(a,b)c(d);', '(a,b:x);',
+                '(a,b),c;', '(a,(b,c);']:
+            self.assertRaises(TreeParseError, LoadTree, treestring=treestring)
+            self.assertRaises(TreeParseError, ArrayTree.fromNewick,
+                    treestring)
+
+    def test_getTree(self):
+        """should round trip back to the same tree"""
+        self.assertEqual(str(self.array_tree.getTree()), str(self.tree))
+
+    def test_tipToTipDistances(self):
+        """should match TreeNode.tipToTipDistances"""
+        (expected, tips) = self.tree.tipToTipDistances()
+        (result, names) = self.array_tree.tipToTipDistances()
+        self.assertEqual(names, [tip.Name for tip in tips])
+        self.assertFloatEqual(result, expected)
+        endpoints = ['g', 'd', 'a', 'e']
+        (expected, tips) = self.tree.tipToTipDistances(endpoints=endpoints)
+        (result, names) = self.array_tree.tipToTipDistances(endpoints)
+        self.assertEqual(names, endpoints)
+        self.assertFloatEqual(result, expected)
+        self.assertRaises(ValueError, self.array_tree.tipToTipDistances,
+                ['a', 'de'])
+
+    def test_lowestCommonAncestor(self):
+        """should match TreeNode.lowestCommonAncestor"""
+        t = self.array_tree
+        for names in [['a'], ['a', 'b'], ['d', 'f'], ['e', 'd', 'c'],
+                ['b', 'e'], ['g', 'x', 'f']]:
+            self.assertEqual(t.Names[t.lca(names)],
+                    self.tree.lowestCommonAncestor(names).Name)
+        self.assertEqual(t.lca(['de', 'f']), t.getNodeIndex('cf'))
+        self.assertEqual(t.lca(['x']), None)
+
+    def test_descendantArray(self):
+        """should list the tips of each internal node"""
+        (result, nodes) = self.array_tree.descendantArray()
+        self.assertEqual([self.array_tree.Names[i] for i in nodes],
+                ['root', 'ab', 'cf', 'de'])
+        self.assertEqual(result, [[1,1,1,1,1,1,1], [1,1,0,0,0,0,0],
+                [0,0,1,1,1,1,0], [0,0,0,1,1,0,0]])
+        (result, nodes) = self.array_tree.descendantArray(['g', 'd'])
+        self.assertEqual(result, [[1,1], [0,0], [0,1], [0,1]])
+
+    def test_getSubTree(self):
+        """should match TreeNode.getSubTree, apart from unrooting"""
+        for (names, keep_root) in [(['a', 'b', 'c'], False),
+                (['a', 'd', 'e'], False), (['d', 'f'], False),
+                (['d', 'f'], True), (['de', 'g'], False)]:
+            expected = self.tree.getSubTree(names, keep_root=keep_root)
+            sub_tree = self.array_tree.getSubTree(names, keep_root=keep_root)
+            result = sub_tree.getTree()
+            result.Name = 'root'
+            self.assertEqual(str(result.unrooted()), str(expected))
+        self.assertRaises(ValueError, self.array_tree.getSubTree, ['a', 'x'])
+        self.assertEqual(self.array_tree.getSubTree(['a', 'x', 'e'],
+                ignore_missing=True).getTipNames(), ['a', 'e'])
+        self.assertRaises(TreeError, self.array_tree.getSubTree, ['a'])
+
+
+if __name__ == '__main__':
+    main()
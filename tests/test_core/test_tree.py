@@ -2,7 +2,9 @@
 """Tests of classes for dealing with trees and phylogeny.
 """
 
+import sys
 from copy import copy, deepcopy
+from StringIO import StringIO
 from cogent import LoadTree
 from cogent.core.tree import TreeNode, PhyloNode, TreeError
 from cogent.parse.tree import DndParser
@@ -1707,6 +1709,28 @@ class TreeInterfaceForLikelihoodFunction(TestCase):
         parsed = LoadTree(treestring=xml)
         self.assertEqual(str(orig), str(parsed))
     
+    def test_write(self):
+        """writeNewick and writeXML should match getNewick and getXML"""
+        tree = self.default_tree
+        for (kw, expected) in [({}, tree.getNewick()),
+                (dict(with_distances=True, semicolon=False),
+                    tree.getNewick(with_distances=True, semicolon=False))]:
+            outfile = StringIO()
+            tree.writeNewick(outfile, **kw)
+            self.assertEqual(outfile.getvalue(), expected)
+        outfile = StringIO()
+        tree.writeXML(outfile)
+        self.assertEqual(outfile.getvalue(), tree.getXML())
+    
+    def test_deep_tree(self):
+        """trees deeper than the recursion limit should be written"""
+        depth = sys.getrecursionlimit() + 100
+        treestring = '(' * depth + 'a' + ''.join(',b%s)' % i
+                for i in range(depth)) + ';'
+        tree = self._maketree(treestring)
+        self.assertEqual(tree.getNewick(), treestring)
+        self.assertEqual(tree.getXML().count('<clade>'), 2 * depth + 1)
+    
     # Magic methods
     
     def test_str(self):
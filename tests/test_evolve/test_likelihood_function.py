@@ -25,10 +25,17 @@ from cogent.util.unit_test import TestCase, main
 from cogent.maths.matrix_exponentiation import PadeExponentiator as expm
 from cogent.maths.stats.information_criteria import aic, bic
 from cogent.evolve.models import JTT92
+from cogent.util import parallel
+from cogent.evolve.substitution_calculation import LengthDefn
 
 Nucleotide = substitution_model.Nucleotide
 MotifChange = predicate.MotifChange
 
+class LocusLengthNucleotide(Nucleotide):
+    """A Nucleotide model with separate lengths for each locus"""
+    def makeDistanceDefn(self, bprobs):
+        return LengthDefn(dimensions=('edge', 'locus'))
+
 __author__ = "Peter Maxwell and Gavin Huttley"
 __copyright__ = "Copyright 2007-2016, The Cogent Project"
 __credits__ = ["Peter Maxwell", "Gavin Huttley", "Rob Knight",
@@ -197,7 +204,27 @@ class LikelihoodCalcs(TestCase):
         values = lf.getParamValueDict(['bin'])['kappa_factor'].values()
         self.assertEqual(round(sum(values) / len(values), 6), 1.0)
         self.assertEqual(len(values), 2)
-    
+
+    def test_batched_bins(self):
+        """batched bins should give the same results as one bin at a time"""
+        for kw in [dict(bins=3),
+                dict(bins=['slow', 'fast'], sites_independent=False)]:
+            results = []
+            for batch_bins in [False, True]:
+                submod = Nucleotide(predicates={'kappa': 'transition'},
+                        ordered_param='rate', distribution='gamma')
+                lf = self._makeLikelihoodFunction(submod,
+                        batch_bins=batch_bins, **kw)
+                lf.setParamRule('length', edge='Human', value=0.5,
+                        is_constant=True)
+                results.append((lf.getLogLikelihood(),
+                        lf.getBinProbs().array,
+                        lf.reconstructAncestralSeqs()['root'].array))
+            (lnL, bin_probs, ancestral) = results[0]
+            self.assertFloatEqual(results[1][0], lnL)
+            self.assertFloatEqual(results[1][1], bin_probs)
+            self.assertFloatEqual(results[1][2], ancestral)
+
     def test_codon(self):
         """test a three taxa codon model."""
         submod = substitution_model.Codon(
@@ -382,6 +409,87 @@ motif  mprobs
         self.assertAlmostEquals(230.77670557,
             likelihood_function.getGStatistic(),places=6)
     
+    def test_single_length_change(self):
+        """changing one length should only recalculate its path to the root,
+        and undoing it should restore the cached values"""
+        lf = self._makeLikelihoodFunction()
+        calc = lf.makeCalculator()
+        x = calc.getValueArray()
+        lnL = calc(x)
+        human = [p for p in calc.opt_pars
+                if p.name == 'length' and 'Human' in p.scope[0]][0]
+        program = calc.cellsChangedBy([(human.rank, None)])
+        self.assertEqual([c.name for c in program].count('plh'),
+                len(self.tree.getNodeMatchingName('Human').ancestors()))
+
+        values = []
+        for i in range(len(x)):
+            y = x[:]
+            y[i] *= 1.1
+            values.append(calc(y))
+            self.assertFloatEqual(calc(x), lnL)
+        for (i, value) in enumerate(values):
+            y = x[:]
+            y[i] *= 1.1
+            self.assertFloatEqual(lf.makeCalculator()(y), value)
+
+    def test_length_gradients(self):
+        """analytic length gradients should match numerical ones"""
+        for kw in [{}, dict(bins=['low', 'high'])]:
+            lf = self._makeLikelihoodFunction(**kw)
+            if kw:
+                lf.setParamRule('beta', bin='low', value=0.1)
+            gradients = lf.getLengthGradients()
+            calc = lf.makeCalculator()
+            numerical = calc.gradient(calc.getValueArray(), epsilon=1e-8)
+            for (opt_par, expect) in zip(calc.opt_pars, numerical):
+                if opt_par.name == 'length':
+                    edge = opt_par.scope[0][0]
+                    self.assertFloatEqual(gradients[edge], expect, eps=1e-4)
+    
+    def test_locus_length_gradients(self):
+        """analytic gradients of locus specific lengths should match
+        numerical ones"""
+        submodel = LocusLengthNucleotide(do_scaling=True, model_gaps=False,
+                equal_motif_probs=True, predicates={'beta': 'transition'})
+        lf = submodel.makeLikelihoodFunction(self.tree, loci=['a', 'b'])
+        half = len(self.data) // 2
+        lf.setAlignment([self.data[:half], self.data[half:]])
+        lf.setParamRule('length', locus='b', value=0.2)
+        calc = lf.makeCalculator()
+        lengths = [p for p in calc.opt_pars if p.name == 'length']
+        self.assertEqual(len(lengths), 2 * len(self.tree.getEdgeVector()[:-1]))
+        x = calc.getValueArray()
+        numerical = calc.gradient(x, epsilon=1e-8)
+        analytic = lf._makeGradientFunction(calc)(x)
+        self.assertFloatEqual(analytic, numerical, eps=1e-4)
+        gradients = lf.getLengthGradients(locus='b')
+        for (opt_par, expect) in zip(calc.opt_pars, numerical):
+            if opt_par.name == 'length' and 'b' in opt_par.scope[0]:
+                edge = opt_par.scope[0][0]
+                self.assertFloatEqual(gradients[edge], expect, eps=1e-4)
+    
+    def test_optimise_with_gradient(self):
+        """optimising with gradients should reach the same optimum"""
+        lnLs = []
+        for gradient in [False, True]:
+            lf = self._makeLikelihoodFunction()
+            lf.optimise(local=True, show_progress=False, gradient=gradient)
+            lnLs.append(lf.getLogLikelihood())
+        self.assertFloatEqual(lnLs[1], lnLs[0], eps=1e-5)
+    
+    def test_optimise_sharded(self):
+        """optimising with columns shared among worker processes should
+        reach the same optimum"""
+        lnLs = []
+        for context in [parallel.NONE,
+                parallel.MultiprocessingParallelContext(3)]:
+            with parallel.parallel_context(context):
+                lf = self._makeLikelihoodFunction()
+                lf.optimise(local=True, show_progress=False)
+            lnLs.append(lf.getLogLikelihood())
+        self.assertFloatEqual(lnLs[1], lnLs[0], eps=1e-6)
+    
     def test_ancestralsequences(self):
         likelihood_function = self._makeLikelihoodFunction()
         self._setLengthsAndBetas(likelihood_function)
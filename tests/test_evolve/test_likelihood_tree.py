@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""Unit tests for site pattern compression of likelihood tree leaves."""
+import cPickle
+from cogent import LoadSeqs, LoadTree, DNA
+from cogent.core.alignment import DenseAlignment
+from cogent.evolve.models import HKY85, CNFGTR
+from cogent.evolve import likelihood_tree
+from cogent.evolve.likelihood_tree import makeLikelihoodTreeLeaf, \
+        getAlignmentSitePatterns, SitePatterns
+from cogent.evolve.likelihood_calculation import recursive_lht_build
+from cogent.util.unit_test import TestCase, main
+
+__author__ = "Peter Maxwell"
+__copyright__ = "Copyright 2007-2016, The Cogent Project"
+__credits__ = ["Peter Maxwell"]
+__license__ = "GPL"
+__version__ = "1.9"
+__maintainer__ = "Peter Maxwell"
+__email__ = "pm67nz@gmail.com"
+__status__ = "Production"
+
+class SitePatternsTests(TestCase):
+    """Tests of SitePatterns against per sequence leaves"""
+    def setUp(self):
+        self.aln = LoadSeqs(data={'a':'ACGACGTTTACG', 'b':'ACGACGTTAACG',
+                'c':'ACG-CGTTAAC?', 'd':'ACGNCGTTTACG'}, moltype=DNA)
+        self.tree = LoadTree(treestring='((a,b),c,d);')
+
+    def test_patterns(self):
+        """site patterns should be in order of first occurrence"""
+        patterns = SitePatterns(self.aln)
+        self.assertEqual(patterns.index, [0,1,2,3,1,2,4,4,5,0,1,6])
+        self.assertEqual(patterns.first, [0,1,2,3,6,8,11])
+        self.assertEqual(patterns.counts, [2,3,2,1,2,1,1])
+        self.assertEqual(patterns.motifs['c'], list('ACG-TA?'))
+        self.assertEqual(len(patterns), 12)
+        codons = SitePatterns(self.aln, motif_len=3)
+        self.assertEqual(codons.index, [0,1,2,3])
+        self.assertEqual(codons.motifs['b'], ['ACG', 'ACG', 'TTA', 'ACG'])
+        copy = cPickle.loads(cPickle.dumps(patterns, 2))
+        self.assertEqual(copy.index, patterns.index)
+        self.assertEqual(copy.motifs, patterns.motifs)
+
+    def test_getAlignmentSitePatterns(self):
+        """site patterns should be kept while the alignment is"""
+        attributes = set(vars(self.aln))
+        patterns = getAlignmentSitePatterns(self.aln)
+        self.assertTrue(getAlignmentSitePatterns(self.aln) is patterns)
+        self.assertFalse(getAlignmentSitePatterns(self.aln, 3) is patterns)
+        sub_aln = self.aln.takeSeqs(['a', 'b'])
+        self.assertFalse(getAlignmentSitePatterns(sub_aln) is patterns)
+        # but not on it, where they would be pickled with it
+        self.assertEqual(set(vars(self.aln)), attributes)
+        # nor out of date after changes to the sequences
+        self.aln.NamedSeqs['a'] = self.aln.NamedSeqs['b']
+        changed = getAlignmentSitePatterns(self.aln)
+        self.assertFalse(changed is patterns)
+        self.assertEqual(changed.motifs['a'], changed.motifs['b'])
+        # and forgotten with the alignment
+        key = id(sub_aln)
+        self.assertTrue(key in likelihood_tree._SITE_PATTERNS)
+        del sub_aln
+        self.assertFalse(key in likelihood_tree._SITE_PATTERNS)
+
+    def test_convertSequence(self):
+        """a model's own convertSequence should still be used"""
+        converted = []
+        class Model(HKY85().__class__):
+            use_site_patterns = False
+            def convertSequence(self, sequence, name):
+                converted.append(name)
+                return super(Model, self).convertSequence(sequence, name)
+        model = HKY85()
+        model.__class__ = Model
+        leaves = model.convertAlignment(self.aln)
+        self.assertEqual(sorted(converted), ['a', 'b', 'c', 'd'])
+        self.assertEqual(sorted(leaves), ['a', 'b', 'c', 'd'])
+
+    def test_leaves(self):
+        """leaves and edges should be the same as without site patterns"""
+        for aligned in [True, DenseAlignment]:
+            aln = LoadSeqs(data={'a':'ACGACGTTTACG', 'b':'ACGACGTTAACG',
+                    'c':'ACGACGTTAACA', 'd':'ACGNCGTTTACG'}, moltype=DNA,
+                    aligned=aligned)
+            for model in [HKY85(), CNFGTR()]:
+                alphabet = model.getAlphabet()
+                leaves = model.convertAlignment(aln)
+                expected = dict((name, makeLikelihoodTreeLeaf(
+                        aln.getGappedSeq(name), alphabet, name))
+                        for name in aln.getSeqNames())
+                for name in aln.getSeqNames():
+                    (leaf, other) = (leaves[name], expected[name])
+                    self.assertEqual(list(leaf.uniq), list(other.uniq))
+                    self.assertEqual(leaf.index, other.index)
+                    self.assertEqual(leaf.counts, other.counts)
+                    self.assertEqual(leaf.input_likelihoods,
+                            other.input_likelihoods)
+                edge = recursive_lht_build(self.tree, leaves)
+                other = recursive_lht_build(self.tree, expected)
+                self.assertTrue(edge.patterns is leaves['a'].patterns)
+                self.assertEqual(edge.uniq, other.uniq)
+                self.assertEqual(edge.index, other.index)
+                self.assertEqual(edge.counts, other.counts)
+
+    def test_errors(self):
+        """motifs not in the alphabet should be located"""
+        aln = LoadSeqs(data={'a':'ACGAAJ', 'b':'ACGTTT'})
+        for (model, message) in [(HKY85(), "'J' at a:5 not in alphabet"),
+                (CNFGTR(), "'AAJ' at a:3 not in alphabet")]:
+            try:
+                model.convertAlignment(aln)
+            except ValueError, e:
+                self.assertEqual(str(e), message)
+            else:
+                self.fail('no error for J')
+
+
+if __name__ == '__main__':
+    main()
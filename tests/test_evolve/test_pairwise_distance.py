@@ -11,9 +11,7 @@ from cogent import LoadSeqs, DNA, RNA, PROTEIN
 from cogent.evolve.pairwise_distance import get_moltype_index_array, \
     seq_to_indices, _fill_diversity_matrix, \
     _jc69_from_matrix, JC69Pair, _tn93_from_matrix, TN93Pair, LogDetPair, \
-    ParalinearPair
-from cogent.evolve._pairwise_distance import \
-    _fill_diversity_matrix as pyx_fill_diversity_matrix
+    ParalinearPair, _diversity_matrices
 
 __author__ = "Gavin Huttley, Yicheng Zhu and Ben Kaehler"
 __copyright__ = "Copyright 2007-2016, The Cogent Project"
@@ -84,15 +82,39 @@ class TestPair(TestCase):
                          [0,0,2,1],
                          [0,0,0,2]], float))
     
-    def test_python_vs_cython_fill_matrix(self):
-        """python & cython fill_diversity_matrix give same answer"""
-        s1 = seq_to_indices('RACGTACGTACN', self.dna_char_indices)
-        s2 = seq_to_indices('AGTGTACGTACA', self.dna_char_indices)
-        matrix1 = numpy.zeros((4,4), float)
-        _fill_diversity_matrix(matrix1, s1, s2)
-        matrix2 = numpy.zeros((4,4), float)
-        pyx_fill_diversity_matrix(matrix2, s1, s2)
-        self.assertFloatEqual(matrix1, matrix2)
+    def test_diversity_matrices(self):
+        """diversity matrices for all pairs at once should match the
+        pairwise ones"""
+        seqs = [seq_to_indices(seq, self.dna_char_indices) for seq in
+                ['ACGTACGTAC', 'GTGTNCGTAC', 'ACG-ACGTTT']]
+        matrices = _diversity_matrices(seqs, seqs[1:], 4)
+        self.assertEqual(matrices.shape, (3, 2, 4, 4))
+        for i in range(3):
+            for j in range(2):
+                matrix = numpy.zeros((4,4), float)
+                _fill_diversity_matrix(matrix, seqs[i], seqs[j+1])
+                self.assertEqual(matrices[i, j], matrix)
+    
+    def test_block_size(self):
+        """distances shouldn't depend on how the pairs are blocked"""
+        aln = LoadSeqs('data/brca1_5.paml', moltype=DNA)
+        for klass in [JC69Pair, TN93Pair, LogDetPair, ParalinearPair]:
+            calc = klass(moltype=DNA, alignment=aln)
+            calc.run(show_progress=False, block_size=len(aln.Names))
+            expect = calc.getPairwiseDistanceArray()
+            for block_size in [None, 1, 2, 4]:
+                calc.run(show_progress=False, block_size=block_size)
+                self.assertFloatEqual(calc.getPairwiseDistanceArray(), expect)
+            dists = calc.getPairwiseDistances()
+            self.assertFloatEqual(expect[0, 1],
+                    dists[tuple(calc.Names[:2])])
+    
+    def test_before_run(self):
+        """there should be no distances until run"""
+        calc = JC69Pair(DNA, alignment=self.alignment)
+        self.assertEqual(calc.getPairwiseDistances(), None)
+        self.assertEqual(calc.getPairwiseDistanceArray(), None)
+        self.assertEqual(calc.Lengths, None)
     
     def test_jc69_from_matrix(self):
         """compute JC69 from diversity matrix"""
@@ -2,9 +2,13 @@
 """Unit tests for distance_transform.py functions.
 """
 from __future__ import division
-from cogent.util.unit_test import TestCase, main
+from cogent.util.unit_test import TestCase, main, FakeCSR
 from cogent.maths.distance_transform import *
-from numpy import array, sqrt, shape, ones, diag
+from numpy import array, sqrt, shape, ones, diag, memmap, triu_indices
+import os
+from tempfile import mkdtemp
+from shutil import rmtree
+from cogent.util import parallel
             
             
 __author__ = "Justin Kuczynski"
@@ -18,7 +22,13 @@ __maintainer__ = "Justin Kuczynski"
 __email__ = "justinak@gmail.com"
 __status__ = "Prototype"
 
-
+_DISTS = [dist_bray_curtis, dist_bray_curtis_magurran, dist_canberra,
+    dist_chisq, dist_chord, dist_euclidean, dist_gower, dist_hellinger,
+    dist_kulczynski, dist_manhattan, dist_abund_jaccard, dist_morisita_horn,
+    dist_pearson, dist_soergel, dist_spearman_approx, dist_specprof,
+    binary_dist_chisq, binary_dist_chord, binary_dist_sorensen_dice,
+    binary_dist_euclidean, binary_dist_hamming, binary_dist_jaccard,
+    binary_dist_lennon, binary_dist_ochiai, binary_dist_pearson]
 
 class functionTests(TestCase):
     """Tests of top-level functions."""
@@ -530,6 +540,58 @@ class functionTests(TestCase):
                         [1-14/17,0,1-4/11],
                         [1-.4,1-4/11,0],
                         ]))
+
+    def test_sparse(self):
+        """sparse matrices should give the same distances as dense ones"""
+        negative = array([[1, -3, 0, 2], [0, 0, 0, 0], [-1, 0, 4, 2],
+            [0, 2, 0, -2.5]])
+        for data in [self.zeromtx, self.mtx1, self.dense1, self.sparse1,
+                self.input_binary_dist_otu_gain1, negative]:
+            strict = data is not negative
+            for f in _DISTS:
+                try:
+                    expected = f(data, strict=strict)
+                except ValueError:
+                    self.assertRaises(ValueError, f, FakeCSR(data),
+                        strict=strict)
+                else:
+                    self.assertFloatEqual(f(FakeCSR(data), strict=strict),
+                        expected)
+
+    def test_condensed_dists(self):
+        """condensed_dists should give the upper triangle of each metric"""
+        (i, j) = triu_indices(4, 1)
+        for f in _DISTS:
+            expected = f(self.sparse1)[i, j]
+            for data in [self.sparse1, FakeCSR(self.sparse1)]:
+                self.assertFloatEqual(condensed_dists(data, f), expected)
+                self.assertFloatEqual(condensed_dists(data, f,
+                    block_size=1), expected)
+        self.assertEqual(condensed_dists(self.emptyarray, strict=False),
+            zeros(0))
+        self.assertRaises(ValueError, condensed_dists, self.sparse1,
+            binary_dist_otu_gain)
+        self.assertRaises(ValueError, condensed_dists, self.sparse1,
+            out=zeros(5))
+
+    def test_condensed_dists_out(self):
+        """condensed_dists should fill in out, in parallel or not"""
+        dirname = mkdtemp()
+        try:
+            data = array([[(r * c) % 7 for c in range(9)] for r in range(30)])
+            out = memmap(os.path.join(dirname, 'dists'), 'd', 'w+',
+                shape=(435,))
+            result = condensed_dists(FakeCSR(data), dist_bray_curtis,
+                out=out, block_size=100)
+            self.assertTrue(result is out)
+            (i, j) = triu_indices(30, 1)
+            expected = dist_bray_curtis(data)[i, j]
+            self.assertFloatEqual(out, expected)
+            self.assertFloatEqual(self.assertSameWithProcesses(
+                lambda: condensed_dists(data, dist_bray_curtis,
+                block_size=100)), expected)
+        finally:
+            rmtree(dirname)
     
     #def test_no_dupes(self):
         #""" here we check all distance functions in distance_transform for 
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""Unit tests for matrix exponentiation."""
+import numpy
+from cogent.util.unit_test import TestCase, main
+from cogent.maths.matrix_exponentiation import FastExponentiator, \
+        PadeExponentiator, ExponentiatorCache, PSUB_CACHE
+
+__author__ = "Peter Maxwell"
+__copyright__ = "Copyright 2007-2016, The Cogent Project"
+__credits__ = ["Peter Maxwell"]
+__license__ = "GPL"
+__version__ = "1.9"
+__maintainer__ = "Gavin Huttley"
+__email__ = "gavin.huttley@anu.edu.au"
+__status__ = "Production"
+
+Q = numpy.array([
+    [-0.6,  0.1,  0.4,  0.1],
+    [ 0.1, -0.6,  0.1,  0.4],
+    [ 0.4,  0.1, -0.6,  0.1],
+    [ 0.1,  0.4,  0.1, -0.6]])
+
+class ExponentiatorCacheTests(TestCase):
+    """Tests of the P matrix cache"""
+    def setUp(self):
+        self.max_bytes = PSUB_CACHE.max_bytes
+        PSUB_CACHE.clear()
+
+    def tearDown(self):
+        PSUB_CACHE.setMaxBytes(self.max_bytes)
+        PSUB_CACHE.clear()
+
+    def test_exponentiators_agree(self):
+        """cached results should match the uncached ones"""
+        for t in [0.0, 0.1, 1.0]:
+            self.assertFloatEqual(FastExponentiator(Q)(t),
+                    PadeExponentiator(Q)._exponentiate(t))
+            self.assertFloatEqual(PadeExponentiator(Q)(t),
+                    FastExponentiator(Q)._exponentiate(t))
+
+    def test_hits(self):
+        """the same Q and t should be a hit even from another exponentiator,
+        and the results should be the caller's own to modify"""
+        P = FastExponentiator(Q)(0.5)
+        self.assertEqual((PSUB_CACHE.hits, PSUB_CACHE.misses), (0, 1))
+        P2 = FastExponentiator(Q.copy())(0.5)
+        self.assertEqual(P2, P)
+        FastExponentiator(Q)(0.25)
+        FastExponentiator(Q*2)(0.5)
+        self.assertEqual((PSUB_CACHE.hits, PSUB_CACHE.misses), (1, 3))
+        P2[0, 0] = 1.0
+        self.assertEqual(FastExponentiator(Q)(0.5), P)
+    
+    def test_changed_q(self):
+        """a Q changed in place shouldn't give stale hits"""
+        Q2 = Q.copy()
+        exp = PadeExponentiator(Q2)
+        P = exp(0.5)
+        Q2 *= 2
+        self.assertFloatEqual(exp(0.5),
+                PadeExponentiator(Q*2)._exponentiate(0.5))
+        self.assertNotEqual(exp(0.5), P)
+
+    def test_lru(self):
+        """the least recently used should go when full"""
+        cache = ExponentiatorCache()
+        entry_size = Q.nbytes * 2
+        cache.setMaxBytes(entry_size * 2)
+        exp = FastExponentiator(Q)
+        cache(exp, 1.0)
+        cache(exp, 2.0)
+        cache(exp, 1.0)
+        cache(exp, 3.0)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.nbytes, entry_size * 2)
+        cache(exp, 1.0)
+        self.assertEqual((cache.hits, cache.misses), (2, 3))
+        cache(exp, 2.0)
+        self.assertEqual((cache.hits, cache.misses), (2, 4))
+        cache.setMaxBytes(0)
+        self.assertEqual(len(cache), 0)
+        cache(exp, 2.0)
+        self.assertEqual(len(cache), 0)
+
+    
+    def test_repeated_hits(self):
+        """repeated hits should be forgotten once superseded"""
+        cache = ExponentiatorCache()
+        cache.setMaxBytes(Q.nbytes * 4)
+        exp = FastExponentiator(Q)
+        cache(exp, 1.0)
+        for i in range(100):
+            cache(exp, 2.0)
+        self.assertTrue(len(cache._uses) < 20)
+        cache(exp, 1.0)
+        cache(exp, 3.0)
+        self.assertEqual(len(cache), 2)
+        cache(exp, 1.0)
+        self.assertEqual((cache.hits, cache.misses), (101, 3))
+        cache(exp, 2.0)
+        self.assertEqual((cache.hits, cache.misses), (101, 4))
+
+
+if __name__ == '__main__':
+    main()
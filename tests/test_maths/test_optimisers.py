@@ -1,9 +1,11 @@
 #!/usr/bin/env python
 
 from __future__ import division
-import time, sys, os, numpy
+import time, sys, os, numpy, warnings
 from cogent.util.unit_test import TestCase, main
 from cogent.maths.optimisers import maximise, MaximumEvaluationsReached
+from cogent.maths import scipy_optimisers
+from cogent.maths.scipy_optimisers import BFGS
 
 __author__ = "Peter Maxwell and Gavin Huttley"
 __copyright__ = "Copyright 2007-2016, The Cogent Project"
@@ -72,6 +74,36 @@ class OptimiserTestCase(TestCase):
         # Global minimum not the nearest one
         self._test_optimisation(local=True, target=2)
     
+    def test_gradient(self):
+        # Quasi-Newton, with and without the global maximum out of bounds
+        def gradient(x):
+            return -0.1 * (12*x**3 + 24*x**2 - 96*x)
+        self._test_optimisation(local=True, xinit=-3.0, gradient=gradient)
+        self._test_optimisation(local=True, target=2, gradient=gradient,
+                bounds=([0.0],[10.0]))
+    
+    def test_bfgs_stalled(self):
+        # fmin_bfgs stalling is only a warning if f was still changing
+        def stalled_after(*fvals):
+            def fake_fmin_bfgs(f, y, callback, **kw):
+                for (i, fval) in enumerate(fvals):
+                    callback(i, y, fval)
+                return (y, 0.0, None, None, len(fvals), len(fvals), 2)
+            return fake_fmin_bfgs
+        orig = scipy_optimisers.fmin_bfgs
+        try:
+            for (fvals, expect_warning) in [((10.0, 5.0), True),
+                    ((10.0, 5.0, 5.0 - 1e-9), False), ((), True)]:
+                scipy_optimisers.fmin_bfgs = stalled_after(*fvals)
+                opt = BFGS(lambda x: -x)
+                with warnings.catch_warnings(record=True) as caught:
+                    warnings.simplefilter('always')
+                    opt.minimise(lambda x: x[0]**2, numpy.array([1.0]), None,
+                            tolerance=1e-6)
+                self.assertEqual(bool(caught), expect_warning)
+        finally:
+            scipy_optimisers.fmin_bfgs = orig
+    
     def test_limited(self):
         self.assertRaises(MaximumEvaluationsReached, 
             self._test_optimisation, max_evaluations=5)
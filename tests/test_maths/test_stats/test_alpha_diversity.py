@@ -1,9 +1,10 @@
 #!/usr/bin/env python
 #file test_alpha_diversity.py
 from __future__ import division
-from numpy import array, log, sqrt, exp
+from numpy import array, log, sqrt, exp, nonzero, isnan, nan
+from numpy.random import seed
 from math import e
-from cogent.util.unit_test import TestCase, main
+from cogent.util.unit_test import TestCase, main, FakeCSR
 from cogent.maths.stats.alpha_diversity import expand_counts, counts, observed_species, singles, \
     doubles, osd, margalef, menhinick, dominance, simpson, \
     simpson_reciprocal, reciprocal_simpson,\
@@ -11,7 +12,8 @@ from cogent.maths.stats.alpha_diversity import expand_counts, counts, observed_s
     strong, kempton_taylor_q, fisher_alpha, \
     mcintosh_e, heip_e, simpson_e, robbins, robbins_confidence, \
     chao1_uncorrected, chao1_bias_corrected, chao1, chao1_var, \
-    chao1_confidence, ACE, michaelis_menten_fit
+    chao1_confidence, chao1_lower, chao1_upper, ACE, michaelis_menten_fit, \
+    diversity_matrix
 
 __author__ = "Rob Knight"
 __copyright__ = "Copyright 2007-2016, The Cogent Project"
@@ -269,5 +271,78 @@ class diversity_tests(TestCase):
         self.assertFloatEqual(res,2.0,eps=.01)
 
 
+class diversity_matrix_tests(TestCase):
+    """Tests of diversity_matrix against the metrics of each row"""
+
+    def setUp(self):
+        """Set up shared variables"""
+        self.Data = array([[0,1,1,4,2,5,2,4,1,2],
+                           [0,2,2,4,5,3,0,3,6,7],
+                           [0,1,1,4,5,3,0,3,6,7],
+                           [3,1,12,2,6,1,10,9,2,1],
+                           [0,0,0,0,0,0,1,3,0,2]])
+
+    def test_diversity_matrix(self):
+        """diversity_matrix should give the metric of each row"""
+        for (f, kwargs) in [(observed_species, {}), (singles, {}),
+                (doubles, {}), (osd, {}), (margalef, {}), (menhinick, {}),
+                (dominance, {}), (simpson, {}), (reciprocal_simpson, {}),
+                (simpson_reciprocal, {}), (shannon, {}),
+                (shannon, {'base':e}), (equitability, {}),
+                (berger_parker_d, {}), (mcintosh_d, {}), (brillouin_d, {}),
+                (kempton_taylor_q, {}), (strong, {}), (fisher_alpha, {}),
+                (mcintosh_e, {}), (heip_e, {}), (simpson_e, {}),
+                (robbins, {}), (robbins_confidence, {'alpha':0.1}),
+                (chao1, {}), (chao1, {'bias_corrected':False}),
+                (chao1_var, {}), (chao1_var, {'bias_corrected':False}),
+                (chao1_confidence, {}), (chao1_lower, {}), (chao1_upper, {}),
+                (lambda c: c.max() - c.min(), {})]:
+            if f is kempton_taylor_q:
+                # undefined for the last row, whose lower quartile is 0
+                expected = [f(row) for row in self.Data[:-1]] + [nan]
+            else:
+                expected = [f(row, **kwargs) for row in self.Data]
+            if isinstance(expected[0], tuple):
+                expected = map(array, zip(*expected))
+            for data in [self.Data, FakeCSR(self.Data)]:
+                result = diversity_matrix(data, f, **kwargs)
+                self.assertFloatEqual(result, expected)
+                if f is kempton_taylor_q:
+                    self.assertTrue(isnan(result[-1]))
+
+    def test_diversity_matrix_ACE(self):
+        """diversity_matrix should give ACE of each row, or raise its error"""
+        data = array([[2,0,0,0,0], [12,0,9,0,0], [12,2,8,0,0],
+            [12,1,2,1,0], [12,3,6,1,10]])
+        self.assertFloatEqual(diversity_matrix(FakeCSR(data), ACE),
+            [1.0, 2.0, 3.0, 7.0, 5.62749672])
+        self.assertRaises(ValueError, diversity_matrix, array([[2,0],[1,1]]),
+            ACE)
+
+    def test_diversity_matrix_michaelis_menten_fit(self):
+        """diversity_matrix should fit Michaelis-Menten to each row"""
+        seed(0)
+        data = array([[22,0], [42,0], [0,34], [70,70]])
+        result = diversity_matrix(data, michaelis_menten_fit, num_repeats=3)
+        self.assertFloatEqual(result, [1.0, 1.0, 1.0, 2.0], eps=.01)
+        result = diversity_matrix(FakeCSR(data), michaelis_menten_fit,
+            return_b=True, block_size=50)
+        self.assertEqual(result.shape, (4, 2))
+        self.assertFloatEqual(result[:,0], [1.0, 1.0, 1.0, 2.0], eps=.01)
+        counts = array([[3,1,12,2,6,1,10,9,2,1]])
+        self.assertFloatEqual(diversity_matrix(counts, michaelis_menten_fit,
+            num_repeats=20), michaelis_menten_fit(counts[0], num_repeats=20),
+            eps=.05)
+        self.assertRaises(ValueError, diversity_matrix, data,
+            michaelis_menten_fit, params_guess=[13,13])
+
+    def test_diversity_matrix_fisher_alpha(self):
+        """diversity_matrix should give nan fisher_alpha for empty rows"""
+        data = array([[0,0,0], [4,3,1], [0,0,0]])
+        result = diversity_matrix(FakeCSR(data), fisher_alpha)
+        self.assertTrue(isnan(result[0]) and isnan(result[2]))
+        self.assertFloatEqual(result[1], fisher_alpha(data[1]))
+
+
 if __name__ == '__main__':
     main()
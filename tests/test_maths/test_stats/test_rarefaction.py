@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 #file test_parse.py
-from numpy import array
+from numpy import array, repeat
+from numpy.random import RandomState
 from cogent.util.unit_test import TestCase, main
 from cogent.maths.stats.rarefaction import (subsample,
                                             naive_histogram,
@@ -8,7 +9,12 @@ from cogent.maths.stats.rarefaction import (subsample,
                                             rarefaction,
                                             subsample_freq_dist_nonzero,
                                             subsample_random,
-                                            subsample_multinomial)
+                                            subsample_multinomial,
+                                            expand_counts,
+                                            subsample_depths,
+                                            rarefied_diversity)
+from cogent.maths.stats.alpha_diversity import observed_species, shannon
+from cogent.util import parallel
 
 __author__ = "Rob Knight"
 __copyright__ = "Copyright 2007-2016, The Cogent Project"
@@ -110,6 +116,43 @@ class TopLevelTests(TestCase):
             actual[tuple(e)] = None
         self.assertTrue(len(actual) > 1)
 
+    def test_expand_counts(self):
+        """expand_counts should return the index of each item"""
+        self.assertEqual(expand_counts(array([2,0,1,3])), [0,0,2,3,3,3])
+        self.assertEqual(expand_counts([]), [])
+
+    def test_subsample_depths(self):
+        """subsample_depths should take each depth from one shuffle"""
+        counts = array([3,0,5,2])
+        order = array([0,1,3,4,7,6,2,5,9,8])
+        shuffle = lambda items: items[order]
+        self.assertEqual(subsample_depths(counts, [4,0,20,1,4], shuffle),
+            array([[2,0,2,0],[0,0,0,0],[3,0,5,2],[1,0,0,0],[2,0,2,0]]))
+        self.assertEqual(subsample_depths(counts, []).shape, (0,4))
+        for i in range(20):
+            result = subsample_depths(counts, range(12))
+            self.assertEqual(result.sum(1), [0,1,2,3,4,5,6,7,8,9,10,10])
+            self.assertTrue((result[1:] >= result[:-1]).all())
+            self.assertTrue((result <= counts).all())
+
+    def test_rarefied_diversity(self):
+        """rarefied_diversity should be repeatable with a seed"""
+        data = array([[5,0,0,3,0,10], [1,1,1,1,1,1], [0,0,9,0,0,0]])
+        metrics = [observed_species, shannon, lambda c: c.sum()]
+        result = rarefied_diversity(data, [1,4,100], metrics, iterations=3,
+            seed=7)
+        self.assertEqual(result.shape, (3,3,3,3))
+        self.assertEqual(result[:,:,:,2], repeat([[[1,4,18],[1,4,6],
+            [1,4,9]]], 3, 0).transpose(1,0,2))
+        self.assertEqual(result[:,:,2,0], [[3,3,3],[6,6,6],[1,1,1]])
+        self.assertEqual(result[2,:,:,1], [[0,0,0]]*3)
+        self.assertSameWithProcesses(lambda: rarefied_diversity(data,
+            [1,4,100], metrics, iterations=3, seed=7))
+        # other permutation_fs are called in order, as without processes
+        data = repeat([[4,2,1,1,0,0]], 4, 0)
+        self.assertSameWithProcesses(lambda: rarefied_diversity(data, [3],
+            metrics, iterations=2, permutation_f=RandomState(0).permutation))
+
     def test_naive_histogram(self):
         """naive_histogram should produce expected result"""
         vals = array([1,0,0,3])
@@ -12,7 +12,10 @@ from cogent.maths.unifrac.fast_tree import (count_envs, sum_env_dict,
     jackknife_int, unifrac, unnormalized_unifrac, PD, G, unnormalized_G, 
     unifrac_matrix, unifrac_vector, PD_vector, weighted_unifrac, 
     weighted_unifrac_matrix, weighted_unifrac_vector, jackknife_array, 
-    env_unique_fraction, unifrac_one_sample, weighted_one_sample)
+    env_unique_fraction, unifrac_one_sample, weighted_one_sample,
+    index_tip_ranges, index_envs_sparse, descendant_counts,
+    iter_descendant_counts, unifrac_stripes, striped_unifrac_matrix,
+    permute_selected_rows_batch, FitchCounterBatch)
 from numpy import (arange, reshape, zeros, logical_or, array, sum, nonzero, 
     flatnonzero, newaxis)
 from numpy.random import permutation    
@@ -348,6 +351,28 @@ f   D"""
         #check that the two versions fill the array with the same values
         self.assertEqual(orig_result, new_result)
 
+    def test_fitch_descendants_batch(self):
+        """FitchCounterBatch should count changes for each permutation"""
+        t = DndParser('(((a:1,b:2):4,(c:3,d:1):2):1,(e:2,f:1):3);',
+            UniFracTreeNode)
+        node_index, nodes = index_tree(t)
+        env_counts = count_envs('a A\nb B\nc D\nd C\ne C\nf D'.split('\n'))
+        count_array = index_envs(env_counts, node_index)[0]
+        tips = [n._leaf_index for n in t.tips()]
+        permutations = [range(6), range(6)[::-1], [1,0,3,2,5,4], [2,4,0,5,1,3]]
+        for envs in [[0,1], [0,1,2,3], [1,2]]:
+            orig = count_array[:,envs]
+            batch = permute_selected_rows_batch(tips, orig, permutations)
+            changes = fitch_descendants(bind_to_array(nodes, batch),
+                counter=FitchCounterBatch)
+            self.assertEqual(len(changes), 4)
+            for k, p in enumerate(permutations):
+                a = orig.copy()
+                permute_selected_rows(tips, orig, a, lambda n: p)
+                expected = fitch_descendants(bind_to_array(nodes, a))
+                self.assertEqual(changes[k], expected)
+                self.assertEqual(batch[:,k], a)
+
     def test_tip_distances(self):
         """tip_distances should set tips to correct distances."""
         t = self.t
@@ -370,6 +395,15 @@ f   D"""
         #make sure we didn't change orig
         self.assertEqual(orig, reshape(arange(8), (4,2)))
 
+    def test_permute_selected_rows_batch(self):
+        """permute_selected_rows_batch should permute rows for each batch"""
+        orig = reshape(arange(8),(4,2))
+        result = permute_selected_rows_batch([0,2], orig, [[1,0],[0,1]])
+        self.assertEqual(result.shape, (4,2,2))
+        self.assertEqual(result[:,0], array([[4,5],[0,0],[0,1],[0,0]]))
+        self.assertEqual(result[:,1], array([[0,1],[0,0],[4,5],[0,0]]))
+        self.assertEqual(orig, reshape(arange(8), (4,2)))
+
     def test_prep_items_for_jackknife(self):
         """prep_items_for_jackknife should expand indices of repeated counts"""
         a = array([0,1,0,1,2,0,3])
@@ -559,6 +593,60 @@ f   D"""
             6.4/(11+1./3)], [4.5/(10.5+1./3), 6.4/(11+1./3), 0]])
         assert (abs(result - exp)).max() < 0.001
         
+    def test_index_envs_sparse(self):
+        """sparse counts should give the same node counts as dense"""
+        first, last, tips = index_tip_ranges(self.t)
+        self.assertEqual(tips, [n._leaf_index for n in self.t.tips()])
+        self.assertEqual(first, [0,1,3,4,2,3,0,2,0])
+        self.assertEqual(last, [1,2,4,5,3,5,2,5,5])
+        keys, cum_counts, unique_envs, env_to_index = index_envs_sparse(
+            self.env_counts, tips, self.node_index)
+        self.assertEqual(keys, [0,1,6,7,8,10,14])
+        self.assertEqual(cum_counts, [0,1,2,3,4,7,9,10])
+        self.assertEqual(unique_envs, self.unique_envs)
+        self.assertEqual(env_to_index, self.env_to_index)
+        envs = self.count_array
+        sum_descendants(bind_to_array(self.nodes, envs))
+        self.assertEqual(descendant_counts(keys, cum_counts, len(tips),
+            first, last, 3), envs)
+        blocks = list(iter_descendant_counts(self.branch_lengths, first, last,
+            keys, cum_counts, len(tips), 3, block_size=7))
+        self.assertEqual(len(blocks), 4)
+        self.assertEqual(blocks[1][0], [1,1])
+        self.assertEqual(blocks[1][1], envs[2:4])
+
+    def test_striped_unifrac_matrix(self):
+        """striped unifrac should match unifrac and weighted unifrac"""
+        first, last, tips = index_tip_ranges(self.t)
+        keys, cum_counts, unique_envs, env_to_index = index_envs_sparse(
+            self.env_counts, tips, self.node_index)
+        bl = self.branch_lengths
+        envs = self.count_array
+        bool_envs = envs.copy()
+        bool_descendants(bind_to_array(self.nodes, bool_envs))
+        sum_descendants(bind_to_array(self.nodes, envs))
+        td = bl.copy()[:,newaxis]
+        tip_distances(td, bind_to_parent_array(self.t, td), tips)
+        node_counts = iter_descendant_counts(bl, first, last, keys,
+            cum_counts, len(tips), 3)
+        self.assertEqual(unifrac_stripes(node_counts, 3, 0, 2),
+            [[7,15,11],[6,9,5]])
+        for block_size, stripes_per_job in [(2**20, None), (2**20, 16),
+                (1, 1)]:
+            kw = dict(block_size=block_size, stripes_per_job=stripes_per_job)
+            result = striped_unifrac_matrix(bl, first, last, tips, keys,
+                cum_counts, 3, **kw)
+            self.assertFloatEqual(result, unifrac_matrix(bl, bool_envs))
+            result = striped_unifrac_matrix(bl, first, last, tips, keys,
+                cum_counts, 3, weighted=True, **kw)
+            self.assertFloatEqual(result,
+                weighted_unifrac_matrix(bl, envs, tips))
+            result = striped_unifrac_matrix(bl, first, last, tips, keys,
+                cum_counts, 3, weighted='correct', tip_distances=td.ravel(),
+                **kw)
+            self.assertFloatEqual(result, weighted_unifrac_matrix(bl, envs,
+                tips, bl_correct=True, tip_distances=td))
+
     def test_weighted_one_sample(self):
         """weighted one sample should match weighted matrix"""
         #should match web site calculations
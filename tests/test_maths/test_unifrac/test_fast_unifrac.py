@@ -15,7 +15,12 @@ from cogent.maths.unifrac.fast_unifrac import (reshape_by_name,
     UniFracTreeNode, mcarlo_sig, num_comps, fast_unifrac, 
     fast_unifrac_whole_tree, PD_whole_tree, PD_generic_whole_tree,
     TEST_ON_TREE, TEST_ON_ENVS, TEST_ON_PAIRWISE, shared_branch_length,
-    shared_branch_length_to_root, fast_unifrac_one_sample)
+    shared_branch_length_to_root, fast_unifrac_one_sample,
+    fast_unifrac_striped, G, fast_unifrac_permutations, fast_p_test,
+    fast_unifrac_permutations_file, fast_p_test_file)
+from cogent.maths.unifrac.fast_tree import (bind_to_array, bool_descendants,
+    fitch_descendants, permute_selected_rows, unifrac)
+from cogent.util import parallel
 from numpy.random import permutation 
 
 __author__ = "Rob Knight and Micah Hamady"
@@ -157,6 +162,84 @@ f B 1
         self.assertRaises(ValueError,  fast_unifrac, self.t, \
             self.wrong_tip_counts)
             
+    def test_fast_unifrac_striped(self):
+        """striped fast_unifrac should match the dense calculation"""
+        for t, envs in [(self.t, self.env_counts), (self.t2, self.env2_counts),
+                (self.old_t, self.old_env_counts),
+                (self.t, self.extra_tip_counts)]:
+            for weighted in [False, True, 'correct']:
+                for make_subtree in [False, True]:
+                    exp = fast_unifrac(t, envs, weighted=weighted,
+                        modes=['distance_matrix'], make_subtree=make_subtree)
+                    obs = fast_unifrac(t, envs, weighted=weighted,
+                        modes=['distance_matrix'], make_subtree=make_subtree,
+                        striped=True)
+                    self.assertFloatEqual(_convert_obj(obs['distance_matrix']),
+                        _convert_obj(exp['distance_matrix']))
+        u, env_names = fast_unifrac_striped(self.t, self.env_counts,
+            stripes_per_job=1)
+        self.assertFloatEqual(u, [[0,10/16,8/13],[10/16,0,8/17],
+            [8/13,8/17,0]])
+        self.assertEqual(env_names, ['A','B','C'])
+        self.assertRaises(ValueError, fast_unifrac_striped, self.t,
+            self.wrong_tip_counts)
+        self.assertRaises(ValueError, fast_unifrac, self.t, self.env_counts,
+            metric=G, is_symmetric=False, striped=True)
+        self.assertRaises(ValueError, fast_unifrac, self.t, self.env_counts,
+            modes=['distance_vector'], striped=True)
+
+    def test_fast_unifrac_permutations(self):
+        """permutations should be as one at a time, and repeatable"""
+        t, envs = self.old_t, self.old_env_counts
+        node_index, nodes = index_tree(t)
+        count_array = index_envs(envs, node_index)[0][:,[0,1]]
+        bl = get_branch_lengths(node_index)
+        tips = [n._leaf_index for n in t.tips()]
+        permutations = [permutation(len(tips)) for i in range(12)]
+        expected_unifrac = []
+        expected_p = []
+        for p in permutations:
+            a = count_array.copy()
+            permute_selected_rows(tips, count_array, a, lambda n: p)
+            b = a.copy()
+            bool_descendants(bind_to_array(nodes, a))
+            expected_unifrac.append(unifrac(bl, a[:,0], a[:,1]))
+            expected_p.append(fitch_descendants(bind_to_array(nodes, b)))
+        # permutation_f is called in order, so can be fed from a list, even
+        # when the batches could be spread over processes
+        def in_order():
+            perms = permutations[:]
+            unifracs = fast_unifrac_permutations(t, envs, False, 12, 'env1',
+                'env2', permutation_f=lambda n: perms.pop(0), batch_size=5)
+            perms = permutations[:]
+            changes = fast_p_test(t, envs, 12, 'env1', 'env2',
+                permutation_f=lambda n: perms.pop(0), batch_size=5)
+            return (unifracs, changes)
+        (obs_unifrac, obs_p) = self.assertSameWithProcesses(in_order)
+        self.assertFloatEqual(obs_unifrac, expected_unifrac)
+        self.assertEqual(obs_p, expected_p)
+        for weighted in [False, True, 'correct']:
+            first = self.assertSameWithProcesses(
+                lambda: fast_unifrac_permutations(t, envs, weighted, 7,
+                'env1', 'env3', seed=3, batch_size=2))
+            self.assertEqual(len(first), 7)
+        first = fast_p_test(t, envs, 7, seed=3, batch_size=2)
+        self.assertEqual(first, fast_p_test(t, envs, 7, seed=3, batch_size=2))
+
+    def test_permutations_file_pairwise(self):
+        """pairwise tests should permute every pair in worker processes"""
+        env_lines = self.env_str.splitlines()
+        pairs = [('A', 'B'), ('A', 'C'), ('B', 'C')]
+        context = parallel.MultiprocessingParallelContext(2)
+        with parallel.parallel_context(context):
+            for test in [fast_unifrac_permutations_file, fast_p_test_file]:
+                result = test([self.t_str], env_lines, num_iters=20,
+                    test_on=TEST_ON_PAIRWISE)
+                self.assertEqual([r[:2] for r in result], pairs)
+                for (first, second, raw_pval, cor_pval) in result:
+                    self.assertTrue(0 <= raw_pval <= 1)
+                self.assertFalse(2 in parallel._POOLS)
+
     def test_fast_unifrac_one_sample(self):
         """ fu one sample should match whole unifrac result, for env 'B'"""
         # first get full unifrac matrix
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""Unit tests for the memory mapped DenseAlignment file format."""
+import os
+import numpy
+from tempfile import mkdtemp
+from shutil import rmtree
+from cogent.util.unit_test import TestCase, main
+from cogent.core.moltype import DNA, PROTEIN
+from cogent.core.alignment import DenseAlignment
+from cogent.core.alphabet import CharAlphabet
+from cogent.parse.record import FileFormatError
+from cogent.parse.dense_alignment import save_dense_alignment, \
+        load_dense_alignment
+
+__author__ = "Peter Maxwell"
+__copyright__ = "Copyright 2007-2016, The Cogent Project"
+__credits__ = ["Peter Maxwell"]
+__license__ = "GPL"
+__version__ = "1.9"
+__maintainer__ = "Peter Maxwell"
+__email__ = "pm67nz@gmail.com"
+__status__ = "Development"
+
+class DenseAlignmentFileTests(TestCase):
+    """Tests of saving and memory mapping DenseAlignments"""
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.filename = os.path.join(self.dir, 'aln.daln')
+        self.aln = DenseAlignment({'a':'ACGT-N', 'b':'AC?TRY',
+                'c':'TTTTTT'}, MolType=DNA)
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def _reload(self, aln, **kw):
+        save_dense_alignment(aln, self.filename)
+        return load_dense_alignment(self.filename, **kw)
+
+    def test_round_trip(self):
+        """loaded alignments should be memory mapped and the same"""
+        protein = DenseAlignment({'x':'MKV-', 'y':'MKLW'}, MolType=PROTEIN)
+        text = DenseAlignment({'x':'xyz', 'y':'abc'})
+        packed = DenseAlignment({'x':'AC-T', 'y':'ACRT'}, MolType=DNA).pack()
+        for aln in [self.aln, protein, text, packed]:
+            result = self._reload(aln)
+            self.assertTrue(isinstance(result.ArraySeqs, numpy.memmap))
+            self.assertEqual(str(result), str(aln))
+            self.assertEqual(result.Names, aln.Names)
+            self.assertTrue(result.MolType is aln.MolType)
+            self.assertTrue(result.Alphabet is aln.Alphabet)
+
+    def test_access(self):
+        """positions, sub alignments and counts should work"""
+        result = self._reload(self.aln)
+        aln = self.aln
+        self.assertEqual(result[2], aln[2])
+        self.assertEqual(result[1:4], aln[1:4])
+        self.assertEqual(result.columnFreqs(), aln.columnFreqs())
+        self.assertEqual(result.getPosFreqs().Data, aln.getPosFreqs().Data)
+        self.assertEqual(str(result.getSubAlignment(seqs=[2,0], pos=[1,5])),
+                str(aln.getSubAlignment(seqs=[2,0], pos=[1,5])))
+
+    def test_mode(self):
+        """arrays should be read only unless copy on write"""
+        result = self._reload(self.aln)
+        self.assertRaises(ValueError, result.ArraySeqs.__setitem__, (0, 0), 1)
+        result = load_dense_alignment(self.filename, mode='c')
+        result.ArraySeqs[0, 0] = 0
+        self.assertEqual(str(load_dense_alignment(self.filename)),
+                str(self.aln))
+
+    def test_errors(self):
+        """unsaveable alignments and other files should be errors"""
+        aln = DenseAlignment(['AB', 'BA'], Alphabet=CharAlphabet('AB'))
+        self.assertRaises(ValueError, save_dense_alignment, aln,
+                self.filename)
+        outfile = open(self.filename, 'w')
+        outfile.write('>a\nACGT\n')
+        outfile.close()
+        self.assertRaises(FileFormatError, load_dense_alignment,
+                self.filename)
+
+
+if __name__ == '__main__':
+    main()
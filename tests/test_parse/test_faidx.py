@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+"""Unit tests for faidx indexed FASTA and FASTQ files."""
+import os
+import time
+from tempfile import mkdtemp
+from shutil import rmtree
+from cogent.util.unit_test import TestCase, main
+from cogent.parse.record import RecordError
+from cogent.parse.faidx import build_index, load_index, IndexedSequences
+from cogent.core.moltype import DNA
+
+__author__ = "Peter Maxwell"
+__copyright__ = "Copyright 2007-2016, The Cogent Project"
+__credits__ = ["Peter Maxwell"]
+__license__ = "GPL"
+__version__ = "1.9"
+__maintainer__ = "Peter Maxwell"
+__email__ = "pm67nz@gmail.com"
+__status__ = "Development"
+
+class FaidxTests(TestCase):
+    """Tests of build_index and IndexedSequences"""
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.seqs = [('a', 'ACGTACGTAC'), ('b', 'GGGTTT'), ('c', ''),
+                ('d', 'ACGTACGTACGT')]
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def _write(self, name, text):
+        filename = os.path.join(self.dir, name)
+        with open(filename, 'wb') as outfile:
+            outfile.write(text)
+        return filename
+
+    def _fasta(self, width=4, newline='\n'):
+        lines = []
+        for (name, seq) in self.seqs:
+            lines.append('>%s description' % name)
+            lines.extend(seq[i:i+width] for i in range(0, len(seq), width))
+        return self._write('seqs.fasta', newline.join(lines) + newline)
+
+    def test_build_index(self):
+        """index should be in the samtools faidx format"""
+        filename = self._fasta()
+        entries = build_index(filename)
+        self.assertEqual(entries[:2], [('a', 10, 15, 4, 5),
+                ('b', 6, 43, 4, 5)])
+        self.assertEqual(entries[3], ('d', 12, 81, 4, 5))
+        self.assertEqual(load_index(filename + '.fai'), entries)
+        entries = build_index(self._fasta(newline='\r\n'))
+        self.assertEqual(entries[:2], [('a', 10, 16, 4, 6),
+                ('b', 6, 48, 4, 6)])
+
+    def test_getSeqStr(self):
+        """sequences and slices should match the originals"""
+        for newline in ['\n', '\r\n']:
+            for width in [1, 3, 4, 60]:
+                filename = self._fasta(width, newline)
+                seqs = IndexedSequences(filename)
+                self.assertEqual(seqs.Names, ['a', 'b', 'c', 'd'])
+                for (name, seq) in self.seqs:
+                    self.assertEqual(seqs.getSeqLength(name), len(seq))
+                    self.assertEqual(seqs.getSeqStr(name), seq)
+                    for (start, end) in [(0, 1), (2, 9), (3, 4), (-5, None),
+                            (5, 100), (7, 3)]:
+                        self.assertEqual(seqs.getSeqStr(name, start, end),
+                                seq[start:end])
+                seqs.close()
+                os.remove(filename + '.fai')
+
+    def test_sequences(self):
+        """getSeq and takeSeqs should make MolType sequences"""
+        seqs = IndexedSequences(self._fasta(), MolType=DNA)
+        self.assertTrue('d' in seqs)
+        self.assertFalse('x' in seqs)
+        seq = seqs['d']
+        self.assertEqual(str(seq), 'ACGTACGTACGT')
+        self.assertEqual(seq.Name, 'd')
+        self.assertEqual(seq.MolType, DNA)
+        self.assertEqual(str(seqs.getSeq('a', 2, 5)), 'GTA')
+        collection = seqs.takeSeqs(['d', 'a'])
+        self.assertEqual(collection.Names, ['d', 'a'])
+        self.assertEqual(collection.todict(),
+                {'a': 'ACGTACGTAC', 'd': 'ACGTACGTACGT'})
+        self.assertRaises(KeyError, seqs.getSeq, 'x')
+
+    def test_index_reuse(self):
+        """an existing index should be used unless the file is newer"""
+        filename = self._fasta()
+        index_filename = self._write('seqs.fasta.fai', 'a\t3\t15\t4\t5\n')
+        os.utime(index_filename, None)
+        seqs = IndexedSequences(filename)
+        self.assertEqual(seqs.Names, ['a'])
+        self.assertEqual(seqs.getSeqStr('a'), 'ACG')
+        old = time.time() - 100
+        os.utime(index_filename, (old, old))
+        seqs = IndexedSequences(filename)
+        self.assertEqual(seqs.Names, ['a', 'b', 'c', 'd'])
+        self.assertEqual(len(load_index(index_filename)), 4)
+
+    def test_fastq(self):
+        """FASTQ files should index sequences and qualities"""
+        filename = self._write('seqs.fastq', '@r1 x\nACGT\n+\nIIHH\n'
+                '@r2\nGGTTA\n+r2\n#####\n')
+        self.assertEqual(build_index(filename), [('r1', 4, 6, 4, 5, 13),
+                ('r2', 5, 22, 5, 6, 32)])
+        seqs = IndexedSequences(filename)
+        self.assertEqual(seqs.getSeqStr('r2'), 'GGTTA')
+        self.assertEqual(seqs.getQualityStr('r1', 1, 3), 'IH')
+        self.assertEqual(seqs.getQualityStr('r2'), '#####')
+        self.assertRaises(RecordError, build_index, self._write('bad.fastq',
+                '@r1\nACGT\n+\nIII\n'))
+
+    def test_errors(self):
+        """inconsistent line lengths and duplicate names are errors"""
+        self.assertRaises(RecordError, build_index,
+                self._write('bad.fasta', '>a\nACGT\nAC\nACGT\n'))
+        self.assertRaises(RecordError, build_index,
+                self._write('bad.fasta', '>a\nACGT\nACGTA\n'))
+        self.assertRaises(RecordError, build_index,
+                self._write('bad.fasta', '>a\nACGT\n>a\nACGT\n'))
+        self.assertRaises(ValueError, IndexedSequences(self._fasta()).
+                getQualityStr, 'a')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,10 @@
 #!/usr/bin/env python
 """Unit tests for FASTA and related parsers.
 """
+from StringIO import StringIO
 from cogent.parse.fasta import FastaParser, MinimalFastaParser, \
-    NcbiFastaLabelParser, NcbiFastaParser, RichLabel, LabelParser, GroupFastaParser
+    NcbiFastaLabelParser, NcbiFastaParser, RichLabel, LabelParser, \
+    GroupFastaParser, ChunkedFastaParser
 from cogent.core.sequence import DnaSequence, Sequence, ProteinSequence as Protein
 from cogent.core.info import Info
 from cogent.parse.record import RecordError
@@ -107,6 +109,63 @@ class MinimalFastaParserTests(GenericFastaTest):
         self.assertEqual(a, ('abc', 'caggac'))
         self.assertEqual(b, ('456', 'cg'))
 
+class ChunkedFastaParserTests(GenericFastaTest):
+    """Tests of ChunkedFastaParser: should match MinimalFastaParser."""
+    
+    def _parse(self, lines, **kw):
+        text = '\n'.join(lines)
+        results = []
+        for block_size in [1, 3, 1000]:
+            result = list(ChunkedFastaParser(StringIO(text),
+                    block_size=block_size, **kw))
+            if kw.get('as_array'):
+                result = [(label, seq.tostring()) for (label, seq) in result]
+            results.append(result)
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[0], results[2])
+        return results[0]
+    
+    def test_empty(self):
+        """ChunkedFastaParser should handle files without labels"""
+        self.assertEqual(self._parse(self.empty), [])
+        self.assertEqual(self._parse(self.nolabels, strict=False), [])
+        self.assertRaises(RecordError, self._parse, self.nolabels)
+    
+    def test_no_labels(self):
+        """ChunkedFastaParser should complain or skip labels w/o seqs"""
+        self.assertRaises(RecordError, self._parse, self.labels)
+        self.assertEqual(self._parse(self.labels, strict=False), [])
+    
+    def test_records(self):
+        """ChunkedFastaParser should read records like MinimalFastaParser"""
+        for lines in [self.oneseq, self.multiline, self.threeseq,
+                self.oneX, ['#comment', '>a b', ' AC ', '', '# x', 'G']]:
+            expected = list(MinimalFastaParser(lines))
+            self.assertEqual(self._parse(lines), expected)
+            self.assertEqual(self._parse(lines, as_array=True), expected)
+        self.assertEqual(self._parse(self.twogood, strict=False),
+                [('abc', 'caggac'), ('456', 'cg')])
+
+    def test_label_lines(self):
+        """ChunkedFastaParser should find labels after leading whitespace
+        or in \\r\\n lines, like MinimalFastaParser"""
+        for lines in [['  >a', 'AC', ' \t>b c', 'GT', '>d', 'T'],
+                ['>a\r', 'AC\r', '\r', '  >b\r', 'G\r', 'T\r', ''],
+                ['AC >x', '>a', 'G>T', ' ', ' ', '  >b', 'C']]:
+            expected = list(MinimalFastaParser(lines, strict=False))
+            self.assertEqual(self._parse(lines, strict=False), expected)
+            self.assertEqual(self._parse(lines, strict=False, as_array=True),
+                    expected)
+        self.assertEqual(self._parse(['  >a', 'AC', ' >b', 'G']),
+                [('a', 'AC'), ('b', 'G')])
+    
+    def test_as_array(self):
+        """ChunkedFastaParser sequences on one line should be views"""
+        ((label, seq),) = ChunkedFastaParser(StringIO('>abc\nUCAG\n'),
+                as_array=True)
+        self.assertEqual(seq.tostring(), 'UCAG')
+        self.assertFalse(seq.flags.owndata)
+
 class FastaParserTests(GenericFastaTest):
     """Tests of FastaParser: returns sequence objects."""
        
@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 from cogent.util.unit_test import TestCase, main
 
-from cogent.parse.fastq import MinimalFastqParser
+from StringIO import StringIO
+from cogent.parse.fastq import MinimalFastqParser, ChunkedFastqParser
+from cogent.parse.record import RecordError
 
 __author__ = "Gavin Huttley"
 __copyright__ = "Copyright 2007-2016, The Cogent Project"
@@ -52,6 +54,43 @@ class ParseFastq(TestCase):
             self.assertEqual(seq, data[label]["seq"])
             self.assertEqual(qual, data[label]["qual"])
     
+    def test_chunked(self):
+        """chunked parsing should match, whatever the block size"""
+        expected = list(MinimalFastqParser('data/fastq.txt'))
+        for block_size in [1, 100, 2**20]:
+            self.assertEqual(list(ChunkedFastqParser('data/fastq.txt',
+                    block_size=block_size)), expected)
+            result = [(label, seq.tostring(), qual.tostring()) for
+                    (label, seq, qual) in ChunkedFastqParser('data/fastq.txt',
+                    block_size=block_size, as_array=True)]
+            self.assertEqual(result, expected)
+    
+    def test_chunked_bad(self):
+        """chunked parsing should complain about bad records if strict"""
+        for text in ['@a\nACG\n+b\nIII\n', '@a\nACG\n+\nIII\n@b\nA\n',
+                'a\nACG\n+\nIII\n']:
+            self.assertRaises(RecordError, list,
+                    ChunkedFastqParser(StringIO(text)))
+        self.assertEqual(list(ChunkedFastqParser(
+                StringIO('@a\r\nACG\r\n+\r\nIII\r\n\n\n'))),
+                [('a', 'ACG', 'III')])
+        # an incomplete last record, even if not strict
+        self.assertRaises(RecordError, list, ChunkedFastqParser(
+                StringIO('@a\nACG\n+\nIII\n@b\nA\n'), strict=False))
+    
+    def test_chunked_stripped(self):
+        """chunked parsing should strip lines like MinimalFastqParser"""
+        text = '@r1 \nACGT \n+r1\t\nIIII \n@r2\n\n+\n\n@r3\n AC\n+ \nII\n'
+        expected = list(MinimalFastqParser(StringIO(text), strict=False))
+        self.assertEqual(expected[0], ('r1', 'ACGT', 'IIII'))
+        for block_size in [1, 7, 2**20]:
+            self.assertEqual(list(ChunkedFastqParser(StringIO(text),
+                    block_size=block_size, strict=False)), expected)
+            result = [(label, seq.tostring(), qual.tostring()) for
+                    (label, seq, qual) in ChunkedFastqParser(StringIO(text),
+                    block_size=block_size, as_array=True, strict=False)]
+            self.assertEqual(result, expected)
+    
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+"""Unit tests for the Newick parser."""
+from cogent.util.unit_test import TestCase, main
+from cogent.parse.newick import parse_string, TreeParseError, _Tokeniser, \
+        _BulkTokeniser
+from cogent import LoadTree
+
+__author__ = "Peter Maxwell"
+__copyright__ = "Copyright 2007-2016, The Cogent Project"
+__credits__ = ["Peter Maxwell"]
+__license__ = "GPL"
+__version__ = "1.9"
+__maintainer__ = "Peter Maxwell"
+__email__ = "pm67nz@gmail.com"
+__status__ = "Production"
+
+class TokeniserTests(TestCase):
+    """Tests of the bulk tokeniser against the word by word one"""
+    def test_same_tokens(self):
+        """both tokenisers should give the same tokens"""
+        for text in ['((a,b)c,(d,e));', '(a:1,\t(b c,d)x:2,b)y;',
+                '((,),a);', ' a ;', '(\n a_1 : 0.5 ,\r\n b_ \n)\n;\n',
+                '(a,b))', '(a b:1:2,,);']:
+            for unmunge in [False, True]:
+                expected = list(_Tokeniser(text,
+                        underscore_unmunge=unmunge).tokens())
+                result = list(_BulkTokeniser(text,
+                        underscore_unmunge=unmunge).tokens())
+                self.assertEqual(result, expected)
+
+    def test_parse_errors(self):
+        """errors should still be located"""
+        constructor = lambda children, name, attributes: name
+        for text in ['(a,b))', '(a:1:2,b);', '(a,b)c(d);', '(a,b:x);']:
+            try:
+                parse_string(text, constructor)
+            except TreeParseError, e:
+                self.assertTrue(' char ' in str(e), str(e))
+            else:
+                self.fail('no error for %s' % text)
+
+    def test_multiline(self):
+        """labels and lengths split across lines should be the same tree"""
+        tree = LoadTree(treestring='(\n(a : 0.1,\nb:0.2)\nab:0.3,\nc);\n')
+        self.assertEqual(str(tree), '((a:0.1,b:0.2)ab:0.3,c);')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,15 @@
 #! /usr/bin/env python
-import unittest, os
+import unittest, os, sys, cPickle
 import warnings
-from numpy import log, exp
+from numpy import log, exp, array
 warnings.filterwarnings('ignore', 'Not using MPI as mpi4py not found')
 
 from cogent.phylo.distance import EstimateDistances
-from cogent.phylo.nj import nj, gnj
-from cogent.phylo.least_squares import wls
+from cogent.phylo.nj import nj, gnj, ArrayNJ
+from cogent.phylo.least_squares import wls, WLS
+from cogent.phylo.tree_space import tree2ancestry, grown, edge_chunks
+from cogent.util import parallel
+from cogent.phylo.util import distanceDictTo2D
 from cogent import LoadSeqs, LoadTree
 from cogent.phylo.tree_collection import LogLikelihoodScoredTreeCollection,\
     WeightedTreeCollection, LoadTrees, ScoredTreeCollection
@@ -14,6 +17,7 @@ from cogent.evolve.models import JC69, HKY85, F81
 from cogent.phylo.consensus import majorityRule, weightedMajorityRule, \
         getSplits, getTree
 from cogent.util.misc import remove_files
+from cogent.util.unit_test import TestCase
 
 __author__ = "Peter Maxwell"
 __copyright__ = "Copyright 2007-2015, The Cogent Project"
@@ -212,7 +216,7 @@ class ConsensusTests(unittest.TestCase):
         remove_files(['sample.trees'], error_on_missing=False)
     
 
-class TreeReconstructionTests(unittest.TestCase):
+class TreeReconstructionTests(TestCase):
     def setUp(self):
         self.tree = LoadTree(treestring='((a:3,b:4):2,(c:6,d:7):30,(e:5,f:5):5)')
         self.dists = self.tree.getDistances()
@@ -228,6 +232,40 @@ class TreeReconstructionTests(unittest.TestCase):
         """testing nj"""
         reconstructed = nj(self.dists)
         self.assertTreeDistancesEqual(self.tree, reconstructed)
+        reconstructed = nj(self.dists, rapid=True)
+        self.assertTreeDistancesEqual(self.tree, reconstructed)
+    
+    def test_nj_array(self):
+        """nj should accept names and a distance array"""
+        (names, d) = distanceDictTo2D(self.dists)
+        for rapid in [False, True]:
+            reconstructed = nj((names, d), rapid=rapid)
+            self.assertTreeDistancesEqual(self.tree, reconstructed)
+
+    def test_nj_negatives(self):
+        """nj should only keep negative branch lengths if asked to"""
+        names = list('abcd')
+        d = array([[0,1,20,20], [1,0,1,1], [20,1,0,2], [20,1,2,0]], float)
+        for rapid in [False, True]:
+            lengths = [node.Length for node in
+                    nj((names, d), rapid=rapid).getEdgeVector()
+                    if node.Length is not None]
+            self.assertTrue(min(lengths) == 0.0)
+            lengths = [node.Length for node in
+                    nj((names, d), no_negatives=False, rapid=rapid
+                    ).getEdgeVector() if node.Length is not None]
+            self.assertTrue(min(lengths) < 0.0)
+
+    def test_nj_blocks(self):
+        """nj should find the same joins whatever the block size"""
+        (names, d) = distanceDictTo2D(self.dists)
+        original = ArrayNJ._BLOCK
+        try:
+            ArrayNJ._BLOCK = 1
+            reconstructed = nj((names, d))
+        finally:
+            ArrayNJ._BLOCK = original
+        self.assertTreeDistancesEqual(self.tree, reconstructed)
         
     def test_gnj(self):
         """testing gnj"""
@@ -278,8 +316,65 @@ class TreeReconstructionTests(unittest.TestCase):
         # if start tree has all seq names, should raise an error
         self.assertRaises(Exception, wls, self.dists,
                 start=[LoadTree(treestring='((a,c),b,(d,(e,f)))')])
+    
+    def test_wls_batch(self):
+        """batch scoring should match scoring trees one at a time"""
+        evaluator = WLS(self.dists)
+        (ancestry, names, lengths) = tree2ancestry(self.tree)
+        evaluate = evaluator.makeTreeScorer(names)
+        evaluate_batch = evaluator.makeTreeBatchScorer(names)
+        ancestries = [grown(ancestry[:-2, :-2], edge) for edge in range(7)]
+        for ((err, lengths), (err2, lengths2)) in zip(
+                evaluate_batch(ancestries), map(evaluate, ancestries)):
+            self.assertAlmostEqual(err, err2)
+            for (length, length2) in zip(lengths, lengths2):
+                self.assertAlmostEqual(length, length2)
+        self.assertEqual(evaluate_batch([]), [])
+    
+    def test_parallel_wls(self):
+        """trex results should not depend on the parallel context"""
+        dists = dict(((a, b), d * (1.0 + 0.01 * len(a + b)))
+                for ((a, b), d) in self.dists.items() if a < b)
+        kw = dict(a=4, k=3, return_all=True, show_progress=False)
+        self.assertSameWithProcesses(lambda: [(err, str(tree))
+                for (err, tree) in WLS(dists).trex(**kw)])
+    
+    def test_parallel_greedy_wls(self):
+        """greedy (k=1) trex results should not depend on the parallel
+        context"""
+        dists = dict(((a, b), d * (1.0 + 0.01 * len(a + b)))
+                for ((a, b), d) in self.dists.items() if a < b)
+        kw = dict(a=4, k=1, return_all=True, show_progress=False)
+        self.assertSameWithProcesses(lambda: [(err, str(tree))
+                for (err, tree) in WLS(dists).trex(**kw)])
+    
+    def test_edge_chunks(self):
+        """the edges of few trees should be split up to occupy every cpu"""
+        self.assertEqual(edge_chunks(1, 7, 4),
+                [(0, [0]), (0, [1, 2]), (0, [3, 4]), (0, [5, 6])])
+        self.assertEqual(edge_chunks(1, 3, 8),
+                [(0, [0]), (0, [1]), (0, [2])])
+        self.assertEqual(edge_chunks(2, 5, 2),
+                [(0, range(5)), (1, range(5))])
         
     
+class NullFile(object):
+    def write(self, x):
+        pass
+    def isatty(self):
+        return False
+    
+
+def quiet(f, *args, **kw):
+    # Checkpointer still has print statements
+    orig = sys.stdout
+    try:
+        sys.stdout = NullFile()
+        result = f(*args, **kw)
+    finally:
+        sys.stdout = orig
+    return result
+
 class DistancesTests(unittest.TestCase):
     def setUp(self):
         self.al = LoadSeqs(data = {'a':'GTACGTACGATC',
@@ -396,6 +491,70 @@ class DistancesTests(unittest.TestCase):
         expect = d.getPairwiseDistances()
         self.assertDistsAlmostEqual(expect, result)
         
+    def test_EstimateDistances_checkpointing(self):
+        """an interrupted run should resume from its checkpoint file"""
+        filename = 'distances.tmp.pickle'
+        remove_files([filename], error_on_missing=False)
+        done = []
+        def note(lf):
+            done.append(tuple(lf.tree.getTipNames()))
+            return lf
+        
+        d = EstimateDistances(self.al, JC69(), modify_lf=note)
+        quiet(d.run, filename=filename, interval=0)
+        expect = d.getPairwiseDistances()
+        self.assertTrue(os.path.exists(filename))
+        
+        done[:] = []
+        d = EstimateDistances(self.al, JC69(), modify_lf=note)
+        quiet(d.run, filename=filename)
+        self.assertEqual(done, [])
+        self.assertEqual(d.getPairwiseDistances(), expect)
+        
+        # the pairs missing from the file are the only ones done
+        (threeway, est_params, signature, ests) = cPickle.load(open(filename))
+        del ests[('a', 'b')]
+        cPickle.dump((threeway, est_params, signature, ests),
+                open(filename, 'w'))
+        d = EstimateDistances(self.al, JC69(), modify_lf=note)
+        quiet(d.run, filename=filename)
+        self.assertEqual(map(sorted, done), [['a', 'b']])
+        self.assertDistsAlmostEqual(expect, d.getPairwiseDistances())
+        
+        # but not if it is from a different kind of estimation
+        d = EstimateDistances(self.al, JC69(), threeway=True, modify_lf=note)
+        self.assertRaises(ValueError, quiet, d.run, filename=filename)
+        # model
+        d = EstimateDistances(self.al, HKY85(), modify_lf=note)
+        self.assertRaises(ValueError, quiet, d.run, filename=filename)
+        # sequences
+        al = LoadSeqs(data=[(n, str(s)[::-1]) for (n, s) in
+                self.al.NamedSeqs.items()], moltype=self.al.MolType)
+        d = EstimateDistances(al, JC69(), modify_lf=note)
+        self.assertRaises(ValueError, quiet, d.run, filename=filename)
+        # modify_lf or optimisation
+        d = EstimateDistances(self.al, JC69())
+        self.assertRaises(ValueError, quiet, d.run, filename=filename)
+        d = EstimateDistances(self.al, JC69(), modify_lf=note)
+        self.assertRaises(ValueError, quiet, d.run, filename=filename,
+                dist_opt_args={'max_restarts': 2})
+        remove_files([filename], error_on_missing=False)
+    
+    def test_EstimateDistances_rerun(self):
+        """running again should estimate every pair again"""
+        done = []
+        def note(lf):
+            done.append(tuple(lf.tree.getTipNames()))
+            return lf
+        
+        d = EstimateDistances(self.al, JC69(), modify_lf=note)
+        quiet(d.run)
+        self.assertEqual(len(done), 6)
+        done[:] = []
+        quiet(d.run, dist_opt_args={'max_restarts': 2})
+        self.assertEqual(len(done), 6)
+        self.assertEqual(len(d.getPairwiseDistances()), 6)
+    
     def test_get_raw_estimates(self):
         """correctly return raw result object"""
         d = EstimateDistances(self.al, HKY85(), est_params=['kappa'])
@@ -3,7 +3,7 @@
 """
 #SUPPORT2425
 #from __future__ import with_statement
-from cogent.util.unit_test import main, TestCase#, numpy_err
+from cogent.util.unit_test import main, TestCase, FakeCSR#, numpy_err
 from cogent.util.array import gapped_to_ungapped, unmasked_to_masked, \
     ungapped_to_gapped, masked_to_unmasked, pairs_to_array,\
     ln_2, log2, safe_p_log_p, safe_log, row_uncertainty, column_uncertainty,\
@@ -19,7 +19,7 @@ from cogent.util.array import gapped_to_ungapped, unmasked_to_masked, \
     only_nonzero, combine_dimensions, split_dimension, \
     non_diag, perturb_one_off_diag, perturb_off_diag, \
     merge_samples, sort_merged_samples_by_value, classifiers, \
-    minimize_error_count, minimize_error_rate, mutate_array
+    minimize_error_count, minimize_error_rate, mutate_array, sparse_nonzero
 
 import numpy
 Float = numpy.core.numerictypes.sctype2char(float)
@@ -571,6 +571,17 @@ class ArrayMathTests(TestCase):
         a = combine_dimensions(m, -4)
         self.assertEqual(a.shape, (81,))
 
+    def test_sparse_nonzero(self):
+        """sparse_nonzero should give the nonzero values of each row"""
+        m = array([[0, 2, 0], [0, 0, 0], [3, 0, 1]])
+        sparse = FakeCSR(m)
+        sparse.data[0] = 0
+        (shape, row, col, values) = sparse_nonzero(sparse)
+        self.assertEqual(shape, (3, 3))
+        self.assertEqual(row, [2, 2])
+        self.assertEqual(col, [0, 2])
+        self.assertEqual(values, [3, 1])
+
     def test_split_dimension(self):
         """split_dimension should unpack specified dimension"""
         m = reshape(arange(12**3), (12,12,12))
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+"""Unit tests for multiprocessing pools."""
+import os
+from cogent.util.unit_test import TestCase, main
+from cogent.util import parallel
+
+__author__ = "Peter Maxwell"
+__copyright__ = "Copyright 2007-2016, The Cogent Project"
+__credits__ = ["Peter Maxwell"]
+__license__ = "GPL"
+__version__ = "1.9"
+__maintainer__ = "Gavin Huttley"
+__email__ = "gavin.huttley@anu.edu.au"
+__status__ = "Production"
+
+class MultiprocessingTests(TestCase):
+    """Tests of the reuse of worker pools"""
+    def setUp(self):
+        self.context = parallel.MultiprocessingParallelContext(2)
+        data = range(10)
+        def squared_and_pid(i):
+            # an unpicklable closure
+            return (data[i]**2, os.getpid())
+        self.f = squared_and_pid
+
+    def tearDown(self):
+        parallel.unregister(self.f)
+        parallel.close_pools()
+
+    def _run(self, f, n=10):
+        results = list(self.context.imap(f, range(n)))
+        return ([value for (value, pid) in results],
+                set(pid for (value, pid) in results))
+
+    def test_imap(self):
+        """unregistered functions should get new workers each time"""
+        (values, pids) = self._run(self.f)
+        self.assertEqual(values, [i**2 for i in range(10)])
+        self.assertFalse(os.getpid() in pids)
+        self.assertFalse(2 in parallel._POOLS)
+        self.assertFalse(id(self.f) in parallel._FUNCTIONS)
+        # which see any changes to the data they use
+        data = [0]
+        g = lambda i: (i * data[0], os.getpid())
+        self._run(g, 4)
+        data[0] = 10
+        (values, pids) = self._run(g, 4)
+        self.assertEqual(values, [0, 10, 20, 30])
+
+    def test_register(self):
+        """registered functions should outlive their pool"""
+        parallel.register(self.f)
+        self._run(self.f)
+        pool = parallel._POOLS[2]
+        (values, pids) = self._run(self.f)
+        self.assertEqual(values, [i**2 for i in range(10)])
+        self.assertTrue(parallel._POOLS[2] is pool)
+        self._run(lambda i: (i, os.getpid()))
+        (values, pids) = self._run(self.f)
+        self.assertEqual(values, [i**2 for i in range(10)])
+        self.assertTrue(parallel._POOLS[2] is pool)
+
+    def test_registered(self):
+        """functions registered together should share one pool, which is
+        stopped after the with block"""
+        g = lambda i: (-i, os.getpid())
+        with parallel.registered(self.f, g):
+            (values, pids) = self._run(self.f)
+            pool = parallel._POOLS[2]
+            (values2, pids2) = self._run(g)
+            self.assertEqual(values2, [-i for i in range(10)])
+            self.assertTrue(parallel._POOLS[2] is pool)
+            self.assertTrue(pids2.issubset(pids))
+        self.assertFalse(2 in parallel._POOLS)
+        self.assertFalse(id(g) in parallel._FUNCTIONS)
+    
+    def test_registered_seeded_imap(self):
+        """seeded_imap of a registered function should reuse its pool"""
+        shuffled = lambda item, permutation_f: (item, list(permutation_f(5)))
+        expected = list(parallel.seeded_imap(shuffled, 'abc', seed=1))
+        with parallel.parallel_context(self.context):
+            with parallel.registered(shuffled):
+                for i in range(2):
+                    self.assertEqual(list(parallel.seeded_imap(shuffled,
+                            'abc', seed=1)), expected)
+                    pool = parallel._POOLS[2]
+                    self.assertTrue(i == 0 or pool is first_pool)
+                    first_pool = pool
+        self.assertFalse(2 in parallel._POOLS)
+    
+    def test_nested(self):
+        """a busy pool shouldn't be replaced"""
+        g = lambda i: (-i, os.getpid())
+        results = []
+        for (value, pid) in self.context.imap(self.f, range(3)):
+            results.append((value, self._run(g, 2)[0]))
+        self.assertEqual(results, [(0, [0, -1]), (1, [0, -1]), (4, [0, -1])])
+        (values, pids) = self._run(self.f)
+        self.assertEqual(values, [i**2 for i in range(10)])
+
+    def test_seeded_imap(self):
+        """seeded_imap should give each item its own seeded permutations"""
+        shuffled = lambda item, permutation_f: (item, list(permutation_f(5)))
+        first = self.assertSameWithProcesses(
+                lambda: list(parallel.seeded_imap(shuffled, 'abc', seed=1)))
+        self.assertEqual([item for (item, perm) in first], list('abc'))
+        self.assertNotEqual(first[0][1], first[1][1])
+        self.assertNotEqual(first,
+                list(parallel.seeded_imap(shuffled, 'abc', seed=2)))
+        # other permutation_fs are used in order
+        perms = [[4,3,2,1,0], [0,1,2,3,4]]
+        self.assertEqual(list(parallel.seeded_imap(shuffled, 'ab',
+                permutation_f=lambda n: perms.pop(0))),
+                [('a', [4,3,2,1,0]), ('b', [0,1,2,3,4])])
+
+
+if __name__ == '__main__':
+    main()